@@ -0,0 +1,181 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import chord
+import craq
+import http_pool
+import keyspace
+
+"""
+Batch insert/query/delete shared by the bootstrap and the regular nodes.
+
+A batch is split by the node it has to go to next: the keys this node is primary for are applied here and replicated
+as one write of the chain pipeline (chain_pipeline.py) or through the eventual consistency queue, the rest are grouped by next hop (successor or closest preceding finger) and each group
+is forwarded as one sub-batch, all groups in parallel. A bulk load therefore costs a few round trips per owner
+instead of one routed request per key. Every call returns a per-key result: {"status": <http status>, ...}.
+Under chain replication the keys of a batch are dirty on every node of the chain until the batch is acknowledged
+(see craq.py), a batch query answers the clean ones at the primary and asks the tail only for the dirty ones.
+"""
+
+MAX_PARALLEL_FORWARDS = int(os.getenv("BATCH_MAX_PARALLEL_FORWARDS", "16"))
+
+
+def _address(node):
+    return f"{node.get_ip()}:{node.get_port()}"
+
+
+def split_by_owner(node, song_names):
+    # returns the songs this node is responsible for and the rest grouped by next hop
+    local = []
+    groups = {}
+    for song_name in song_names:
+        key = keyspace.key_id(song_name)
+        if chord.is_responsible(node, key):
+            local.append(song_name)
+        else:
+            groups.setdefault(tuple(chord.next_hop(node, key)), []).append(song_name)
+    return local, groups
+
+
+def forward_groups(node, path, groups, build_payload, params=None):
+    # forwards every group to its next hop in parallel and merges the per-key results, params go along with each
+    results = {}
+    if not groups:
+        return results
+
+    def send(hop, song_names):
+        try:
+            response = chord.forward_to(node, list(hop), "POST", path, json=build_payload(song_names), params=params or {})
+            response.raise_for_status()
+            return response.json().get("results", {})
+        except requests.RequestException as e:
+            return {song_name: {"status": 500, "error": f"Failed to forward batch to node {hop[0]}:{hop[1]}: {str(e)}"} for song_name in song_names}
+
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_FORWARDS, len(groups))) as executor:
+        for partial in executor.map(lambda group: send(*group), groups.items()):
+            results.update(partial)
+    return results
+
+
+def replicate(node, path, payload):
+    # sends one replication packet to the successor, returns the per-key results of the rest of the chain
+    successor = node.get_successor()
+    if not successor or successor == []:
+        return {}
+    response = http_pool.post(f"http://{successor[0]}:{successor[1]}{path}", json=payload)
+    response.raise_for_status()
+    return response.json().get("results", {})
+
+
+def insert(node, items, k, consistency, number_of_nodes, replication, pipeline):
+    local, groups = split_by_owner(node, items)
+    results = forward_groups(node, "/batch/insert", groups, lambda song_names: {"items": {song_name: items[song_name] for song_name in song_names}})
+
+    if local:
+        to_send = min(k, number_of_nodes)  # under-replication, the chain is as long as the ring
+
+        def apply():
+            for song_name in local:
+                node.insert(song_name, items[song_name])
+            return local
+
+        if consistency == "chain replication":
+            _, committed = pipeline.write("insert", local, apply, to_send - 1)
+        else:
+            apply()
+            committed = True
+            if consistency == "eventual consistency" and to_send > 1 and node.get_successor():
+                for song_name in local:
+                    replication.enqueue(song_name, "insert", node.get_song_list()[song_name], to_send - 1)
+        for song_name in local:
+            results[song_name] = {"status": 200, "node": _address(node)} if committed else {"status": 504, "error": "The tail of the chain did not acknowledge the batch"}
+    return results
+
+
+def query(node, song_names, k, consistency, view, params=None):
+    local, groups = split_by_owner(node, song_names)
+    results = forward_groups(node, "/batch/query", groups, lambda names: {"keys": names}, params)
+
+    if local:
+        if consistency == "chain replication" and k > 1 and node.get_successor():
+            # linearizable reads: clean songs from here, dirty ones from the tail of the chain
+            members = view.chain(node.get_key(), k)
+            try:
+                if craq.is_member(node, members):
+                    results.update(craq.read_many(node, members, local))
+                else:
+                    results.update(replicate(node, "/batch/chain_replicated_query", {"keys": local, "k": k - 1}))
+            except requests.RequestException as e:
+                for song_name in local:
+                    results[song_name] = {"status": 500, "error": f"Failed to forward batch query: {str(e)}"}
+        else:
+            results.update(local_query(node, local))
+    return results
+
+
+def local_query(node, song_names):
+    results = {}
+    for song_name in song_names:
+        result = node.query(song_name)
+        if result is None:
+            results[song_name] = {"status": 404}
+        else:
+            results[song_name] = {"status": 200, "value": result, "node": _address(node)}
+    return results
+
+
+def delete(node, song_names, k, consistency, number_of_nodes, replication, pipeline):
+    local, groups = split_by_owner(node, song_names)
+    results = forward_groups(node, "/batch/delete", groups, lambda names: {"keys": names})
+
+    if local:
+        to_send = min(k, number_of_nodes)  # under-replication, the chain is as long as the ring
+
+        def apply():
+            return [song_name for song_name in local if node.delete(song_name)]
+
+        if consistency == "chain replication":
+            deleted, committed = pipeline.write("delete", local, apply, to_send - 1)
+        else:
+            deleted, committed = apply(), True
+            if deleted and consistency == "eventual consistency" and to_send > 1 and node.get_successor():
+                for song_name in deleted:
+                    replication.enqueue(song_name, "delete", None, to_send - 1)
+        deleted = set(deleted)
+        for song_name in local:
+            if song_name not in deleted:
+                results[song_name] = {"status": 404}
+            elif committed:
+                results[song_name] = {"status": 200, "node": _address(node)}
+            else:
+                results[song_name] = {"status": 504, "error": "The tail of the chain did not acknowledge the batch"}
+    return results
+
+
+def apply_eventual_insert(node, items, counter, replication):
+    # one hop of eventual replication: store the values and queue them for the successor, acknowledged right away
+    if counter <= 0:
+        return {}
+    for song_name, value in items.items():
+        node.set_song_to_song_list(song_name, value)
+        replication.enqueue(song_name, "insert", value, counter - 1)
+    return {song_name: {"status": 200, "node": _address(node)} for song_name in items}
+
+
+def apply_eventual_delete(node, song_names, counter, replication):
+    if counter <= 0:
+        return {}
+    results = {}
+    for song_name in song_names:
+        results[song_name] = {"status": 200 if node.delete(song_name) else 404, "node": _address(node)}
+        replication.enqueue(song_name, "delete", None, counter - 1)
+    return results
+
+
+def chain_query(node, song_names, counter):
+    # walk down the chain, the last node (counter == 1) answers
+    if counter <= 1 or not node.get_successor():
+        return local_query(node, song_names)
+    return replicate(node, "/batch/chain_replicated_query", {"keys": song_names, "k": counter - 1})
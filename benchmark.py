@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import random
+import time
+
+import aiohttp
+import requests
+
+from local_cluster import LocalCluster, configure
+
+"""
+YCSB-style benchmark of the DHT.
+
+Clients are asyncio tasks sharing one aiohttp session. Every operation goes to a random node, like the requests of
+the original experiments, and picks its key from a uniform or a Zipfian distribution over --keys keys. The operation
+mix comes from a preset (--workload) or from --read/--write/--delete.
+
+  closed loop (default): --clients clients, each sends its next request when the previous one answered
+  open loop (--rate R):  requests arrive as a Poisson process of R per second whatever the latency. Latency counts
+                         from the scheduled arrival, so time spent queueing behind slow requests is included
+                         (no coordinated omission)
+
+Results go to a JSON file: the configuration, throughput, p50/p99/p999 latency overall and per operation, and a
+timeline of throughput and p99 per --interval. first_experiment.py and second_experiment.py plot these files.
+
+    python benchmark.py --cluster 4 --k 3 --consistency "eventual consistency" --workload insert --output results/insert_k3_eventual.json
+    python benchmark.py --nodes http://10.0.17.96:5000 http://10.0.17.245:5001 --workload a --distribution zipfian
+
+With --nodes, --k and --consistency switch the running ring to those settings before the run (POST /config), so a
+whole matrix of settings can be measured against one live cluster.
+"""
+
+WORKLOADS = {  # (read, write, delete) fractions
+    "insert": (0.0, 1.0, 0.0),
+    "query": (1.0, 0.0, 0.0),
+    "a": (0.5, 0.5, 0.0),  # YCSB A, update heavy
+    "b": (0.95, 0.05, 0.0),  # YCSB B, read mostly
+    "c": (1.0, 0.0, 0.0),  # YCSB C, read only
+    "mixed": (0.45, 0.45, 0.1),
+}
+PRELOAD_BATCH = 1000  # songs per /batch/insert when the keys are loaded before the run
+
+
+class ZipfianGenerator:
+    """Zipfian ranks in [0, items) with exponent theta, the rejection-free method of Gray et al. that YCSB uses."""
+
+    def __init__(self, items, theta=0.99, rng=random):
+        self.items = items
+        self.theta = theta
+        self.rng = rng
+        self.zetan = sum(1.0 / (i ** theta) for i in range(1, items + 1))
+        zeta2 = 1.0 + 1.0 / (2 ** theta)
+        self.alpha = 1.0 / (1.0 - theta)
+        self.eta = (1 - (2.0 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < 1.0 + 0.5 ** self.theta:
+            return 1
+        return min(self.items - 1, int(self.items * ((self.eta * u - self.eta + 1) ** self.alpha)))
+
+
+class UniformGenerator:
+    def __init__(self, items, rng=random):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randrange(self.items)
+
+
+def percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) if ordered else None,
+        "p50": percentile(ordered, 0.50),
+        "p99": percentile(ordered, 0.99),
+        "p999": percentile(ordered, 0.999),
+        "max": ordered[-1] if ordered else None,
+    }
+
+
+class Benchmark:
+    def __init__(self, nodes, mix, keys, distribution, theta, duration, clients, rate, interval, seed):
+        self.nodes = nodes
+        self.operations = ["read", "write", "delete"]
+        self.cumulative = [sum(mix[:i + 1]) for i in range(len(mix))]
+        self.keys = keys
+        self.rng = random.Random(seed)
+        self.chooser = ZipfianGenerator(keys, theta, self.rng) if distribution == "zipfian" else UniformGenerator(keys, self.rng)
+        self.duration = duration
+        self.clients = clients
+        self.rate = rate
+        self.interval = interval
+        self.samples = []  # (finished_at - started, operation, latency, outcome)
+
+    def next_operation(self):
+        operation = self.operations[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+        song_name = f"user{self.chooser.next()}"
+        return operation, song_name, self.rng.choice(self.nodes)
+
+    async def send(self, session, operation, song_name, node):
+        if operation == "read":
+            request = session.get(f"{node}/query/{song_name}")
+        elif operation == "write":
+            request = session.post(f"{node}/insert/{song_name}/{self.rng.randrange(1000)}")
+        else:
+            request = session.delete(f"{node}/delete/{song_name}")
+        try:
+            async with request as response:
+                await response.read()
+                if response.status < 300 or (response.status == 404 and operation != "write"):
+                    return "ok"  # a missing song is a valid answer for reads and deletes
+                return "error"
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return "error"
+
+    async def timed(self, session, scheduled):
+        operation, song_name, node = self.next_operation()
+        outcome = await self.send(session, operation, song_name, node)
+        finished = time.perf_counter()
+        self.samples.append((finished - self.started, operation, finished - scheduled, outcome))
+
+    async def closed_client(self, session, deadline):
+        while time.perf_counter() < deadline:
+            await self.timed(session, time.perf_counter())
+
+    async def open_loop(self, session, deadline):
+        pending = set()
+        scheduled = time.perf_counter()
+        while True:
+            scheduled += self.rng.expovariate(self.rate)
+            if scheduled >= deadline:
+                break
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            task = asyncio.ensure_future(self.timed(session, scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=self.clients)
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.started = time.perf_counter()
+            deadline = self.started + self.duration
+            if self.rate:
+                await self.open_loop(session, deadline)
+            else:
+                await asyncio.gather(*(self.closed_client(session, deadline) for _ in range(self.clients)))
+            self.elapsed = time.perf_counter() - self.started
+
+    def results(self):
+        ok = [sample for sample in self.samples if sample[3] == "ok"]
+        windows = [[] for _ in range(math.ceil(self.elapsed / self.interval))]
+        for sample in ok:
+            windows[min(len(windows) - 1, int(sample[0] / self.interval))].append(sample[2])
+        timeline = [{"t": index * self.interval, "throughput": len(window) / self.interval, "p99": percentile(sorted(window), 0.99)}
+                    for index, window in enumerate(windows)]
+        return {
+            "elapsed": self.elapsed,
+            "operations": len(self.samples),
+            "errors": len(self.samples) - len(ok),
+            "throughput": len(ok) / self.elapsed,
+            "latency": summarize([sample[2] for sample in ok]),
+            "per_operation": {operation: summarize([sample[2] for sample in ok if sample[1] == operation])
+                              for operation in self.operations if any(sample[1] == operation for sample in ok)},
+            "timeline": timeline,
+        }
+
+
+def preload(nodes, keys):
+    # every key once, so reads find something and deletes have something to delete
+    for first in range(0, keys, PRELOAD_BATCH):
+        items = {f"user{i}": 0 for i in range(first, min(keys, first + PRELOAD_BATCH))}
+        requests.post(f"{nodes[0]}/batch/insert", json={"items": items}, timeout=600).raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YCSB-style benchmark of the DHT")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--nodes", nargs="+", help="URLs of running nodes, requests are spread over them")
+    target.add_argument("--cluster", type=int, metavar="N", help="start a local cluster of N regular nodes plus the bootstrap")
+    parser.add_argument("--k", type=int, help="replication factor (default 2 for --cluster, unchanged for --nodes)")
+    parser.add_argument("--consistency", choices=["chain replication", "eventual consistency"],
+                        help="consistency model (default chain replication for --cluster, unchanged for --nodes)")
+    parser.add_argument("--workload", default="a", choices=sorted(WORKLOADS), help="operation mix preset (default a: 50%% reads, 50%% writes)")
+    parser.add_argument("--read", type=float, help="fraction of reads, overrides the preset together with --write/--delete")
+    parser.add_argument("--write", type=float)
+    parser.add_argument("--delete", type=float)
+    parser.add_argument("--keys", type=int, default=10000, help="number of distinct keys")
+    parser.add_argument("--distribution", default="uniform", choices=["uniform", "zipfian"])
+    parser.add_argument("--theta", type=float, default=0.99, help="Zipfian exponent")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of measurement")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients (closed loop), connection limit (open loop)")
+    parser.add_argument("--rate", type=float, help="open loop: arrivals per second; closed loop when not given")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds per timeline point")
+    parser.add_argument("--no-preload", action="store_true", help="do not insert the keys before the run")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    mix = WORKLOADS[args.workload]
+    if any(fraction is not None for fraction in (args.read, args.write, args.delete)):
+        mix = (args.read or 0.0, args.write or 0.0, args.delete or 0.0)
+    if sum(mix) <= 0:
+        parser.error("the operation mix is empty")
+
+    cluster = None
+    if args.cluster:
+        cluster = LocalCluster(args.cluster, args.k or 2, args.consistency or "chain replication").start()
+    try:
+        nodes = cluster.urls if cluster else [node.rstrip('/') for node in args.nodes]
+        if not cluster and (args.k or args.consistency):
+            configure(nodes, args.k, args.consistency)
+        overlay = requests.get(f"{nodes[0]}/overlay", timeout=30).json()
+        if not args.no_preload and (mix[0] or mix[2]):
+            preload(nodes, args.keys)
+        benchmark = Benchmark(nodes, mix, args.keys, args.distribution, args.theta, args.duration, args.clients,
+                              args.rate, args.interval, args.seed)
+        asyncio.run(benchmark.run())
+    finally:
+        if cluster:
+            cluster.stop()
+
+    results = {
+        "config": {
+            "workload": args.workload if mix == WORKLOADS[args.workload] else "custom",
+            "mix": dict(zip(["read", "write", "delete"], mix)),
+            "k": overlay.get("k"),
+            "consistency": overlay.get("consistency"),
+            "nodes": len(overlay.get("overlay", [])),
+            "keys": args.keys,
+            "distribution": args.distribution,
+            "theta": args.theta if args.distribution == "zipfian" else None,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "clients": args.clients,
+            "duration": args.duration,
+        },
+        **benchmark.results(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    latency = results["latency"]
+    print(f"{results['throughput']:.1f} ops/s, {results['errors']} errors, "
+          f"p50 {latency['p50'] * 1000:.2f} ms, p99 {latency['p99'] * 1000:.2f} ms, p999 {latency['p999'] * 1000:.2f} ms -> {args.output}"
+          if latency["count"] else f"no successful operations, {results['errors']} errors -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,40 @@
-from flask import Flask, request, jsonify
+import serving
+serving.patch_if_async()  # before anything below opens sockets or threads
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from node import BootstrapNode  
 import utils
+import chain_pipeline
+import chord
+import craq
+import keyspace
+import batch
+import handoff
+import http_pool
+import latency
+import log
+import membership
+import metrics
+import scatter
+from chain_pipeline import ChainPipeline
+from replication_queue import ReplicationQueue
 import os
 import requests
-import threading
 from dotenv import load_dotenv
 import sys
-import time
+import threading
+import urllib.parse
 
 app = Flask(__name__)
+app.before_request(log.start_request)  # per-request trace sampling
+metrics.instrument(app)  # per-route counts, in-flight gauges and latency histograms for /metrics
 
-k = utils.k # replication factor
+logger = log.get_logger("bootstrap")
+trace = log.get_tracer("bootstrap")
 
-consistency = utils.consistency # chain replication
+lookup_mode = utils.lookup_mode # recursive forwarding or iterative redirects
+
+ring_view = membership.MembershipView()  # the bootstrap advances it on every join, departure and settings change
 
 number_of_nodes = 1
 
@@ -22,16 +44,77 @@ network_nodes = [{
     "key": utils.hash_function(f"{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}")
 }]
 
-def belongs_to_me(key, current, predecessor):
-    if predecessor == current:
-        # single node ring covers everything
-        return True
-    if predecessor < current:
-        # normal no wrap
-        return predecessor < key <= current
-    else:
-        # wrap around case
-        return key > predecessor or key <= current
+pending_joins = set()  # keys of joining nodes that are in the ring but not yet in the membership view (handoff running)
+pending_resizes = set()  # keys of the nodes still pulling the ranges a larger k added to their window
+
+def request_settings():
+    # (k, consistency) of this request: the cluster settings of the membership view, ?consistency= overrides the model
+    # of a read (check_consistency_override turns it away on writes)
+    k, consistency = ring_view.settings()
+    return k, request.args.get("consistency", consistency)
+
+
+def consistency_override():
+    # query parameters that carry a per-request consistency override along when the request is forwarded
+    return {"consistency": request.args["consistency"]} if "consistency" in request.args else {}
+
+
+def resize_window(ring, old_k, new_k):
+    # a new k changes every replica window, the bootstrap refills or trims its own like every other node
+    try:
+        received, dropped = handoff.resize(node, ring, old_k, new_k)
+        logger.info("Replication factor %s -> %s: received %s songs, dropped %s", old_k, new_k, received, dropped)
+    except requests.RequestException as e:
+        logger.warning("Replication factor %s -> %s: failed to refill the replica window: %s", old_k, new_k, str(e))
+        return
+    resize_done(utils.hash_function(f"{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}"), new_k)
+
+
+def resize_done(key, k):
+    # a node has the whole window of k; once every node has, reads are spread over the whole chain
+    if k != ring_view.k or key not in pending_resizes:
+        return  # a report for an older change, or from a node that joined with the new k
+    pending_resizes.discard(key)
+    if not pending_resizes:
+        view = publish_membership()
+        logger.info("Every node filled its replica window, reads use k=%s at epoch %s", view["read_k"], view["epoch"])
+
+
+def iterative_lookup():
+    return request.args.get("mode", lookup_mode) == "iterative"
+
+
+def redirect_to_next_hop(hop):
+    # iterative lookup: hand the next hop back to the client (307 keeps the method) instead of waiting on it
+    args = request.args.to_dict()
+    args.update({"mode": "iterative", "routed": "1"})
+    location = f"http://{hop[0]}:{hop[1]}{urllib.parse.quote(request.path)}?{urllib.parse.urlencode(args)}"
+    response = jsonify({"message": f"Not responsible, continue at node {hop[0]}:{hop[1]}", "next_hop": hop})
+    response.status_code = 307
+    response.headers["Location"] = location
+    return response
+
+
+@app.before_request
+def inject_network_delay():
+    # models WAN latency per endpoint when NETWORK_DELAY is set (see latency.py), no-op otherwise
+    latency.inject(request.endpoint)
+
+
+WRITE_ENDPOINTS = ("insert_song", "delete", "batch_insert", "batch_delete")  # routes that take no ?consistency=
+
+
+@app.before_request
+def check_consistency_override():
+    override = request.args.get("consistency")
+    if override is None:
+        return None
+    if request.endpoint in WRITE_ENDPOINTS:
+        # a write replicated another way than the ring's other writes could be reordered with them at a replica
+        return jsonify({"error": f"The consistency model can only be overridden on reads, writes use the cluster's ({ring_view.consistency})"}), 400
+    if override not in membership.CONSISTENCY_MODELS:
+        return jsonify({"error": f"Unknown consistency model '{override}', expected one of {list(membership.CONSISTENCY_MODELS)}"}), 400
+
 
 @app.route('/')
 def home():
@@ -40,99 +123,71 @@ def home():
 
 @app.route('/insert/<string:song_name>/<int:value>', methods=['POST'])
 def insert_song(song_name: str, value: int = 0):
-    key = utils.hash_function(song_name)  # compute hash key for routing
-    current_id = node.get_identifier()
+    k, consistency = request_settings()
+    if request.args.get("routed") and not node.get_successor():
+        # reached through a stale finger after this node departed
+        return jsonify({"error": "Node is not part of the ring"}), 410
+    key = keyspace.key_id(song_name)  # ring position used for routing
     
     predecessor = node.get_predecessor() 
     
     if predecessor in (None, []):
-        print("Only One Node: Insert Locally")
+        trace.debug("Only One Node: Insert Locally")
         node.insert(song_name, value)
         return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
     
-    print(f"Predecessor IP: {predecessor[0]}, Predecessor Port: {predecessor[1]}")
-
-    predecessor = utils.hash_function(f"{predecessor[0]}:{predecessor[1]}")
-    
+    trace.debug("Predecessor IP: %s, Predecessor Port: %s", predecessor[0], predecessor[1])
      
-    print(f"--- INSERT REQUEST ---")
-    print(f"Song: {song_name}")
-    print(f"Computed Key: {key}")
-    print(f"Current Node ID: {current_id} (IP: {node.get_ip()}, Port: {node.get_port()})")
-    print(f"Predecessor Key: {predecessor}")
-    print(f"Successor Key: {utils.hash_function(f'{node.get_successor()[0]}:{node.get_successor()[1]}')}")
+    trace.debug("--- INSERT REQUEST --- Song: %s, Computed Key: %040x, Current Node ID: %s (IP: %s, Port: %s)", song_name, key, node.get_identifier(), node.get_ip(), node.get_port())
     
-    # Check if the key falls in the interval (predecessor, current_id]
-    if belongs_to_me(key,  current_id, predecessor,):
-        print("Responsible : Inserting locally.")
-        node.insert(song_name, value)
+    # Check if the key falls in the interval (predecessor, current node]
+    if chord.is_responsible(node, key):
+        trace.debug("Responsible : Inserting locally.")
+        to_send = min(k, ring_view.size())  # under-replication, the chain is as long as the ring
         # Check for the consistency model 
         if consistency == 'chain replication':
-            print(f"Consistency Model: {consistency} and we start from the primary node of the key {node.get_ip()}:{node.get_port()}")
-            # The Last Node in the chain has to return the response to the client
-            if node.get_successor() == []:
-                return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
-            else:
-                try: 
-                    packet = {"song_name": song_name, "value": node.get_song_list()[song_name], "k": k-1} 
-                    response = requests.post(f"http://{node.get_successor()[0]}:{node.get_successor()[1]}/chain_replicated_insert",json=packet)
-                    response.raise_for_status()
-                    return response.json(), response.status_code
-                except requests.RequestException as e:
-                    return jsonify({"error": f"Failed to forward request to node {node.get_successor()[0]}:{node.get_successor()[1]}: {str(e)}"}), 500          
-        
-        elif consistency == "eventual consistency": # eventual consistency
-            print(f"Consistency Model: {consistency} and we start from the primary node of the key {node.get_ip()}:{node.get_port()}")
-            # The First Node in the chain has to return the response to the client and then return the response to the client, meanwhile a thread has been opened to replicate the song to the next k-1 nodes
+            trace.debug("Consistency Model: %s and we start from the primary node of the key %s:%s", consistency, node.get_ip(), node.get_port())
+            # applied, numbered and queued down the chain in one step; answered once the tail acknowledged the write
+            _, committed = pipeline.write("insert", [song_name], lambda: node.insert(song_name, value) or [song_name], to_send-1)
+            if not committed:
+                return jsonify({"error": f"The tail of the chain did not acknowledge the write within {chain_pipeline.ACK_TIMEOUT}s"}), 504
+            return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
+        node.insert(song_name, value)
+        if consistency == "eventual consistency": # eventual consistency
+            trace.debug("Consistency Model: %s and we start from the primary node of the key %s:%s", consistency, node.get_ip(), node.get_port())
+            # The First Node in the chain returns the response to the client, the replication queue replicates the song to the next k-1 nodes
             if node.get_successor() == []:
                 return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
             else:
-                packet = {"song_name": song_name, "value": node.get_song_list()[song_name], "k": k-1} # prepare the packet that is the argument of the thread
-                thread = threading.Thread(target=eventual_insertion_background, args=(packet,)) # our argument is the function that we want to run in the thread, so from the function we hit the endpoint
-                thread.start() # start the thread to replicate the song to the next k-1 nodes
+                # queued for the next k-1 nodes, the replication workers ship it in the background
+                replication.enqueue(song_name, "insert", node.get_song_list()[song_name], to_send-1)
                 return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
               
              
         else:  # no cosistency model
-             print("Responsible : Inserting locally. No consistency model")
+             trace.debug("Responsible : Inserting locally. No consistency model")
              return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
         
     else:
-        print("Not responsible : Forwarding to successor.")
-        # Forward the request to the successor.
-        successor = node.get_successor()
+        trace.debug("Not responsible : Forwarding to the closest preceding finger.")
+        # Forward the request to the successor or to the finger that is closest to the key.
+        successor = chord.next_hop(node, key)
         if successor == []:  #if no successor insert locally.
             node.insert(song_name, value)
             return jsonify({"message": f"Inserted '{song_name}' locally at node {node.get_ip()} and port {node.get_port()} (alone in ring)"}), 200
         
-        print(f'Forwarding to successor {successor[0]}:{successor[1]}')
-        successor_url = f"http://{successor[0]}:{successor[1]}/insert/{song_name}/{value}"
+        if iterative_lookup():
+            return redirect_to_next_hop(successor)
+        
+        trace.debug('Forwarding to next hop %s:%s', successor[0], successor[1])
         try:
-            response = requests.post(successor_url)
+            response = chord.forward(node, key, "POST", f"/insert/{song_name}/{value}")
             response.raise_for_status()
-            return response.json()  # Return the response from the successor.
+            return response.json()  # Return the response from the next hop.
         except requests.RequestException as e:
             return jsonify({"error": f"Failed to forward request to node {successor[0]}:{successor[1]}: {str(e)}"}), 500
 
 
-def eventual_insertion_background(packet):
-    time.sleep(0.01)  # 10 millisecond delay
-    successor = node.get_successor()
-    if not successor or successor == []:
-        print("No valid successor found, replication stops here.")
-        return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-    try:
-        response = requests.post(f"http://{successor[0]}:{successor[1]}/eventual_insertion", json=packet)
-        response.raise_for_status()
-        print("Response from endpoint of :", response.json())
-    except Exception as e:
-        print("Error calling endpoint:", e)
-        # threads in Python terminate automatically when the function call ends, so no need to do anything else here for the thread
-    return response.json()
-
-
-# Have to correct the eventual_insertion endpoint ... 
-
 @app.route('/eventual_insertion', methods=['POST'])
 def eventual_insertion():
     data = request.get_json()
@@ -143,144 +198,73 @@ def eventual_insertion():
     value = data["value"]
     counter = data["k"]
     
-    print(f"Received chain replication packet for '{song_name}' with k = {counter} at node {node.get_ip()}:{node.get_port()}")
-    
+    trace.debug("Received eventual replication packet for '%s' with k = %s at node %s:%s", song_name, counter, node.get_ip(), node.get_port())
     
     # K = 1
-    if counter ==0:
-        print(f"K=1 and  {node.get_ip()}:{node.get_port()}")
+    if counter <= 0:
+        trace.debug("K=1 and  %s:%s", node.get_ip(), node.get_port())
         return jsonify({"message": "Did not do anything..."}), 200
     
-    if counter == 1: # Last node and we return the response 
-        print(f"Last Node that the song replication happens {node.get_ip()}:{node.get_port()}")
-        node.set_song_to_song_list(song_name, value)
-        return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()} -> Last Node that the song was eventually inserted ..."}), 200
-    
-    else: # not the last node in the chain of k
-        node.set_song_to_song_list(song_name, value)
-        new_counter = counter - 1
-        new_packet = {"song_name": song_name, "value": value, "k": new_counter}
-        successor = node.get_successor()
-        if not successor or successor == []:
-            print("No valid successor found, replication stops here.")
-            return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-        
-        replication_url = f"http://{successor[0]}:{successor[1]}/eventual_insertion"
-        
-        try:
-            print(f"Node {node.get_ip()}:{node.get_port()} forwarding chain replication packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-            response = requests.post(replication_url, json=new_packet)
-            response.raise_for_status()
-            return jsonify({
-                "message": f"Forwarded chain replication packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                "next_response": response.json()
-            }), 200
-        except requests.RequestException as e:
-            return jsonify({"error": f"Failed to forward chain replication packet to node {successor}: {str(e)}"}), 500
-        
-    
-    
+    node.set_song_to_song_list(song_name, value)
+    # the rest of the chain is served by the replication queue, the sender does not wait for it
+    replication.enqueue(song_name, "insert", value, counter - 1)
+    return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
+
 
-@app.route('/chain_replicated_insert', methods=['POST'])
-def chain_replicated_insert():
+# pipelined chain replication: updates from the predecessor, applied in order and passed on without waiting
+@app.route('/chain_append', methods=['POST'])
+def chain_append():
     data = request.get_json()
-    if not data or "song_name" not in data or "value" not in data or "k" not in data:
+    if not data or not isinstance(data.get("updates"), list):
         return jsonify({"error": "Invalid replication packet data"}), 400
-    
-    song_name = data["song_name"]
-    value = data["value"]
-    counter = data["k"]
-    
-    time.sleep(0.01)  # 10 millisecond delay at each hop
+    pipeline.append(data["updates"])
+    return jsonify({"message": f"Applied {len(data['updates'])} updates"}), 200
+
+
+# cumulative acknowledgements from the successor, chain -> highest sequence number committed at the tail
+@app.route('/chain_ack', methods=['POST'])
+def chain_ack():
+    data = request.get_json()
+    if not data or not isinstance(data.get("acks"), dict):
+        return jsonify({"error": "Invalid acknowledgement"}), 400
+    pipeline.ack(data["acks"])
+    return jsonify({"message": "Acknowledged"}), 200
 
-    
-    print(f"Received chain replication packet for '{song_name}' with k = {counter} at node {node.get_ip()}:{node.get_port()}")
-    
-    if counter == 0:
-        print(f"K=1 and  {node.get_ip()}:{node.get_port()}")
-        return jsonify({"message": "Did not do anything..."}), 200
-    
-    if counter == 1: # Last node in the chain and we return the response to the client
-        print(f"Last Node that the song replication happens {node.get_ip()}:{node.get_port()}")
-        node.set_song_to_song_list(song_name, value)
-        return jsonify({"message": f"Inserted '{song_name}' at node {node.get_ip()} and port {node.get_port()} -> Last Node of the Chain"}), 200
-    
-    else:
-        node.set_song_to_song_list(song_name, value)
-        new_counter = counter - 1
-        new_packet = {"song_name": song_name, "value": value, "k": new_counter}
-        successor = node.get_successor()
-        if not successor or successor == []:
-            print("No valid successor found, replication stops here.")
-            return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-        
-        replication_url = f"http://{successor[0]}:{successor[1]}/chain_replicated_insert"
-        
-        try:
-            print(f"Node {node.get_ip()}:{node.get_port()} forwarding chain replication packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-            response = requests.post(replication_url, json=new_packet)
-            response.raise_for_status()
-            return jsonify({
-                "message": f"Forwarded chain replication packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                "next_response": response.json()
-            }), 200
-        except requests.RequestException as e:
-            return jsonify({"error": f"Failed to forward chain replication packet to node {successor}: {str(e)}"}), 500
-    
 
 @app.route('/query/<string:song_name>', methods=['GET'])
 def query_song(song_name: str):
+    k, consistency = request_settings()
+    k = min(k, ring_view.read_k)  # a grown k is read from once the new replicas have their ranges
+    if request.args.get("routed") and not node.get_successor():
+        # reached through a stale finger after this node departed
+        return jsonify({"error": "Node is not part of the ring"}), 410
     if song_name == "*":
-        # Use a visited set to avoid loops
-        visited_param = request.args.get('visited', '')
-        visited_set = set(visited_param.split(',')) if visited_param else set()
-
-        current_node_id = f"{node.get_ip()}:{node.get_port()}"
-        if current_node_id in visited_set:
-            return jsonify({"songs": {}}), 200
-        visited_set.add(current_node_id)
-
-        local_songs = node.get_song_list().copy()
-        this_node_id = node.get_identifier()
-        predecessor = node.get_predecessor()
-        
-        # Single node case
-        if predecessor in (None, []):
-            return jsonify({"songs": local_songs}), 200
-        
-        if isinstance(predecessor, list):
-            predecessor_id = utils.hash_function(f"{predecessor[0]}:{predecessor[1]}")
-        else:
-            predecessor_id = predecessor or this_node_id
-
-        successor = node.get_successor()
-        if not successor or successor == []:
-            return jsonify({"songs": local_songs}), 200
-
-        successor_url = (
-            f"http://{successor[0]}:{successor[1]}/query/*"
-            f"?visited={','.join(visited_set)}"
-        )
+        # fan out to the primary of every range of the ring, each song comes back once
+        if request.args.get("format") == "ndjson":
+            # full dump in ring order, relayed range by range
+            return Response(stream_with_context(scatter.stream_all(node, ring_view.ring(), k)), mimetype='application/x-ndjson')
         try:
-            response = requests.get(successor_url)
-            response.raise_for_status()
-            successor_songs = response.json().get("songs", {})
+            if "cursor" in request.args or "limit" in request.args:
+                cursor = request.args.get("cursor")
+                limit = request.args.get("limit", scatter.PAGE_SIZE, type=int)
+                if limit <= 0:
+                    return jsonify({"error": "limit has to be a positive number"}), 400
+                songs, next_cursor = scatter.query_page(node, ring_view.ring(), k, keyspace.from_hex(cursor) if cursor else None, limit)
+                return jsonify({
+                    "songs": [{"song_name": song_name, "value": value} for song_name, value in songs],
+                    "next_cursor": keyspace.to_hex(next_cursor) if next_cursor is not None else None
+                }), 200
+            return jsonify({"songs": scatter.query_all(node, ring_view.ring(), k)}), 200
         except requests.RequestException as e:
-            return jsonify({
-                "error": f"Failed to forward query to node {successor}: {str(e)}"
-            }), 500
-
-        local_songs.update(successor_songs)
-        return jsonify({"songs": local_songs}), 200
+            return jsonify({"error": f"Failed to collect the songs of the ring: {str(e)}"}), 500
 
     else: # Query for a specific song 
-        key = utils.hash_function(song_name)
-        current_id = node.get_identifier()
+        key = keyspace.key_id(song_name)
         predecessor = node.get_predecessor()
 
         # If we have no predecessor, the node is alone.
         if not predecessor or predecessor == []:
-            print("Only One Node: Query Locally")
+            trace.debug("Only One Node: Query Locally")
             result = node.query(song_name)
             if result is None:
                 return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
@@ -289,18 +273,11 @@ def query_song(song_name: str):
                 "value": result
             }), 200
 
-        if isinstance(predecessor, list):
-            predecessor_id = utils.hash_function(f"{predecessor[0]}:{predecessor[1]}")
-       
-        print(f"--- QUERY REQUEST (Clockwise) ---")
-        print(f"Song: {song_name}")
-        print(f"Computed Key: {key}")
-        print(f"Current Node ID: {current_id} (IP: {node.get_ip()}, Port: {node.get_port()})")
-        print(f"Predecessor Key: {predecessor_id}")
+        trace.debug("--- QUERY REQUEST (Clockwise) --- Song: %s, Computed Key: %040x, Current Node ID: %s (IP: %s, Port: %s)", song_name, key, node.get_identifier(), node.get_ip(), node.get_port())
         
         
         if consistency == "eventual consistency":
-            print(f"Consistency Model: {consistency} and we start from a random node {node.get_ip()}:{node.get_port()}")
+            trace.debug("Consistency Model: %s and we start from a random node %s:%s", consistency, node.get_ip(), node.get_port())
             # Get visited nodes from query parameters (if any)
             visited_param = request.args.get("visited", "")
             visited_set = set(visited_param.split(',')) if visited_param else set()
@@ -312,13 +289,15 @@ def query_song(song_name: str):
 
             result = node.query(song_name)
             if result is None:
-                successor = node.get_successor()
-                if successor == []:
+                successor = chord.next_hop(node, key)
+                if successor == [] or chord.is_responsible(node, key):
+                    # the primary node is the first replica of the key, nobody after it can have a copy we are missing
                     return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
+                if iterative_lookup():
+                    return redirect_to_next_hop(successor)
                 try:
-                    # Forward the request while appending the visited set.
-                    successor_url = f"http://{successor[0]}:{successor[1]}/query/{song_name}?visited={','.join(visited_set)}"
-                    response = requests.get(successor_url)
+                    # Forward the request towards the primary node while appending the visited set.
+                    response = chord.forward(node, key, "GET", f"/query/{song_name}", params={"visited": ','.join(visited_set), **consistency_override()})
                     response.raise_for_status()
                     return response.json(), response.status_code
                 except requests.RequestException as e:
@@ -334,49 +313,56 @@ def query_song(song_name: str):
                 }), 200
 
         
-        # If the key falls in our interval, we are responsible.
-        if belongs_to_me(key, current_id, predecessor_id):
-            # If chain replication is enabled, delegate read to the tail.
-            if consistency == "chain replication":
-                if node.get_successor() and node.get_successor() != []:
-                    successor = node.get_successor()
-                    packet = {"song_name": song_name, "k": k-1}
-                    chain_query_url = f"http://{successor[0]}:{successor[1]}/chain_replicated_query?song_name={song_name}&k={k-1}"
-                    try:
-                        print(f"Chain replication enabled; forwarding query for '{song_name}' to tail via node {successor[0]}:{successor[1]}.")
-                        response = requests.get(chain_query_url)
-                        response.raise_for_status()
-                        return response.json(), response.status_code
-                    except requests.RequestException as e:
-                        return jsonify({"error": f"Failed to forward chain replicated query: {str(e)}"}), 500
-                else:
-                    # No successor means this node is the tail.
-                    result = node.query(song_name)
-                    if result is None:
-                        return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
-                    return jsonify({
-                        "message": f"Song found at tail node {node.get_ip()}:{node.get_port()}",
-                        "value": result
-                    }), 200
-            
-            else: # no consistency model
-                print("Responsible : Querying locally.")
-                result = node.query(song_name)
+        if consistency == "chain replication":
+            # CRAQ: every node of the key's chain answers reads, a dirty key is checked with the tail
+            members = ring_view.chain(key, k)
+            if craq.is_member(node, members):
+                try:
+                    result = craq.read(node, members, song_name)
+                except requests.RequestException as e:
+                    return jsonify({"error": f"Failed to ask the tail for the committed version: {str(e)}"}), 500
                 if result is None:
                     return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
                 return jsonify({
-                    "message": f"Song found at node {node.get_ip()}:{node.get_port()}",
+                    "message": f"Song found at chain node {node.get_ip()}:{node.get_port()}",
                     "value": result
                 }), 200
+            if members and (not request.args.get("routed") or chord.is_responsible(node, key)):
+                # one hop to a random node of the chain, the read load of a key is spread over its k replicas; a
+                # joining node is not in the view until its handoff is done and passes the reads it owns on as well
+                hop = craq.pick(members)
+                if iterative_lookup():
+                    return redirect_to_next_hop(hop)
+                try:
+                    response = chord.forward_to(node, hop, "GET", f"/query/{song_name}", params=consistency_override())
+                    if response.status_code == 404:
+                        return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
+                    response.raise_for_status()
+                    return response.json(), response.status_code
+                except requests.RequestException as e:
+                    return jsonify({"error": f"Failed to forward query to node {hop}: {str(e)}"}), 500
+
+        # If the key falls in our interval, we are responsible.
+        if chord.is_responsible(node, key):
+            # no membership view yet
+            trace.debug("Responsible : Querying locally.")
+            result = node.query(song_name)
+            if result is None:
+                return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
+            return jsonify({
+                "message": f"Song found at node {node.get_ip()}:{node.get_port()}",
+                "value": result
+            }), 200
             
         else: # Does not belong to us (we are not responsible, meaning we are not the primary node for this song)
-            successor = node.get_successor()
+            successor = chord.next_hop(node, key)
             if successor == []:
                 return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
+            if iterative_lookup():
+                return redirect_to_next_hop(successor)
 
-            successor_url = f"http://{successor[0]}:{successor[1]}/query/{song_name}"
             try:
-                response = requests.get(successor_url)
+                response = chord.forward(node, key, "GET", f"/query/{song_name}", params=consistency_override())
                 if response.status_code == 404:
                     return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 404
                 response.raise_for_status()
@@ -392,7 +378,7 @@ def chain_replicated_query():
     counter = int(request.args.get("k"))
     
     if counter == 1:
-        print(f"Last Node that the song query happens {node.get_ip()}:{node.get_port()}")
+        trace.debug("Last Node that the song query happens %s:%s", node.get_ip(), node.get_port())
         result = node.query(song_name)
         if result is None:
             return jsonify({"message": f"Song '{song_name}' not found in DHT"}), 200
@@ -409,7 +395,7 @@ def chain_replicated_query():
         # Otherwise, forward the query further along the chain.
         chain_query_url = f"http://{successor[0]}:{successor[1]}/chain_replicated_query?song_name={song_name}&k={counter-1}"
         try:
-            response = requests.get(chain_query_url)
+            response = http_pool.get(chain_query_url)
            
             response.raise_for_status()
             return response.json(), response.status_code
@@ -424,66 +410,55 @@ def chain_replicated_query():
 
 @app.route('/delete/<string:song_name>', methods=['DELETE'])
 def delete(song_name: str):
-    key = utils.hash_function(song_name)
+    k, consistency = request_settings()
+    if request.args.get("routed") and not node.get_successor():
+        # reached through a stale finger after this node departed
+        return jsonify({"error": "Node is not part of the ring"}), 410
+    key = keyspace.key_id(song_name)
     current_ip = node.get_ip()
-    current_id = node.get_identifier()
     # Use predecessor to define responsibility.
     pred = node.get_predecessor()
     
     if pred in (None, []):
-        print("Only One Node: Delete Locally")
+        trace.debug("Only One Node: Delete Locally")
         result = node.delete(song_name)
         if result:
             return jsonify({"message": f"Deleted song '{song_name}' from node {current_ip}:{node.get_port()}"}), 200
         else:
             return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
     
-    if isinstance(pred, list):
-        pred = utils.hash_function(f"{pred[0]}:{pred[1]}")
-    
-    if belongs_to_me(key, current_id ,pred):
-        result = node.delete(song_name)
-        
-        network_nodes = 0
-        try:
-            request = requests.get(f"http://{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}/get_nodes")
-            network_nodes = request.json().get("number_of_nodes", 1)
-        except requests.RequestException as e:
-            return jsonify({"error": f"Failed to get number of nodes from bootstrap node: {str(e)}"}), 500
+    if chord.is_responsible(node, key):
+        ring_size = ring_view.size()  # from the local membership view, the bootstrap is not on the delete path
         
         to_send = k
-        if network_nodes <= k:
-            print('Under-replication detected\n')
-            to_send = network_nodes
-            
+        if ring_size <= k:
+            trace.debug('Under-replication detected')
+            to_send = ring_size
+        
+        if consistency == "chain replication":
+            trace.debug("Consistency Model: %s and we start from the primary node of the key %s:%s", consistency, node.get_ip(), node.get_port())
+            # deleted, numbered and queued down the chain in one step; answered once the tail acknowledged the delete
+            deleted, committed = pipeline.write("delete", [song_name], lambda: [song_name] if node.delete(song_name) else [], to_send-1)
+            if not deleted:
+                return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
+            if not committed:
+                return jsonify({"error": f"The tail of the chain did not acknowledge the write within {chain_pipeline.ACK_TIMEOUT}s"}), 504
+            return jsonify({"message": f"Deleted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
+        
+        result = node.delete(song_name)
         
         if result == True:
-            if consistency == "chain replication":
-                print(f"Consistency Model: {consistency} and we start from the primary node of the key {node.get_ip()}:{node.get_port()}")
-                # The Last Node in the chain has to return the response to the client
+            if consistency == "eventual consistency": # eventual consistency
+                trace.debug("Consistency Model: %s and we start from the primary node of the key %s:%s", consistency, node.get_ip(), node.get_port())
+                # The First Node in the chain returns the response to the client, the replication queue replicates the song to the next k-1 nodes
                 if node.get_successor() == []:
                     return jsonify({"message": f"Deleted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
-                else:
-                    try: 
-                        packet = {"song_name": song_name, "k": to_send-1}
-                        response = requests.post(f"http://{node.get_successor()[0]}:{node.get_successor()[1]}/chain_replicated_delete",json=packet)
-                        response.raise_for_status()
-                        return response.json(), response.status_code
-                    except requests.RequestException as e:
-                        return jsonify({"error": f"Failed to forward request to node {node.get_successor()[0]}:{node.get_successor()[1]}: {str(e)}"}), 500
-
-            elif consistency == "eventual consistency": # eventual consistency
-                print(f"Consistency Model: {consistency} and we start from the primary node of the key {node.get_ip()}:{node.get_port()}")
-                # The First Node in the chain has to return the response to the client and then return the response to the client, meanwhile a thread has been opened to replicate the song to the next k-1 nodes
-                if node.get_successor() == []:
-                    return jsonify({"message": f"Deleted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
-                packet = {"song_name": song_name , "k": to_send-1}  # prepare the packet that is the argument of the thread
-                thread = threading.Thread(target=eventual_deletion_background, args=(packet,)) # our argument is the function that we want to run in the thread, so from the function we hit the endpoint
-                thread.start() # start the thread to replicate the song to the next k-1 nodes
+                # queued for the next k-1 nodes, the replication workers ship it in the background
+                replication.enqueue(song_name, "delete", None, to_send-1)
                 return jsonify({"message": f"Deleted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
             
             else:  # no cosistency model
-                print("Responsible : Deleting locally. No consistency model")
+                trace.debug("Responsible : Deleting locally. No consistency model")
                 node.delete(song_name)
                 return jsonify({"message": f"Deleted '{song_name}' at node {node.get_ip()} and port {node.get_port()}"}), 200
             
@@ -491,15 +466,15 @@ def delete(song_name: str):
             return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
     
     else:
-        # Forward the delete request to the successor.
-        successor = node.get_successor()
+        # Forward the delete request to the successor or the closest preceding finger.
+        successor = chord.next_hop(node, key)
         if successor == []:
             return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
-        
-        successor_url = f"http://{successor[0]}:{successor[1]}/delete/{song_name}"
+        if iterative_lookup():
+            return redirect_to_next_hop(successor)
     
     try:
-        response = requests.delete(successor_url)
+        response = chord.forward(node, key, "DELETE", f"/delete/{song_name}")
         
         # If the successor reports a 404, return a 404 response here as well.
         if response.status_code == 404:
@@ -515,20 +490,6 @@ def delete(song_name: str):
         return jsonify({"error": f"Failed to forward delete request to node {successor}: {str(e)}"}), 500
 
 
-def eventual_deletion_background(packet):
-    successor = node.get_successor()
-    if not successor or successor == []:
-        print("No valid successor found, deletion stops here.")
-        return jsonify({"message": "Deletion ended at this node (no successor)"}), 200
-    try:
-        response = requests.post(f"http://{successor[0]}:{successor[1]}/eventual_deletion", json=packet)
-        response.raise_for_status()
-        print("Response from endpoint of :", response.json())
-    except Exception as e:
-        print("Error calling endpoint:", e)
-        # threads in Python terminate automatically when the function call ends, so no need to do anything else here for the thread
-    return response.json()
-
 @app.route('/eventual_deletion', methods=['POST'])
 def eventual_deletion():
     data = request.get_json()
@@ -537,89 +498,91 @@ def eventual_deletion():
     song_name = data["song_name"]
     counter = data["k"]
     
-    if k == 1:
-        print(f"K=1 and  {node.get_ip()}:{node.get_port()}")
+    if counter <= 0:
+        trace.debug("K=1 and  %s:%s", node.get_ip(), node.get_port())
         return jsonify({"message": "Did not do anything..."}), 200
     
-    if counter == 1:
-        print(f"Last Node that the song deletion happens {node.get_ip()}:{node.get_port()}")
-        result = node.delete(song_name)
-        if result:
-            return jsonify({"message": f"Deleted song '{song_name}' from node {node.get_ip()}:{node.get_port()} -> Last Node of the Chain"}), 200
-        else:
-            return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
+    result = node.delete(song_name)
+    # propagate even when the song is missing here, an earlier insert may still be queued towards this node
+    replication.enqueue(song_name, "delete", None, counter - 1)
+    if result:
+        return jsonify({"message": f"Deleted song '{song_name}' from node {node.get_ip()}:{node.get_port()}"}), 200
     else:
-        result = node.delete(song_name)
-        if result:
-            new_counter = counter - 1
-            new_packet = {"song_name": song_name, "k": new_counter}
-            successor = node.get_successor()
-            if not successor or successor == []:
-                print("No valid successor found, deletion stops here.")
-                return jsonify({"message": "Deletion ended at this node (no successor)"}), 200
-            
-            replication_url = f"http://{successor[0]}:{successor[1]}/eventual_deletion"
-            try:
-                print(f"Node {node.get_ip()}:{node.get_port()} forwarding chain deletion packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-                response = requests.post(replication_url, json=new_packet)
-                response.raise_for_status()
-                return jsonify({
-                    "message": f"Forwarded chain deletion packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                    "next_response": response.json()
-                }), 200
-            except requests.RequestException as e:
-                return jsonify({"error": f"Failed to forward chain deletion packet to node {successor}: {str(e)}"}), 500
-        else:
-            return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
+        return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
     
 
-@app.route('/chain_replicated_delete', methods=['POST'])
-def chain_replicated_delete():
+
+"""------------------------------------------------------Batch Requests--------------------------------------------------------------------------------"""
+@app.route('/batch/insert', methods=['POST'])
+def batch_insert():
+    if request.args.get("routed") and not node.get_successor():
+        return jsonify({"error": "Node is not part of the ring"}), 410
     data = request.get_json()
-    if not data or "song_name" not in data or "k" not in data:
+    if not data or not isinstance(data.get("items"), dict) or not all(isinstance(value, int) for value in data["items"].values()):
+        return jsonify({"error": "Invalid batch, expected {\"items\": {song_name: integer value}}"}), 400
+    k, consistency = request_settings()
+    return jsonify({"results": batch.insert(node, data["items"], k, consistency, ring_view.size(), replication, pipeline)}), 200
+
+
+@app.route('/batch/query', methods=['POST'])
+def batch_query():
+    if request.args.get("routed") and not node.get_successor():
+        return jsonify({"error": "Node is not part of the ring"}), 410
+    data = request.get_json()
+    if not data or not isinstance(data.get("keys"), list):
+        return jsonify({"error": "Invalid batch, expected {\"keys\": [song_name, ...]}"}), 400
+    k, consistency = request_settings()
+    k = min(k, ring_view.read_k)
+    return jsonify({"results": batch.query(node, data["keys"], k, consistency, ring_view, consistency_override())}), 200
+
+
+@app.route('/batch/delete', methods=['POST'])
+def batch_delete():
+    if request.args.get("routed") and not node.get_successor():
+        return jsonify({"error": "Node is not part of the ring"}), 410
+    data = request.get_json()
+    if not data or not isinstance(data.get("keys"), list):
+        return jsonify({"error": "Invalid batch, expected {\"keys\": [song_name, ...]}"}), 400
+    k, consistency = request_settings()
+    return jsonify({"results": batch.delete(node, data["keys"], k, consistency, ring_view.size(), replication, pipeline)}), 200
+
+
+@app.route('/batch/eventual_insertion', methods=['POST'])
+def batch_eventual_insertion():
+    data = request.get_json()
+    if not data or not isinstance(data.get("items"), dict) or "k" not in data:
         return jsonify({"error": "Invalid replication packet data"}), 400
-    
-    song_name = data["song_name"]
-    counter = data["k"]
-    
-    print(f"Received chain replication packet for '{song_name}' with k = {counter} at node {node.get_ip()}:{node.get_port()}")
-    
-    
-    if counter == 0:
-        print(f"K=1 and  {node.get_ip()}:{node.get_port()}")
-        return jsonify({"message": "Did not do anything..."}),200
-    
-    
-    if counter == 1:
-        print(f"Last Node that the song deletion happens {node.get_ip()}:{node.get_port()}")
-        result = node.delete(song_name)
-        if result:
-            return jsonify({"message": f"Deleted song '{song_name}' from node {node.get_ip()}:{node.get_port()} -> Last Node of the Chain"}), 200
-        else:
-            return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
-    else:
-        result = node.delete(song_name)
-        if result:
-            new_counter = counter - 1
-            new_packet = {"song_name": song_name, "k": new_counter}
-            successor = node.get_successor()
-            if not successor or successor == []:
-                print("No valid successor found, deletion stops here.")
-                return jsonify({"message": "Deletion ended at this node (no successor)"}), 200
-            
-            replication_url = f"http://{successor[0]}:{successor[1]}/chain_replicated_delete"
-            try:
-                print(f"Node {node.get_ip()}:{node.get_port()} forwarding chain deletion packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-                response = requests.post(replication_url, json=new_packet)
-                response.raise_for_status()
-                return jsonify({
-                    "message": f"Forwarded chain deletion packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                    "next_response": response.json()
-                }), 200
-            except requests.RequestException as e:
-                return jsonify({"error": f"Failed to forward chain deletion packet to node {successor}: {str(e)}"}), 500
-        else:
-            return jsonify({"message": f"Song '{song_name}' not found in the DHT"}), 404
+    return jsonify({"results": batch.apply_eventual_insert(node, data["items"], data["k"], replication)}), 200
+
+
+@app.route('/batch/eventual_deletion', methods=['POST'])
+def batch_eventual_deletion():
+    data = request.get_json()
+    if not data or not isinstance(data.get("keys"), list) or "k" not in data:
+        return jsonify({"error": "Invalid replication packet data"}), 400
+    return jsonify({"results": batch.apply_eventual_delete(node, data["keys"], data["k"], replication)}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(replication, pipeline), mimetype='text/plain; version=0.0.4'), 200
+
+
+@app.route('/replication_stats', methods=['GET'])
+def replication_stats():
+    # depth and lag of the eventual consistency replication queue, outbox and in-flight writes of the chain pipeline
+    return jsonify(dict(replication.stats(), chain=pipeline.stats())), 200
+
+
+@app.route('/batch/chain_replicated_query', methods=['POST'])
+def batch_chain_replicated_query():
+    data = request.get_json()
+    if not data or not isinstance(data.get("keys"), list) or "k" not in data:
+        return jsonify({"error": "Invalid replication packet data"}), 400
+    try:
+        return jsonify({"results": batch.chain_query(node, data["keys"], data["k"])}), 200
+    except requests.RequestException as e:
+        return jsonify({"error": f"Failed to forward chain replicated batch query: {str(e)}"}), 500
 
 
 """------------------------------------------------------Join Request--------------------------------------------------------------------------------"""
@@ -633,19 +596,25 @@ def join_network():
     if not candidate_node_ip or not candidate_node_port or not candidate_node_key:
         return jsonify({"error": "Invalid join request; insufficient data"}), 400
     
-    print(f"Join request from {candidate_node_ip}:{candidate_node_port} with key {candidate_node_key}")
+    logger.info("Join request from %s:%s with key %s", candidate_node_ip, candidate_node_port, candidate_node_key)
     
+    rejoin = False
     for node_info in network_nodes:
         if node_info["key"] == candidate_node_key:
-            return jsonify({"error": "Node already exists in network"}), 400
-    
-    candidate_node = {
-        "ip": candidate_node_ip,
-        "port": candidate_node_port,
-        "key": candidate_node_key
-    }
-    network_nodes.append(candidate_node)
-    network_nodes.sort(key=lambda n: n["key"])
+            if [node_info["ip"], str(node_info["port"])] != [candidate_node_ip, str(candidate_node_port)]:
+                return jsonify({"error": "Node already exists in network"}), 400
+            # a member that restarted (e.g. recovered from DATA_DIR) joins again, the ring does not change
+            rejoin = True
+    
+    if not rejoin:
+        candidate_node = {
+            "ip": candidate_node_ip,
+            "port": candidate_node_port,
+            "key": candidate_node_key
+        }
+        network_nodes.append(candidate_node)
+        network_nodes.sort(key=lambda n: n["key"])
+        pending_joins.add(candidate_node_key)
     
     candidate_index = next(i for i, n in enumerate(network_nodes) if n["key"] == candidate_node_key)
     predecessor_index = (candidate_index - 1) % len(network_nodes)
@@ -658,13 +627,38 @@ def join_network():
         "message": "Node successfully joined the network",
         "predecessor": [predecessor["ip"], predecessor["port"]],
         "successor": [successor["ip"], successor["port"]],
+        "ring": [[n["ip"], n["port"]] for n in network_nodes],  # sorted by key, used for the range handoff
+        "membership": ring_view.snapshot(),  # the new node enters the view on /join_complete
+        "rejoin": rejoin,
     }
     
-    global number_of_nodes
-    number_of_nodes += 1
+    if not rejoin:
+        global number_of_nodes
+        number_of_nodes += 1
     
     return jsonify(response_data), 200
 
+@app.route('/join_complete', methods=['POST'])
+def join_complete():
+    # the joining node has its pointers and its replica window, from now on it serves the keys of the new view
+    data = request.get_json(silent=True) or {}
+    if not data.get("ip") or not data.get("port"):
+        return jsonify({"error": "Invalid join_complete request; insufficient data"}), 400
+    key = utils.hash_function(f"{data['ip']}:{data['port']}")
+    if key not in pending_joins:
+        return jsonify(ring_view.snapshot()), 200  # a rejoin, or a retry after the view was published
+    pending_joins.discard(key)
+    return jsonify(publish_membership()), 200
+
+@app.route('/resize_complete', methods=['POST'])
+def resize_complete():
+    # a node pulled the ranges the current k added to its replica window
+    data = request.get_json(silent=True) or {}
+    if not data.get("ip") or not data.get("port") or "k" not in data:
+        return jsonify({"error": "Invalid resize_complete request; insufficient data"}), 400
+    resize_done(utils.hash_function(f"{data['ip']}:{data['port']}"), data["k"])
+    return jsonify({"epoch": ring_view.epoch, "read_k": ring_view.read_k}), 200
+
 @app.route('/join', methods=['POST'])
 def join():
     # Fetch bootstrap node details from environment variables.
@@ -682,7 +676,7 @@ def join():
     # Construct URL for bootstrap node's join_network endpoint.
     bootstrap_url = f"http://{bootstrap_node_ip}:{bootstrap_node_port}/join_network"
     try:
-        response = requests.post(bootstrap_url, json={
+        response = http_pool.post(bootstrap_url, json={
             "ip": node.get_ip(),
             "port": node.get_port(),
             "key_to_join": my_key
@@ -704,7 +698,7 @@ def join():
     if node.get_predecessor():
         pred_url = f"http://{node.get_predecessor()[0]}:{node.get_predecessor()[1]}/update_successor"
         try:
-            response = requests.post(pred_url, json={
+            response = http_pool.post(pred_url, json={
                 "ip": node.get_ip(),
                 "port": node.get_port()
             })
@@ -715,7 +709,7 @@ def join():
     if node.get_successor():
         succ_url = f"http://{node.get_successor()[0]}:{node.get_successor()[1]}/update_predecessor"
         try:
-            response = requests.post(succ_url, json={
+            response = http_pool.post(succ_url, json={
                 "ip": node.get_ip(),
                 "port": node.get_port()
             })
@@ -723,253 +717,57 @@ def join():
         except requests.RequestException as e:
             return jsonify({"error": f"Failed to update successor's predecessor: {str(e)}"}), 500
     
-    # start the replication process
-    print('Starting replication process...\n')
-    
-    pred = node.get_predecessor()
-    if pred and isinstance(pred, list):
-        pred_param = f"{pred[0]},{pred[1]}"
-    else:
-        pred_param = ""
-    
-    
-    
-    try: 
-        request = requests.get(f"http://{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}/get_nodes")
-        number_of_nodes = request.json().get("number_of_nodes", 1)
-    except requests.RequestException as e:
-        return jsonify({"error": f"Failed to get number of nodes from bootstrap node: {str(e)}"}), 500
-    
-    # handle the case of under-replication, all nodes have the same song_list
-    if number_of_nodes <= k:
-        print('Under-replication detected, starting replication process...\n')
-        pred = node.get_predecessor()
-        pred_song_list = {}
+    # hand off the keys of the new replica windows in bulk
+    ring = data_from_bootstrap.get("ring", [])
+    received = dropped = 0
+    if ring:
+        logger.info('Starting range handoff...')
         try:
-            request = requests.get(f"http://{pred[0]}:{pred[1]}/show_song_list")
-            pred_song_list = request.json()
+            received = handoff.join(node, ring, ring_view.k, data_from_bootstrap.get("rejoin", False))
         except requests.RequestException as e:
-            return jsonify({"error": f"Failed to get song list from predecessor: {str(e)}"}), 500
-        
-        node.set_song_list(pred_song_list)
-        return jsonify({"message": "Join request processed"}), 200
+            return jsonify({"error": f"Failed to hand off the key ranges: {str(e)}"}), 500
     
+    # only now the bootstrap publishes the view with this node, the chains of its keys change over to it
+    try:
+        response = http_pool.post(f"http://{bootstrap_node_ip}:{bootstrap_node_port}/join_complete", json={
+            "ip": node.get_ip(),
+            "port": node.get_port()
+        })
+        response.raise_for_status()
+    except requests.RequestException as e:
+        return jsonify({"error": f"Failed to complete the join: {str(e)}"}), 500
+    ring_view.apply(response.json())
     
-    if node.get_successor() != [] and node.get_predecessor != []:
-     # 1. get the songs from the successor that are supposed to be in this node (if any ...)
-        successor = node.get_successor()
-        successor_url = f"http://{successor[0]}:{successor[1]}/replicate?pred={pred_param}"       
+    # the nodes past the new window drop what they no longer replicate, once the reads of the new view land here
+    if ring:
         try:
-            response = requests.get(successor_url)
-            response.raise_for_status()
+            dropped = handoff.trim_neighbours(node, ring, ring_view.k)
         except requests.RequestException as e:
-            return jsonify({"error": f"Failed to replicate songs from successor: {str(e)}"}), 500
-        
-        songs_to_replicate = response.json().get("songs_that_belong_to_me", {})
-        if songs_to_replicate == None or songs_to_replicate == {}:
-            print ('No songs to replicate, ending replication process...\n')
-            return jsonify({"status": "No songs to replicate"}), 200
-         
-        else:    #2. send a packet for each song I replicated to the whole DHT starting from The Primary Node of this Key , which is consisted of the song its value and a counter each time k-1, and if k == 0 then delete it from the list because it violates the replication factor of k 
-            print('First Step done...\n')   
-            print(f"Songs to replicate: {songs_to_replicate}")
-            # first we insert the songs to our node_list and then we send the aforementioned packet to the whole DHT
-            for song in songs_to_replicate:
-                node.insert(song, songs_to_replicate[song])
-                packet = {"song_name": song, "value": songs_to_replicate[song], "k":k-1}
-                # send the packet to the whole DHT (until we get again to this node starting from the node that actually is responsible for the key), to see if we have to delete the song from the list of the node that gets the request
-                # If this node is responsible for the song, start the replication process here.
-                song_key = utils.hash_function(song)
-                current_id = node.get_identifier()
-                predecessor_id = utils.hash_function(f"{pred[0]}:{pred[1]}")
-                if belongs_to_me(song_key, current_id, predecessor_id):
-                    successor = node.get_successor()
-                    if not successor or successor == []:
-                        print("No valid successor found; replication aborted.")
-                        return jsonify({"message": "Replication aborted (no successor)"}), 200
-                    
-                    primary_url = f"http://{successor[0]}:{successor[1]}/start_replication"
-                    try:
-                        print(f"Node {node.get_ip()}:{node.get_port()} is primary for '{song}', starting replication.")
-                        response = requests.post(primary_url, json=packet)
-                        response.raise_for_status()
-                        print(f"Replication packet for '{song}' successfully initiated.")
-                    except requests.RequestException as e:
-                        print(f"Error starting replication for song '{song}': {str(e)}")
-                else:
-                    # this node is not the primary for the song, forward the replication packet to our successor, in order to find the primary node for this song 
-                    successor = node.get_successor()
-                    if not successor or successor == []:
-                        print("No valid successor found; replication aborted.")
-                        continue
-                    replication_url = f"http://{successor[0]}:{successor[1]}/find_primary"
-                    try:
-                        print(f"Forwarding replication packet for '{song}' (not primary here) to node {successor[0]}:{successor[1]}.")
-                        response = requests.post(replication_url, json=packet)
-                        response.raise_for_status()
-                    except requests.RequestException as e:
-                        print(f"Error forwarding replication for song '{song}': {str(e)}")
-                
-                print('Replication process done...\n')
-
-    return jsonify({"message": "Join request processed"}), 200
-
-
-@app.route('/find_primary', methods=['POST'])
-def find_primary():
+            return jsonify({"error": f"Failed to trim the neighbours' replica windows: {str(e)}"}), 500
+        logger.info('Range handoff done, received %s songs, neighbours dropped %s replicas', received, dropped)
+    return jsonify({"message": "Join request processed", "received": received, "dropped": dropped}), 200
+
+
+# streams the songs in (start, end] as NDJSON, a missing start means the whole ring
+@app.route('/transfer_range', methods=['GET'])
+def transfer_range():
+    end = request.args.get('end')
+    if not end:
+        return jsonify({"error": "No end of range can not proceed... "}), 400
+    start = request.args.get('start')
+    start = keyspace.from_hex(start) if start else None  # no start means the whole ring
+    limit = request.args.get('limit', type=int)  # only the first limit songs of the range (query * pages)
+    return Response(stream_with_context(handoff.stream_range(node, start, keyspace.from_hex(end), limit)), mimetype='application/x-ndjson')
+
+
+# drops the songs in (start, end], the range that slid out of this node's replica window
+@app.route('/drop_range', methods=['POST'])
+def drop_range():
     data = request.get_json()
-    if not data or "song_name" not in data or "value" not in data or "k" not in data:
-        return jsonify({"error": "Invalid replication packet data"}), 400
-    
-    song_name = data["song_name"]
-    value = data["value"]
-    counter = data["k"]
-    
-    print(f"Received replication packet for '{song_name}' with k = {counter} at node {node.get_ip()}:{node.get_port()}")
-     
-    # check if we are the primary node for this song
-    song_key = utils.hash_function(song_name)
-    current_id = node.get_identifier()
-    predecessor = node.get_predecessor()
-    
-    if not belongs_to_me(song_key, current_id, utils.hash_function(f"{predecessor[0]}:{predecessor[1]}")):
-        # this node is not the primary for the song , forward the packet to our successor
-        successor = node.get_successor()
-        if not successor or successor == []:
-            print("No valid successor found, replication aborted.")
-            return jsonify({"message": "Replication aborted (no successor)"}), 200
-        else:
-            replication_url = f"http://{successor[0]}:{successor[1]}/find_primary"
-            try:
-                print(f"Forwarding replication packet for '{song_name}' (not primary here) to node {successor[0]}:{successor[1]}.")
-                response = requests.post(replication_url, json=data)
-                response.raise_for_status()
-                return jsonify({
-                    "message": f"Forwarded replication packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                    "next_response": response.json()
-                }), 200
-            except requests.RequestException as e:
-                return jsonify({"error": f"Failed to forward replication packet to node {successor}: {str(e)}"}), 500
-    
-    else:
-        # This node is the primary node for the song, now we send the packet the next k-1 nodes and replicate it , and after the k-1 nodes we delete it from the list of the node that gets the request if exists till we get to the primary node of the key again
-            new_counter = counter - 1
-            new_packet = {"song_name": song_name, "value": value, "k": new_counter}
-            successor = node.get_successor()
-            if not successor or successor == []:
-                print("No valid successor found, replication stops here.")
-                return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-            replication_url = f"http://{successor[0]}:{successor[1]}/start_replication"
-            try:
-                print(f"Primary node starting the replication process for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-                response = requests.post(replication_url, json=new_packet)
-                response.raise_for_status()
-                return jsonify({
-                    "message": f"Forwarded replication packet for '{song_name}' from primary node to {successor[0]}:{successor[1]}",
-                    "next_response": response.json()
-                }), 200
-            except requests.RequestException as e:
-                return jsonify({"error": f"Primary node failed to forward replication packet: {str(e)}"}), 500
- 
-            
-# last step of the replication process, we copy to the next k-1 nodes the song and its value and the counter, and if the counter is 0 we delete it from the list of the node that gets the request, all of these till we reach again the primary node of the key    
-@app.route('/start_replication', methods=['POST'])
-def start_replication():
-    data = request.get_json()
-    if not data or "song_name" not in data or "value" not in data or "k" not in data:
-        return jsonify({"error": "Invalid replication packet data"}), 400
-    
-    song_name = data["song_name"]
-    value = data["value"]
-    counter = data["k"]
-    print(f"Received replication packet for '{song_name}' with k = {counter} at node {node.get_ip()}:{node.get_port()}")
-    
-    #check if we are the primary node for this song, if we are then we stop the recursion and return
-    song_key = utils.hash_function(song_name)
-    current_id = node.get_identifier()
-    predecessor = node.get_predecessor()
-    
-    print(f"I am {node.get_port()}")
-    
-    # base case of our recursion, we are the primary node for the song (the node the requests started from)
-    if belongs_to_me(song_key, current_id, utils.hash_function(f"{predecessor[0]}:{predecessor[1]}")):
-        print(f"Primary node reached for '{song_name}', stopping replication.")
-        return jsonify({"message": f"Primary node reached again for '{song_name}',replication has been finished"}), 200
-    
-    
-    # we are not responsible for the song, so we delete it and forward the packet to our successor
-    if counter <= 0:
-        print(f'counter is {counter} , deleting song {song_name} from node {node.get_ip()}:{node.get_port()}')
-        node.delete(song_name)
-        print(f"Song '{song_name}' deleted from node {node.get_ip()}:{node.get_port()} (k = 0), so we are not responsible for it")
-        new_counter = counter - 1
-        new_packet = {"song_name": song_name, "value": value, "k": new_counter}
-        successor = node.get_successor()
-        if not successor or successor == []:
-            print("No valid successor found, replication stops here.")
-            return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-        replication_url = f"http://{successor[0]}:{successor[1]}/start_replication"
-        try:
-            print(f"Node {node.get_ip()}:{node.get_port()} forwarding replication packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-            response = requests.post(replication_url, json=new_packet)
-            response.raise_for_status()
-            return jsonify({
-                "message": f"Forwarded replication packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                "next_response": response.json()
-            }), 200
-        except requests.RequestException as e:
-            return jsonify({"error": f"Failed to forward replication packet to node {successor}: {str(e)}"}), 500
-    
-    # we are responsible for the song, so we insert it and forward the packet to our successor
-    else:
-        if node.query(song_name) is not None:
-            print(f"Song '{song_name}' already exists in this node, updating value.")
-            node.get_song_list()[song_name] = value # we want all the responsible nodes to have the same value for the same song
-        
-        else: # song does not exist in this node, so we can simply insert it
-            node.insert(song_name, value)
-        
-        new_counter = counter - 1
-        new_packet = {"song_name": song_name, "value": value, "k": new_counter}
-        successor = node.get_successor()
-        if not successor or successor == []:
-            print("No valid successor found, replication stops here.")
-            return jsonify({"message": "Replication ended at this node (no successor)"}), 200
-        replication_url = f"http://{successor[0]}:{successor[1]}/start_replication"
-        try:
-            print(f"Node {node.get_ip()}:{node.get_port()} forwarding replication packet for '{song_name}' with new k = {new_counter} to node {successor[0]}:{successor[1]}.")
-            response = requests.post(replication_url, json=new_packet)
-            response.raise_for_status()
-            return jsonify({
-                "message": f"Forwarded replication packet for '{song_name}' to node {successor[0]}:{successor[1]}",
-                "next_response": response.json()
-            }), 200
-        except requests.RequestException as e:
-            return jsonify({"error": f"Failed to forward replication packet to node {successor}: {str(e)}"}), 500
-        
-
-# returns the songs that are supposed to be in the node that hit the request but are in the node that got the request
-@app.route('/replicate', methods=['GET'])
-def replicate():
-    # Get the songs that are supposed to be in the predecessor node
-    songs = node.get_song_list()
-    songs_to_replicate = {}
-    pred_param = request.args.get('pred', '')
-    pred_of_pred = [] 
-    if pred_param:
-        pred_list = pred_param.split(',')
-        pred_of_pred = pred_list
-    else:
-        return jsonify({"error": "No predecessor can not proceed... "}), 400
-    
-    if pred_of_pred == None or pred_of_pred == []:
-        return jsonify({"error": "No predecessor of predecessor can not proceed... "}), 400
-    pred = node.get_predecessor()
-    for song in songs:
-        song_key = utils.hash_function(song)
-        if belongs_to_me(song_key,utils.hash_function(f"{pred[0]}:{pred[1]}") , utils.hash_function(f"{pred_of_pred[0]}:{pred_of_pred[1]}")):
-            songs_to_replicate[song] = songs[song]
-    return jsonify({"songs_that_belong_to_me": songs_to_replicate}), 200
+    if not data or not data.get("start") or not data.get("end"):
+        return jsonify({"error": "Invalid range"}), 400
+    dropped = handoff.drop_range(node, keyspace.from_hex(data["start"]), keyspace.from_hex(data["end"]))
+    return jsonify({"message": f"Dropped {dropped} songs", "dropped": dropped}), 200
 
 
 @app.route('/update_predecessor', methods=['POST'])
@@ -993,13 +791,45 @@ def update_successor():
     node.set_successor([succ_ip, succ_port])
     return jsonify({"message": "Successor updated"}), 200
 
+@app.route('/find_successor/<string:key>', methods=['GET'])
+def find_successor(key: str):
+    if not node.get_successor():
+        return jsonify({"error": "Node is not part of the ring"}), 410
+    identifier = keyspace.from_hex(key)
+    if iterative_lookup():
+        # answer with the owner if it is this node or its successor, otherwise with the closest preceding finger
+        owner = chord.owner_if_known(node, identifier)
+        if owner:
+            return jsonify({"node": owner}), 200
+        return jsonify({"next_hop": chord.next_hop(node, identifier)}), 200
+    try:
+        return jsonify({"node": chord.find_successor(node, identifier)}), 200
+    except requests.RequestException as e:
+        return jsonify({"error": f"Failed to find the successor of {key}: {str(e)}"}), 500
+
+
+@app.route('/predecessor', methods=['GET'])
+def predecessor_pointer():
+    return jsonify({"predecessor": node.get_predecessor()}), 200
+
+
+@app.route('/notify', methods=['POST'])
+def notify():
+    requests_data = request.get_json()
+    candidate_ip = requests_data.get("ip")
+    candidate_port = requests_data.get("port")
+    if not candidate_ip or not candidate_port:
+        return jsonify({"error": "Not sufficient amount of data to notify"}), 400
+    updated = chord.notify(node, [candidate_ip, candidate_port])
+    return jsonify({"message": "Predecessor updated" if updated else "Predecessor unchanged"}), 200
+
 @app.route('/pred_suc', methods=['POST'])
 def pred_suc():
     pred = node.get_predecessor()
     suc = node.get_successor()
     if pred != [] and suc != []:
-        return jsonify({"predecessor key": utils.hash_function(f'{pred[0]}:{pred[1]}'), 
-                    "successor key": utils.hash_function(f'{suc[0]}:{suc[1]}'),
+        return jsonify({"predecessor key": keyspace.to_hex(node.get_predecessor_key()), 
+                    "successor key": keyspace.to_hex(node.get_successor_key()),
                         "pred":pred, "suc":suc , "current_key":node.get_identifier()}), 200
     else:
         return jsonify({"pred": pred, "suc":suc}), 404
@@ -1023,21 +853,22 @@ def overlay():
     # start the overlay list with current node info
     overlay_list = [{
         "ip": node.get_ip(),
-        "port": node.get_port()
+        "port": node.get_port(),
+        "key": node.get_identifier()
     }]
     
     # get the successor pointer
     successor = node.get_successor()
     
     if not successor or successor == []:
-        return jsonify({"overlay": overlay_list}), 200
+        return jsonify({"overlay": overlay_list, "k": ring_view.k, "consistency": ring_view.consistency}), 200
     
     # prepare the query parameter for visited nodes
     params = {'visited': ','.join(visited_set)}
     successor_url = f"http://{successor[0]}:{successor[1]}/overlay"
     
     try:
-        response = requests.get(successor_url, params=params)
+        response = http_pool.get(successor_url, params=params)
         response.raise_for_status()
         # merge overlay info from successor with current node's info
         successor_overlay = response.json().get("overlay", [])
@@ -1045,87 +876,104 @@ def overlay():
     except requests.RequestException as e:
         return jsonify({"error": f"Failed to forward overlay request to node {successor[0]}:{successor[1]}: {str(e)}"}), 500
     
-    return jsonify({"overlay": overlay_list}), 200
+    return jsonify({"overlay": overlay_list, "k": ring_view.k, "consistency": ring_view.consistency}), 200
 
 
 @app.route('/get_nodes', methods=['GET'])
 def get_nodes():
-  if node.get_identifier() == utils.hash_function(f"{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}"):
-    return jsonify({"number_of_nodes": number_of_nodes}), 200
-  else:
-      try:
-         data =  requests.get(f"http://{os.getenv('BOOTSTRAP_IP')}:{os.getenv('BOOTSTRAP_PORT')}/get_nodes")
-      except requests.RequestException as e:
-          return jsonify({"error": f"Failed to get nodes from bootstrap node: {str(e)}"}), 500
-      
-      num_of_nodes = data.json().get("number_of_nodes", 0)
-      return jsonify({"number_of_nodes": number_of_nodes}), 200
+    return jsonify({"number_of_nodes": number_of_nodes, "epoch": ring_view.epoch}), 200
+
+
+@app.route('/ring', methods=['GET'])
+def ring():
+    # all the nodes of the ring sorted by key
+    return jsonify({"ring": [[n["ip"], n["port"]] for n in network_nodes]}), 200
+
+
+def publish_membership():
+    # new epoch of the membership view, pushed to every node except the bootstrap; nodes still joining are left out and
+    # reads keep the old k while a larger one is being filled in
+    view = ring_view.advance([[n["ip"], n["port"]] for n in network_nodes if n["key"] not in pending_joins],
+                             read_k=None if pending_resizes else ring_view.k)
+    membership.push(view, exclude=[[os.getenv("BOOTSTRAP_IP"), os.getenv("BOOTSTRAP_PORT")]])
+    return view
+
+
+@app.route('/membership', methods=['GET'])
+def membership_view():
+    return jsonify(ring_view.snapshot()), 200
+
+
+# replication factor and consistency model of the cluster, a change is pushed to every node with a new epoch
+@app.route('/config', methods=['GET', 'POST'])
+def config():
+    if request.method == 'GET':
+        view = ring_view.snapshot()
+        return jsonify({"epoch": view["epoch"], "k": view["k"], "consistency": view["consistency"]}), 200
+    data = request.get_json(silent=True) or {}
+    new_k = data.get("k", ring_view.k)
+    new_consistency = data.get("consistency", ring_view.consistency)
+    if not isinstance(new_k, int) or isinstance(new_k, bool) or new_k < 1:
+        return jsonify({"error": "k has to be a positive integer"}), 400
+    if new_consistency not in membership.CONSISTENCY_MODELS:
+        return jsonify({"error": f"Unknown consistency model '{new_consistency}', expected one of {list(membership.CONSISTENCY_MODELS)}"}), 400
+    old_k = ring_view.k
+    pending_resizes.clear()
+    if new_k > ring_view.read_k:
+        pending_resizes.update(n["key"] for n in network_nodes if n["key"] not in pending_joins)
+    view = ring_view.advance(k=new_k, consistency=new_consistency)
+    membership.push(view, exclude=[[os.getenv("BOOTSTRAP_IP"), os.getenv("BOOTSTRAP_PORT")]])
+    if new_k != old_k:
+        threading.Thread(target=resize_window, args=(view["ring"], old_k, new_k), daemon=True).start()
+    logger.info("Cluster settings changed to k=%s, %s at epoch %s", new_k, new_consistency, view["epoch"])
+    return jsonify({"epoch": view["epoch"], "k": new_k, "consistency": new_consistency}), 200
 
 
 @app.route('/decrease_num_of_nodes', methods=['POST'])
 def decrease_num_of_nodes():
     global number_of_nodes
     number_of_nodes -= 1
+    # forget the departed node so that later joins compute their replica windows on the current ring
+    departed = request.get_json(silent=True) or {}
+    if departed.get("ip") and departed.get("port"):
+        departed_key = utils.hash_function(f"{departed['ip']}:{departed['port']}")
+        network_nodes[:] = [n for n in network_nodes if n["key"] != departed_key]
+        pending_joins.discard(departed_key)
+        pending_resizes.discard(departed_key)
+    publish_membership()
     return jsonify({"message": "Number of nodes decreased"}), 200
 
 @app.route('/give_songs', methods=['POST'])
 def give_songs():
-    # Get the songs that are supposed to be in the predecessor node
+    # Songs handed over by a departing node, one chunk at a time
     data = request.get_json()
     if data == None or data == {}:
-        return jsonify({"error": "No songs to give"}), 400
+        return jsonify({"message": "No songs to give"}), 200
+    if "transfer_id" in data:
+        if not handoff.receive_chunk(node, data):
+            # back-pressure: the departing node retries this chunk later
+            response = jsonify({"error": "Busy applying other chunks"})
+            response.status_code = 429
+            response.headers["Retry-After"] = "0.05"
+            return response
+        return jsonify({"message": "Chunk applied", "ack": data.get("seq")}), 200
     for song in data:
         node.set_song_to_song_list(song, data[song])
     return jsonify({"message": "Songs given successfully"}), 200
 
-@app.route('/same_image', methods=['POST'])
-def same_image():
-     # Get the song list from the request payload.
-    song_list = request.get_json()
-    if song_list is None:
-        return jsonify({"error": "No song list provided"}), 400
-
-    # Update local song list.
-    node.set_song_list(song_list)
-    print(f"Node {node.get_ip()}:{node.get_port()} updated song list to: {node.get_song_list()}")
-
-    # Get visited nodes from query parameters to avoid cycles.
-    visited_param = request.args.get('visited', '')
-    visited = set(visited_param.split(',')) if visited_param else set()
-
-    current_node = f"{node.get_ip()}:{node.get_port()}"
-    if current_node in visited:
-        # Cycle complete; return the updated song list.
-        print(f"Cycle complete at node {current_node}.")
-        return jsonify({"message": "Same image cycle complete", "song_list": node.get_song_list()}), 200
-
-    # Add current node to visited set.
-    visited.add(current_node)
-    # If there is a valid successor, forward the same image packet.
-    successor = node.get_successor()
-    if not successor or successor == []:
-        print("No valid successor found; same image propagation ends here.")
-        return jsonify({"message": "No successor to propagate same image", "song_list": node.get_song_list()}), 200
-
-    same_image_url = f"http://{successor[0]}:{successor[1]}/same_image?visited={','.join(visited)}"
-    try:
-        print(f"Forwarding same image from node {current_node} to successor {successor[0]}:{successor[1]}")
-        response = requests.post(same_image_url, json=song_list)
-        response.raise_for_status()
-        return jsonify({"message": "Propagated same image", "next_response": response.json()}), 200
-    except requests.RequestException as e:
-        return jsonify({"error": f"Failed to forward same image to node {successor}: {str(e)}"}), 500
-    
-    
-
 # for testing purposes
 @app.route('/show_song_list', methods=['GET'])
 def show_song_list():
-    return jsonify(node.get_song_list()), 200
+    # serialized by the store itself, the compact engine writes it straight from its buffers
+    return Response(node.get_song_list().dump_json(), mimetype='application/json'), 200
                    
 if __name__ == '__main__':
-    print(f"Starting Flask for Bootstrap on port: 5000")
+    logger.info("Starting Flask for Bootstrap on port: 5000")
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
 
     node = BootstrapNode(None, None, port)
-    app.run(host="0.0.0.0", port=port, debug=True)
+    ring_view.advance([[n["ip"], n["port"]] for n in network_nodes])
+    replication = ReplicationQueue(node)
+    pipeline = ChainPipeline(node)
+    chord.start_maintenance(node)
+    serving.run(app, port)
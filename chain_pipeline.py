@@ -0,0 +1,218 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+import craq
+import http_pool
+import log
+import metrics
+
+"""
+Pipelined chain replication.
+
+The primary of a key is the head of its chain and numbers every write with the next sequence number of its chain.
+Writes are applied and numbered in one step, so the chain sees them in the order the head applied them. Instead of
+one blocking request per hop, every node keeps one outbox towards its successor: a sender thread ships what has piled
+up as one /chain_append packet, and the receiving node applies the updates in order, puts them in its own outbox and
+answers right away. Many writes of one chain are thus in flight at once and no handler thread waits on the rest of
+the chain.
+
+The tail applies an update and acknowledges it back up the chain with a cumulative /chain_ack (chain -> highest
+sequence number committed), again batched by a sender thread. Every node on the way cleans the keys the
+acknowledged writes left dirty (see craq.py) and passes the ack on; the head releases the client requests that
+wait for it.
+
+A packet that failed is sent again; a node applies an update only if its sequence number is not below the last one
+it applied for that chain, so a resent packet does no harm. A client write that got no ack within CHAIN_ACK_TIMEOUT
+is answered with an error, its keys stay dirty until a later ack cleans them.
+"""
+
+BATCH_SIZE = int(os.getenv("CHAIN_BATCH_SIZE", "500"))  # updates per /chain_append packet
+ACK_TIMEOUT = float(os.getenv("CHAIN_ACK_TIMEOUT", "30"))  # seconds a client write waits for the tail's ack
+RETRY_DELAY = float(os.getenv("CHAIN_RETRY_DELAY", "0.1"))  # seconds before a failed packet is sent again
+
+logger = log.get_logger("chain_pipeline")
+
+
+class ChainPipeline:
+    def __init__(self, node, batch_size=BATCH_SIZE):
+        self.node = node
+        # the chain this node is the head of; a restarted node starts a new one, so its sequence numbers start over
+        self.chain = f"{node.get_ip()}:{node.get_port()}@{time.time_ns()}"
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._outbox = deque()  # [chain, seq, op, song_name, value, k] to ship to the successor, in order
+        self._outbox_ready = threading.Condition(self._lock)
+        self._acks = {}  # chain -> highest committed seq, to ship to the predecessor
+        self._acks_ready = threading.Condition(self._lock)
+        self._next_seq = 0
+        self._waiting = {}  # seq of this node's chain -> (event, started) of the client request waiting for it
+        self._applied = {}  # chain -> last seq applied here
+        self._acked = {}  # chain -> last seq acknowledged here
+        self._dirty = {}  # chain -> OrderedDict seq -> [(song_names, craq version)] not acknowledged yet
+        self.shipped = 0
+        self.committed = 0
+        self.timed_out = 0
+        threading.Thread(target=self._send_updates, daemon=True).start()
+        threading.Thread(target=self._send_acks, daemon=True).start()
+
+    def write(self, op, song_names, apply, k):
+        """
+        Head side of a write of op ("insert" or "delete") to song_names. apply() changes the local store and returns
+        the songs that changed; they are numbered, queued for the next k nodes and the call waits for the tail's ack.
+        The store's log is synced after the lock is released, so concurrent writes share one fsync.
+        Returns (songs that changed, True if the tail acknowledged them within ACK_TIMEOUT).
+        """
+        songs = self.node.get_song_list()
+        songs.defer_sync()
+        try:
+            with self._lock:
+                version = craq.begin_write(song_names)
+                changed = list(apply())
+                if not changed or k <= 0 or not self.node.get_successor():
+                    craq.acknowledge(song_names, version)
+                    return changed, True
+                self._next_seq += 1
+                seq = self._next_seq
+                event = threading.Event()
+                self._waiting[seq] = (event, time.perf_counter())
+                self._applied[self.chain] = seq
+                self._dirty.setdefault(self.chain, OrderedDict())[seq] = [(song_names, version)]
+                for song_name in changed:
+                    self._outbox.append([self.chain, seq, op, song_name, songs.get(song_name) if op == "insert" else None, k])
+                self._outbox_ready.notify()
+        finally:
+            songs.sync()
+        if event.wait(ACK_TIMEOUT):
+            return changed, True
+        with self._lock:
+            self._waiting.pop(seq, None)
+            self.timed_out += 1
+        return changed, False
+
+    def append(self, updates):
+        # a /chain_append packet from the predecessor: apply in order, pass on down the chain or, at the tail, ack
+        committed = {}
+        songs = self.node.get_song_list()
+        songs.defer_sync()
+        try:
+            with self._lock:
+                is_tail_here = not self.node.get_successor()
+                for chain, seq, op, song_name, value, k in updates:
+                    if chain == self.chain:
+                        # a chain longer than the ring came back around to its head, which is also its tail: the ack
+                        # still goes back through the nodes in between, it ends here when it comes around again
+                        committed[chain] = seq
+                        self._acks[chain] = max(seq, self._acks.get(chain, 0))
+                        self._acks_ready.notify()
+                        continue
+                    if k <= 0 or seq < self._applied.get(chain, 0):
+                        continue  # resent packet, a newer write of the chain was applied already
+                    self._applied[chain] = seq
+                    tail = k == 1 or is_tail_here
+                    if not tail:
+                        version = craq.begin_write([song_name])
+                        self._dirty.setdefault(chain, OrderedDict()).setdefault(seq, []).append(([song_name], version))
+                    if op == "insert":
+                        self.node.set_song_to_song_list(song_name, value)
+                    else:
+                        self.node.delete(song_name)
+                    if tail:
+                        committed[chain] = seq
+                    else:
+                        self._outbox.append([chain, seq, op, song_name, value, k - 1])
+                self._outbox_ready.notify()
+        finally:
+            songs.sync()  # the tail acks only what is on its disk
+        if committed:
+            self.ack(committed)
+
+    def ack(self, acks):
+        # cumulative acks chain -> seq, from the successor or from this node as the tail
+        with self._lock:
+            for chain, seq in acks.items():
+                if seq <= self._acked.get(chain, 0):
+                    continue
+                self._acked[chain] = seq
+                dirty = self._dirty.get(chain, {})
+                while dirty and next(iter(dirty)) <= seq:
+                    for song_names, version in dirty.popitem(last=False)[1]:
+                        craq.acknowledge(song_names, version)
+                if chain == self.chain:
+                    self._release(seq)
+                elif chain.partition("@")[0] != self.chain.partition("@")[0]:
+                    # pass it on towards the head, also through a node that never saw the chain (it joined between
+                    # head and tail); it ends at the head, at an earlier run of the head's address or, when the head
+                    # is gone, after one lap at a node that acked it already
+                    self._acks[chain] = max(seq, self._acks.get(chain, 0))
+                    self._acks_ready.notify()
+
+    def _release(self, seq):
+        now = time.perf_counter()
+        for waiting_seq in [waiting_seq for waiting_seq in self._waiting if waiting_seq <= seq]:
+            event, started = self._waiting.pop(waiting_seq)
+            metrics.REPLICATION_LAG.observe(now - started, "chain replication")
+            self.committed += 1
+            event.set()
+
+    def _send_updates(self):
+        while True:
+            with self._lock:
+                while not self._outbox:
+                    self._outbox_ready.wait()
+                packet = [self._outbox[index] for index in range(min(self.batch_size, len(self._outbox)))]
+            successor = self.node.get_successor()
+            try:
+                if successor:
+                    response = http_pool.post(f"http://{successor[0]}:{successor[1]}/chain_append", json={"updates": packet})
+                    response.raise_for_status()
+                else:
+                    self.append([update[:5] + [1] for update in packet])  # the ring shrank to this node, it is the tail
+            except requests.RequestException as e:
+                logger.warning("Chain replication packet to %s:%s failed, resending: %s", successor[0], successor[1], str(e))
+                time.sleep(RETRY_DELAY)
+                continue
+            except Exception:
+                # anything else must not end the sender thread either, the packet stays in the outbox
+                logger.exception("Chain replication packet of %s updates failed, resending", len(packet))
+                time.sleep(RETRY_DELAY)
+                continue
+            with self._lock:
+                for _ in packet:
+                    self._outbox.popleft()  # only removed once delivered, so updates never overtake each other
+                self.shipped += len(packet)
+
+    def _send_acks(self):
+        while True:
+            with self._lock:
+                while not self._acks:
+                    self._acks_ready.wait()
+                acks, self._acks = self._acks, {}
+            predecessor = self.node.get_predecessor()
+            if not predecessor:
+                continue
+            try:
+                response = http_pool.post(f"http://{predecessor[0]}:{predecessor[1]}/chain_ack", json={"acks": acks})
+                response.raise_for_status()
+                continue
+            except requests.RequestException as e:
+                logger.warning("Chain ack to %s:%s failed, resending: %s", predecessor[0], predecessor[1], str(e))
+            except Exception:
+                logger.exception("Chain ack to %s:%s failed, resending", predecessor[0], predecessor[1])
+            time.sleep(RETRY_DELAY)
+            with self._lock:
+                for chain, seq in acks.items():
+                    self._acks[chain] = max(seq, self._acks.get(chain, 0))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "outbox": len(self._outbox),
+                "waiting": len(self._waiting),
+                "shipped": self.shipped,
+                "committed": self.committed,
+                "timed_out": self.timed_out,
+            }
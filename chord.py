@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+
+import requests
+
+import http_pool
+import keyspace
+import log
+from keyspace import address_id, between, between_right_inclusive, finger_start
+
+"""
+Chord finger table maintenance and routing, shared by the bootstrap and the regular nodes.
+
+finger[i] of a node n is the node responsible for (n + 2^i) mod 2^M, so forwarding a request to the
+closest preceding finger halves the distance to the key at every hop and a lookup costs O(log N) hops
+instead of walking the ring one successor at a time.
+"""
+
+M = keyspace.BITS
+
+logger = log.get_logger("chord")
+trace = log.get_tracer("chord")
+
+FIX_FINGERS_INTERVAL = float(os.getenv("FIX_FINGERS_INTERVAL", "2.0"))  # seconds between stabilize/fix-fingers rounds
+
+
+def is_responsible(node, key):
+    # True when the key falls in (predecessor, node], a node without predecessor or successor owns the whole ring
+    predecessor_key = node.get_predecessor_key()
+    if predecessor_key is None or not node.get_successor():
+        return True
+    return between_right_inclusive(key, predecessor_key, node.get_key())
+
+
+def closest_preceding_finger(node, key):
+    # scan the fingers from the farthest one backwards and return the first that precedes the key
+    current_id = node.get_key()
+    for finger in reversed(node.get_finger_table()):
+        if finger and between(finger[0], current_id, key):
+            return finger[1]
+    return None
+
+
+def next_hop(node, key):
+    """
+    Returns the [ip, port] a request for the key should be forwarded to when this node is not responsible for it:
+    the successor if the key falls in (current, successor], otherwise the closest preceding finger.
+    """
+    successor = node.get_successor()
+    if not successor or successor == []:
+        return []
+    if between_right_inclusive(key, node.get_key(), node.get_successor_key()):
+        return successor
+    return closest_preceding_finger(node, key) or successor
+
+
+def forward(node, key, method, path, **kwargs):
+    """
+    Sends the request for the key to the next hop. The request is marked as routed, so a node that has
+    departed but is still reachable through a stale finger answers 410 instead of acting as a lone ring;
+    in that case (or if the finger is down) the finger is dropped and the request goes to the successor.
+    """
+    return forward_to(node, next_hop(node, key), method, path, **kwargs)
+
+
+def forward_to(node, hop, method, path, **kwargs):
+    successor = node.get_successor()
+    params = dict(kwargs.pop("params", {}), routed="1")
+    try:
+        response = http_pool.request(method, f"http://{hop[0]}:{hop[1]}{path}", params=params, **kwargs)
+        if response.status_code != 410 or hop == successor:
+            return response
+    except requests.RequestException:
+        if hop == successor:
+            raise
+    trace.debug("Finger %s:%s is stale, forwarding to successor %s:%s instead", hop[0], hop[1], successor[0], successor[1])
+    node.set_finger_table([finger for finger in node.get_finger_table() if finger[1] != hop])
+    return http_pool.request(method, f"http://{successor[0]}:{successor[1]}{path}", params=params, **kwargs)
+
+
+def owner_if_known(node, key):
+    # the node responsible for the key if it is this node or its successor, None if the lookup has to go on
+    me = [node.get_ip(), node.get_port()]
+    predecessor = node.get_predecessor()
+    successor = node.get_successor()
+    if not predecessor or not successor:
+        return me
+    if between_right_inclusive(key, node.get_predecessor_key(), node.get_key()):
+        return me
+    if between_right_inclusive(key, node.get_key(), node.get_successor_key()):
+        return successor
+    return None
+
+
+def find_successor(node, key):
+    # returns the [ip, port] of the node responsible for the key
+    owner = owner_if_known(node, key)
+    if owner:
+        return owner
+    successor = node.get_successor()
+
+    hop = closest_preceding_finger(node, key) or successor
+    try:
+        response = http_pool.get(f"http://{hop[0]}:{hop[1]}/find_successor/{keyspace.to_hex(key)}")
+        response.raise_for_status()
+        return response.json()["node"]
+    except requests.RequestException as e:
+        if hop == successor:
+            raise
+        # the finger is stale (the node departed), fall back to the successor and let the next round repair it
+        logger.warning("Finger %s:%s unreachable (%s), falling back to successor", hop[0], hop[1], str(e))
+        response = http_pool.get(f"http://{successor[0]}:{successor[1]}/find_successor/{keyspace.to_hex(key)}")
+        response.raise_for_status()
+        return response.json()["node"]
+
+
+def stabilize(node):
+    # ask the successor for its predecessor and adopt it if it sits between us, then notify the successor about us
+    successor = node.get_successor()
+    if not successor or successor == []:
+        return
+    response = http_pool.get(f"http://{successor[0]}:{successor[1]}/predecessor")
+    response.raise_for_status()
+    candidate = response.json().get("predecessor")
+    if candidate and between(address_id(candidate), node.get_key(), node.get_successor_key()):
+        node.set_successor(candidate)
+        successor = candidate
+    http_pool.post(f"http://{successor[0]}:{successor[1]}/notify", json={"ip": node.get_ip(), "port": node.get_port()})
+
+
+def notify(node, candidate):
+    # candidate thinks it might be our predecessor
+    predecessor = node.get_predecessor()
+    if not predecessor or predecessor == []:
+        return False
+    if between(address_id(candidate), node.get_predecessor_key(), node.get_key()):
+        node.set_predecessor(candidate)
+        return True
+    return False
+
+
+def fix_fingers(node):
+    """
+    Rebuilds the whole finger table. Consecutive fingers usually point to the same node, so a remote lookup
+    is only made when the start of a finger lies past the node found for the previous one, which keeps
+    a full refresh at about log N lookups.
+    """
+    successor = node.get_successor()
+    if not successor or successor == []:
+        node.set_finger_table([])
+        return
+    current_id = node.get_key()
+    fingers = []
+    previous = None
+    for i in range(M):
+        start = finger_start(current_id, i)
+        if previous and previous[0] != current_id and between_right_inclusive(start, current_id, previous[0]):
+            fingers.append(previous)
+            continue
+        address = find_successor(node, start)
+        previous = (address_id(address), address)
+        fingers.append(previous)
+    node.set_finger_table(fingers)
+
+
+def maintenance_loop(node, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            stabilize(node)
+            fix_fingers(node)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logger.warning("Finger maintenance round failed: %s", str(e))
+
+
+def start_maintenance(node, interval=FIX_FINGERS_INTERVAL):
+    thread = threading.Thread(target=maintenance_loop, args=(node, interval), daemon=True)
+    thread.start()
+    return thread
@@ -1,9 +1,13 @@
 import requests
 import sys
+from dht_client import DHTClient
 
 # Use the bootstrap node as the default entry point:
 BASE_URL = "http://10.0.17.96:5000"
 
+# When set, insert/delete/query go straight to the node that owns the key (see dht_client.py)
+smart_client = None
+
 node_mapping = {
     1: ('10.0.17.96', 5000),
     2: ('10.0.17.245', 5001),
@@ -26,6 +30,7 @@ def print_help():
     print("  overlay               - Display the network overlay (Chord ring topology).")
     print("  setnode <node id>     - Set the target node (from available mapping) to hit.")
     print("  listnodes             - List all available node mappings.")
+    print("  smart <on|off>        - Send requests straight to the owner of the key using a cached ring.")
     print("  help                  - Show this help message.")
     print("  exit                  - Exit the CLI.")
 
@@ -47,10 +52,24 @@ def setnode_command(node_id_str):
     except ValueError:
         print("Please provide a valid node id (an integer).")
 
+def smart_command(state):
+    global smart_client
+    if state == "on":
+        try:
+            smart_client = DHTClient(BASE_URL)
+            smart_client.refresh()
+            print(f"Smart routing enabled ({len(smart_client.get_ring())} nodes, k = {smart_client.k}, {smart_client.consistency})")
+        except Exception as e:
+            smart_client = None
+            print(f"Error fetching the ring: {e}")
+    else:
+        smart_client = None
+        print("Smart routing disabled")
+
 def insert_command(key, value):
     url = f"{BASE_URL}/insert/{key}/{value}"
     try:
-        response = requests.post(url)
+        response = smart_client.insert(key, value) if smart_client else requests.post(url)
         print(response.json())
     except Exception as e:
         print(f"Error during insert: {e}")
@@ -58,7 +77,7 @@ def insert_command(key, value):
 def delete_command(key):
     url = f"{BASE_URL}/delete/{key}"
     try:
-        response = requests.delete(url)
+        response = smart_client.delete(key) if smart_client else requests.delete(url)
         print(response.json())
     except Exception as e:
         print(f"Error during delete: {e}")
@@ -66,7 +85,7 @@ def delete_command(key):
 def query_command(key):
     url = f"{BASE_URL}/query/{key}"
     try:
-        response = requests.get(url)
+        response = smart_client.query(key) if smart_client else requests.get(url)
         print(response.json())
     except Exception as e:
         print(f"Error during query: {e}")
@@ -125,6 +144,11 @@ def main():
                 print("Usage: setnode <node id>")
                 continue
             setnode_command(tokens[1])
+        elif command == "smart":
+            if len(tokens) != 2 or tokens[1].lower() not in ("on", "off"):
+                print("Usage: smart <on|off>")
+                continue
+            smart_command(tokens[1].lower())
         elif command == "listnodes":
             list_nodes()
         elif command == "help":
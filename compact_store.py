@@ -0,0 +1,270 @@
+import array
+import hashlib
+import json
+import re
+import threading
+
+import keyspace
+from storage import SongStore
+
+"""
+Compact in-memory song storage (STORAGE_ENGINE=compact) for nodes that hold tens of millions of songs.
+
+MemoryStore pays for a dict slot, a str and a boxed int per song plus a tuple in the position index, a few hundred
+bytes in total. CompactStore keeps the same data in flat buffers, about 60 bytes per song for short names:
+
+    arena        song names as UTF-8, back to back (bytearray)
+    slots        per song: name offset and length in the arena, 64-bit value, 20 byte ring position (packed arrays)
+    table        open addressing hash table (linear probing) from the low bits of the ring position to the slot
+    buckets      the ring cut into 2^bits buckets by the high bits of the position, each an array of slots
+
+Ring ranges are served from the buckets: the buckets inside the range are taken whole and only the two at its edges
+are filtered, so a range costs time proportional to the songs in it. Values that are not 64-bit integers are kept
+in a side dict. /transfer_range and /show_song_list are serialized straight from the buffers.
+"""
+
+INITIAL_CAPACITY = 1024  # hash table entries, always a power of two
+MAX_LOAD = 0.7  # live and deleted table entries per table entry before the table doubles
+BUCKET_TARGET = 64  # average songs per ring bucket before the number of buckets doubles
+
+_EMPTY = -1
+_DELETED = -2
+_NEEDS_ESCAPE = re.compile(rb'[\x00-\x1f"\\]')
+_INT64 = (-2 ** 63, 2 ** 63)
+
+
+class CompactStore(SongStore):
+    def __init__(self, songs=None):
+        self._lock = threading.RLock()
+        CompactStore.replace(self, songs or {})
+
+    def replace(self, songs):
+        with self._lock:
+            self._arena = bytearray()
+            self._name_offsets = array.array('I')
+            self._name_lengths = array.array('H')
+            self._values = array.array('q')
+            self._positions = bytearray()  # 20 bytes per slot
+            self._objects = {}  # slot -> value that does not fit the value array
+            self._free = array.array('I')  # slots of deleted songs, reused by inserts
+            self._garbage = 0  # arena bytes of deleted songs
+            self._count = 0
+            self._table = array.array('i', [_EMPTY]) * INITIAL_CAPACITY
+            self._used = 0  # table entries that are not empty
+            self._bucket_bits = 4
+            self._buckets = [array.array('I') for _ in range(2 ** self._bucket_bits)]
+            for song_name, value in songs.items():
+                self[song_name] = value
+
+    # slots
+
+    def _name(self, slot):
+        offset = self._name_offsets[slot]
+        return bytes(self._arena[offset:offset + self._name_lengths[slot]])
+
+    def _digest(self, slot):
+        return bytes(self._positions[slot * 20:slot * 20 + 20])
+
+    def _position(self, slot):
+        return int.from_bytes(self._positions[slot * 20:slot * 20 + 20], 'big')
+
+    def _value(self, slot):
+        return self._objects[slot] if slot in self._objects else self._values[slot]
+
+    def _set_value(self, slot, value):
+        if type(value) is int and _INT64[0] <= value < _INT64[1]:
+            self._values[slot] = value
+            self._objects.pop(slot, None)
+        else:
+            self._values[slot] = 0
+            self._objects[slot] = value
+
+    def _bucket(self, digest):
+        return int.from_bytes(digest[:8], 'big') >> (64 - self._bucket_bits)
+
+    def _allocate(self, name, digest, value):
+        if len(name) >= 2 ** 16:
+            raise ValueError("song names are limited to 64 KiB")
+        offset = len(self._arena)
+        self._arena += name
+        if self._free:
+            slot = self._free.pop()
+            self._name_offsets[slot] = offset
+            self._name_lengths[slot] = len(name)
+            self._positions[slot * 20:slot * 20 + 20] = digest
+        else:
+            slot = len(self._values)
+            self._name_offsets.append(offset)
+            self._name_lengths.append(len(name))
+            self._values.append(0)
+            self._positions += digest
+        self._set_value(slot, value)
+        return slot
+
+    # hash table
+
+    def _find(self, name, digest):
+        # (table index, slot), slot -1 when the song is missing and the index is where it would go
+        mask = len(self._table) - 1
+        index = int.from_bytes(digest[12:], 'big') & mask
+        reusable = -1
+        while True:
+            slot = self._table[index]
+            if slot == _EMPTY:
+                return (reusable if reusable >= 0 else index), -1
+            if slot == _DELETED:
+                if reusable < 0:
+                    reusable = index
+            elif self._digest(slot) == digest and self._name(slot) == name:
+                return index, slot
+            index = (index + 1) & mask
+
+    def _live_slots(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def _grow_table(self):
+        size = len(self._table)
+        while self._count >= MAX_LOAD * size / 2:
+            size *= 2
+        self._table = array.array('i', [_EMPTY]) * size
+        mask = size - 1
+        for slot in self._live_slots():
+            index = int.from_bytes(self._positions[slot * 20 + 12:slot * 20 + 20], 'big') & mask
+            while self._table[index] != _EMPTY:
+                index = (index + 1) & mask
+            self._table[index] = slot
+        self._used = self._count
+
+    def _split_buckets(self):
+        self._bucket_bits += 1
+        buckets = [array.array('I') for _ in range(2 ** self._bucket_bits)]
+        for slot in self._live_slots():
+            buckets[self._bucket(self._digest(slot))].append(slot)
+        self._buckets = buckets
+
+    def _compact_arena(self):
+        # copies the names of the live songs into a new arena, dropping the bytes of deleted ones
+        arena = bytearray()
+        for slot in self._live_slots():
+            name = self._name(slot)
+            self._name_offsets[slot] = len(arena)
+            arena += name
+        self._arena = arena
+        self._garbage = 0
+
+    # mapping
+
+    def __getitem__(self, song_name):
+        name = song_name.encode('utf-8')
+        with self._lock:
+            _, slot = self._find(name, hashlib.sha1(name).digest())
+            if slot < 0:
+                raise KeyError(song_name)
+            return self._value(slot)
+
+    def __contains__(self, song_name):
+        name = song_name.encode('utf-8')
+        with self._lock:
+            return self._find(name, hashlib.sha1(name).digest())[1] >= 0
+
+    def __setitem__(self, song_name, value):
+        name = song_name.encode('utf-8')
+        digest = hashlib.sha1(name).digest()
+        with self._lock:
+            index, slot = self._find(name, digest)
+            if slot >= 0:
+                self._set_value(slot, value)
+                return
+            slot = self._allocate(name, digest, value)
+            if self._table[index] == _EMPTY:
+                self._used += 1
+            self._table[index] = slot
+            self._buckets[self._bucket(digest)].append(slot)
+            self._count += 1
+            if self._used > MAX_LOAD * len(self._table):
+                self._grow_table()
+            if self._count > BUCKET_TARGET * len(self._buckets):
+                self._split_buckets()
+
+    def __delitem__(self, song_name):
+        name = song_name.encode('utf-8')
+        digest = hashlib.sha1(name).digest()
+        with self._lock:
+            index, slot = self._find(name, digest)
+            if slot < 0:
+                raise KeyError(song_name)
+            self._remove(index, slot, digest)
+
+    def _remove(self, index, slot, digest):
+        self._table[index] = _DELETED
+        self._buckets[self._bucket(digest)].remove(slot)
+        self._objects.pop(slot, None)
+        self._free.append(slot)
+        self._garbage += self._name_lengths[slot]
+        self._count -= 1
+        if self._garbage > 2 ** 20 and self._garbage > len(self._arena) // 2:
+            self._compact_arena()
+
+    def __iter__(self):
+        with self._lock:
+            return iter([self._name(slot).decode('utf-8') for slot in self._live_slots()])
+
+    def __len__(self):
+        return self._count
+
+    # ring ranges
+
+    def _range_slots(self, start, end, limit=None):
+        # slots in (start, end] in ring order, only the buckets at the edges of an interval are filtered
+        if start is None:
+            intervals = [(-1, keyspace.SIZE - 1)]
+        elif start < end:
+            intervals = [(start, end)]
+        else:
+            intervals = [(start, keyspace.SIZE - 1), (-1, end)]  # wraps around 0 (start == end: the whole ring)
+        shift = keyspace.BITS - self._bucket_bits
+        slots = []
+        for low, high in intervals:
+            first, last = (low + 1) >> shift, high >> shift
+            for number in range(first, last + 1):
+                bucket = sorted(self._buckets[number], key=self._position)
+                if number in (first, last):
+                    bucket = [slot for slot in bucket if low < self._position(slot) <= high]
+                slots.extend(bucket)
+                if limit is not None and len(slots) >= limit:
+                    return slots[:limit]
+        return slots
+
+    def range_items(self, start, end, limit=None):
+        with self._lock:
+            return [(self._name(slot).decode('utf-8'), self._value(slot)) for slot in self._range_slots(start, end, limit)]
+
+    def delete_range(self, start, end):
+        with self._lock:
+            slots = self._range_slots(start, end)
+            for slot in slots:
+                digest = self._digest(slot)
+                index, _ = self._find(self._name(slot), digest)
+                self._remove(index, slot, digest)
+            return len(slots)
+
+    # serialization straight from the buffers
+
+    def _json_pair(self, slot, separator):
+        # b'"name"<separator><value>', the name is copied from the arena unless it needs escaping
+        name = self._name(slot)
+        if _NEEDS_ESCAPE.search(name):
+            name = json.dumps(name.decode('utf-8'), ensure_ascii=False).encode('utf-8')
+        else:
+            name = b'"' + name + b'"'
+        value = json.dumps(self._objects[slot]) if slot in self._objects else str(self._values[slot])
+        return name + separator + value.encode('utf-8')
+
+    def ndjson_range(self, start, end, limit=None):
+        with self._lock:
+            return [b'{"song_name": ' + self._json_pair(slot, b', "value": ') + b'}\n' for slot in self._range_slots(start, end, limit)]
+
+    def dump_json(self):
+        with self._lock:
+            return b'{' + b', '.join(self._json_pair(slot, b': ') for slot in self._live_slots()) + b'}'
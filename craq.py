@@ -0,0 +1,93 @@
+import itertools
+import random
+import threading
+
+import http_pool
+import keyspace
+
+"""
+Apportioned reads (CRAQ) for chain replication.
+
+Every node of a key's chain answers reads of the key, not only the tail. A node marks a key dirty before it applies a
+write that still has to travel down the chain, and clean again once that write is acknowledged, i.e. the tail's
+cumulative /chain_ack covering the write's sequence number came back up the chain (see chain_pipeline.py). Writes
+are numbered per node and only the acknowledgement of the latest one cleans the key, so a key written again before
+the ack of the earlier write arrived stays dirty until the newer write is acknowledged.
+
+A read takes the local value first and checks the key afterwards: clean means every write the node had applied is
+committed, the local value is answered. For a dirty key the node asks the tail for the committed version; values are
+single integers here, so the tail answers with the committed value itself rather than a version number to look up.
+Reads spread over the k nodes of the chain and stay linearizable.
+"""
+
+_lock = threading.Lock()
+_versions = itertools.count(1)
+_dirty = {}  # song_name -> number of the latest write applied here that the tail has not acknowledged yet
+
+
+def begin_write(song_names):
+    # marks the songs dirty before the write is applied, returns the number to acknowledge it with
+    with _lock:
+        version = next(_versions)
+        for song_name in song_names:
+            _dirty[song_name] = version
+    return version
+
+
+def acknowledge(song_names, version):
+    # the tail applied the write, the songs are clean unless a newer write came in meanwhile
+    if version is None:
+        return  # the write was not marked, e.g. the node had no successor
+    with _lock:
+        for song_name in song_names:
+            if _dirty.get(song_name) == version:
+                del _dirty[song_name]
+
+
+def is_dirty(song_name):
+    return song_name in _dirty
+
+
+def dirty_count():
+    return len(_dirty)
+
+
+def is_member(node, members):
+    return any(keyspace.address_id(member) == node.get_key() for member in members)
+
+
+def pick(members):
+    # a random node of the chain, this is how reads are apportioned over it
+    return random.choice(members)
+
+
+def read(node, members, song_name):
+    # the committed (song_name, value) at a node of the song's chain, None if the song does not exist
+    result = node.query(song_name)
+    tail = members[-1]
+    if not is_dirty(song_name) or keyspace.address_id(tail) == node.get_key():
+        return result
+    response = http_pool.get(f"http://{tail[0]}:{tail[1]}/chain_replicated_query", params={"song_name": song_name, "k": 1})
+    response.raise_for_status()
+    return response.json().get("value")
+
+
+def read_many(node, members, song_names):
+    # batch version of read: clean songs from the local store, the dirty ones from the tail in one request
+    results = {}
+    dirty = []
+    tail = members[-1]
+    at_tail = keyspace.address_id(tail) == node.get_key()
+    for song_name in song_names:
+        result = node.query(song_name)
+        if is_dirty(song_name) and not at_tail:
+            dirty.append(song_name)
+        elif result is None:
+            results[song_name] = {"status": 404}
+        else:
+            results[song_name] = {"status": 200, "value": result, "node": f"{node.get_ip()}:{node.get_port()}"}
+    if dirty:
+        response = http_pool.post(f"http://{tail[0]}:{tail[1]}/batch/chain_replicated_query", json={"keys": dirty, "k": 1})
+        response.raise_for_status()
+        results.update(response.json().get("results", {}))
+    return results
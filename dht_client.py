@@ -0,0 +1,122 @@
+import bisect
+import json
+import random
+import time
+import urllib.parse
+
+import requests
+
+import keyspace
+
+"""
+Ring-aware client for the DHT. It keeps a cached copy of the ring (node keys from /overlay plus k and the
+consistency model), hashes the song locally with keyspace.key_id and sends the request straight to the node
+that owns it: the primary for writes, a random node of the chain for chain replication reads (every node of the
+chain answers them, see craq.py), which spreads the read load of a key over its replicas. When the cached ring
+is stale the node answers with a redirect (requests are sent with mode=iterative), the client refreshes the ring
+and retries, so the common path costs a single HTTP call and no forwarding on the nodes.
+"""
+
+
+class DHTClient:
+    def __init__(self, entry_url, refresh_interval=30.0, max_attempts=3):
+        self.entry_url = entry_url.rstrip('/')
+        self.refresh_interval = refresh_interval  # seconds after which the cached ring is rebuilt anyway
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        self._ring = []  # [(key, "http://ip:port")] sorted by key
+        self._keys = []
+        self.k = 1
+        self.consistency = ""
+        self._refreshed_at = 0.0
+
+    def refresh(self):
+        # rebuild the cached ring from the overlay of the entry node
+        response = self.session.get(f"{self.entry_url}/overlay")
+        response.raise_for_status()
+        data = response.json()
+        ring = []
+        for member in data.get("overlay", []):
+            key = keyspace.from_hex(member["key"]) if member.get("key") else keyspace.address_id([member['ip'], member['port']])
+            ring.append((key, f"http://{member['ip']}:{member['port']}"))
+        ring.sort()
+        self._ring = ring
+        self._keys = [key for key, _ in ring]
+        self.k = data.get("k", 1)
+        self.consistency = data.get("consistency", "")
+        self._refreshed_at = time.time()
+
+    def get_ring(self):
+        if not self._ring or time.time() - self._refreshed_at > self.refresh_interval:
+            self.refresh()
+        return self._ring
+
+    def replicas(self, song_name):
+        # the primary node of the song followed by the k-1 nodes that hold its replicas
+        ring = self.get_ring()
+        index = bisect.bisect_left(self._keys, keyspace.key_id(song_name)) % len(ring)
+        return [ring[(index + i) % len(ring)][1] for i in range(min(self.k, len(ring)))]
+
+    def primary(self, song_name):
+        return self.replicas(song_name)[0]
+
+    def tail(self, song_name):
+        return self.replicas(song_name)[-1]
+
+    def _send(self, method, song_name, path, params=None):
+        """
+        Sends the request to the owner of the song. A redirect, a 410 (departed node) or a connection error means
+        the cached ring is stale: refresh it and try again, following the redirect on the last attempt.
+        """
+        params = dict(params or {}, mode="iterative")
+        quoted = urllib.parse.quote(song_name, safe='')
+        last_error = None
+        for attempt in range(self.max_attempts):
+            url = f"{self.primary(song_name)}{path.format(song=quoted)}"
+            last_attempt = attempt == self.max_attempts - 1
+            try:
+                response = self.session.request(method, url, params=params, allow_redirects=last_attempt)
+            except requests.RequestException as e:
+                last_error = e
+                self.refresh()
+                continue
+            if response.status_code in (307, 410):
+                self.refresh()
+                continue
+            return response
+        if last_error is not None:
+            raise last_error
+        return response
+
+    def insert(self, song_name, value):
+        return self._send("POST", song_name, f"/insert/{{song}}/{value}")
+
+    def delete(self, song_name):
+        return self._send("DELETE", song_name, "/delete/{song}")
+
+    def query(self, song_name):
+        if song_name == '*':
+            return self.session.get(f"{self.entry_url}/query/*")
+        self.get_ring()
+        if self.consistency == "chain replication":
+            # linearizable reads are served by any node of the chain, pick one at random
+            replica = random.choice(self.replicas(song_name))
+            try:
+                response = self.session.get(f"{replica}/query/{urllib.parse.quote(song_name, safe='')}",
+                                            params={"mode": "iterative"}, allow_redirects=False)
+                if response.status_code in (200, 404):
+                    return response
+            except requests.RequestException:
+                pass
+            self.refresh()
+            # the cached chain is stale (redirect) or the replica is gone: go through the primary
+        return self._send("GET", song_name, "/query/{song}")
+
+    def scan(self):
+        # every (song_name, value) of the DHT in ring order, read as an NDJSON stream so the dump is never held whole
+        with self.session.get(f"{self.entry_url}/query/*", params={"format": "ndjson"}, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    song = json.loads(line)
+                    yield song["song_name"], song["value"]
@@ -1,19 +1,27 @@
-import matplotlib.pyplot as plt
+import glob
+import json
+import sys
 
-# k values including k=1, 3, and 5
-k_values = [1, 3, 5]
+import matplotlib.pyplot as plt
 
-# Throughput values for each consistency model.
-throughput_chain = [210.12, 139.14, 98.56]       # Chain Replication
-throughput_eventual = [215.11, 169.82, 124.23]     # Eventual Consistency
+# benchmark.py results of the insert workload, one file per (k, consistency model): the files given on the command
+# line or every results/*.json
+files = sys.argv[1:] or glob.glob("results/*.json")
+throughput = {}  # consistency model -> {k: inserts/sec}
+for file_name in files:
+    with open(file_name) as f:
+        result = json.load(f)
+    if result["config"]["workload"] == "insert":
+        throughput.setdefault(result["config"]["consistency"], {})[result["config"]["k"]] = result["throughput"]
 
 plt.figure(figsize=(10, 6))
-plt.plot(k_values, throughput_chain, marker='o', label='Chain Replication')
-plt.plot(k_values, throughput_eventual, marker='o', label='Eventual Consistency')
+for consistency, label in (("chain replication", 'Chain Replication'), ("eventual consistency", 'Eventual Consistency')):
+    k_values = sorted(throughput.get(consistency, {}))
+    plt.plot(k_values, [throughput[consistency][k] for k in k_values], marker='o', label=label)
 
 plt.xlabel('k (Replication Factor)')
 plt.ylabel('Throughput (inserts/sec)')
 plt.title('Throughput vs. Replication Factor for Different Consistency Models')
 plt.legend()
 plt.grid(True)
-plt.show()
\ No newline at end of file
+plt.show()
@@ -0,0 +1,278 @@
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+import http_pool
+import keyspace
+
+"""
+Range based key handoff used when the ring membership changes.
+
+With replication factor k a node stores every key in its replica window (p_k, node], where p_k is its k-th predecessor
+(the whole ring when there are k nodes or fewer). When a node joins or leaves only the windows of the k nodes after
+it change, so the keys that have to move are whole ring ranges: on join they are streamed as NDJSON in one request
+per neighbour and dropped in bulk, on depart they are pushed in acknowledged chunks, instead of walking the ring
+once per song or posting the whole song list in one body.
+"""
+
+DEPART_CHUNK_SIZE = int(os.getenv("DEPART_CHUNK_SIZE", "1000"))  # songs per /give_songs chunk
+MAX_CONCURRENT_CHUNKS = int(os.getenv("MAX_CONCURRENT_CHUNKS", "2"))  # chunks a node applies at once, the rest get 429
+MAX_CHUNK_RETRIES = int(os.getenv("MAX_CHUNK_RETRIES", "20"))
+
+# departure progress: (target, start, end) -> key of the last song the target acknowledged, so a failed depart resumes
+_depart_progress = {}
+# receiving side: transfer id -> last applied sequence number until its last chunk, retried chunks are not applied twice
+_received_chunks = {}
+_chunk_slots = threading.BoundedSemaphore(MAX_CONCURRENT_CHUNKS)
+
+
+def ring_keys(ring):
+    # ring: [[ip, port], ...] as returned by the bootstrap node, sorted by key
+    return [keyspace.address_id(address) for address in ring]
+
+
+def window_start(ring, index, k):
+    # key of the k-th predecessor of ring[index], None when every node holds the whole ring
+    if len(ring) <= k:
+        return None
+    return keyspace.address_id(ring[(index - k) % len(ring)])
+
+
+def drop_range(node, start, end):
+    # removes every key in (start, end]
+    return node.get_song_list().delete_range(start, end)
+
+
+def stream_range(node, start, end, limit=None):
+    # NDJSON body of /transfer_range, one {"song_name", "value"} object per line, serialized by the store
+    return node.get_song_list().ndjson_range(start, end, limit)
+
+
+def pull_range(node, source, start, end, reconcile=False):
+    """
+    Streams (start, end] from the source node and stores it locally as it arrives, songs recovered from disk with
+    the same value are not written again. With reconcile the local copy of the range is made equal to the source's:
+    the stream comes in ring order, so the local songs between two streamed ones are songs the source no longer has
+    (e.g. deleted while this node was down) and are removed as the stream passes them. Songs written on this node
+    while the pull runs (tracked by the caller, see join) are newer than the source's copy and are left alone.
+    """
+    params = {"end": keyspace.to_hex(end)}
+    if start is not None:
+        params["start"] = keyspace.to_hex(start)
+    written = node.written_since_tracking()
+    store = node.get_song_list()
+    # the stream starts after start and wraps around 0 once when start > end; start None streams from position 0
+    previous = -1 if start is None else start
+    received = 0
+    with http_pool.get(f"http://{source[0]}:{source[1]}/transfer_range", params=params, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            song = json.loads(line)
+            position = keyspace.key_id(song["song_name"])
+            if reconcile:
+                if position < previous:
+                    _drop_missing(store, previous, keyspace.SIZE - 1, written)
+                    previous = -1
+                _drop_missing(store, previous, position, written, keep=song["song_name"])
+            previous = position
+            if song["song_name"] not in written and store.get(song["song_name"]) != song["value"]:
+                store[song["song_name"]] = song["value"]
+            received += 1
+    if reconcile:
+        if start is not None and previous > end:  # the stream never wrapped around 0
+            _drop_missing(store, previous, keyspace.SIZE - 1, written)
+            previous = -1
+        _drop_missing(store, previous, keyspace.SIZE - 1 if start is None else end, written)
+    return received
+
+
+def _drop_missing(store, low, high, written, keep=None):
+    # removes the local songs in (low, high] except keep and the songs written meanwhile, a chunk at a time
+    while low < high:
+        songs = store.range_items(low, high, limit=DEPART_CHUNK_SIZE)
+        for song_name, _ in songs:
+            if song_name != keep and song_name not in written:
+                store.pop(song_name, None)
+        if len(songs) < DEPART_CHUNK_SIZE:
+            return
+        low = keyspace.key_id(songs[-1][0])
+
+
+def join(node, ring, k, rejoin=False):
+    """
+    Runs on the joining node once its pointers are set. Pulls its replica window, its own primary range from the
+    successor (which held it before the join, or is its first replica when a member rejoins) and the primary range
+    of each of its k-1 predecessors from that predecessor, and reconciles what it recovered from disk against them.
+    Returns the number of songs received.
+    """
+    me = [node.get_ip(), node.get_port()]
+    keys = ring_keys(ring)
+    index = keys.index(node.get_key())
+    successor = ring[(index + 1) % len(ring)]
+    if successor == me or keyspace.address_id(successor) == node.get_key():
+        return 0
+
+    start = window_start(ring, index, k)
+    if start is not None:
+        # songs recovered from disk that are no longer in this node's window
+        node.get_song_list().delete_range(node.get_key(), start)
+    node.start_tracking_writes()
+    try:
+        if start is None:
+            received = pull_range(node, successor, None, node.get_key(), reconcile=True)  # every node holds the ring
+        else:
+            received = 0
+            for step in range(k):
+                primary = (index - step) % len(ring)
+                if step == 0 and rejoin and k == 1:
+                    continue  # nobody else holds this range, the copy recovered from disk is the only one
+                source = successor if step == 0 else ring[primary]
+                received += pull_range(node, source, keys[primary - 1], keys[primary], reconcile=True)
+    finally:
+        node.stop_tracking_writes()
+    return received
+
+
+def trim_neighbours(node, ring, k):
+    """
+    Runs on the joining node once the view with it is published. Asks each of the k following nodes to drop the
+    range that slid out of its window and returns the number of replicas dropped.
+    """
+    keys = ring_keys(ring)
+    index = keys.index(node.get_key())
+    dropped = 0
+    if len(ring) > k:
+        for step in range(1, k + 1):
+            neighbour_index = (index + step) % len(ring)
+            if neighbour_index == index:
+                break
+            neighbour = ring[neighbour_index]
+            # the complement of (start, neighbour] is (neighbour, start]
+            response = http_pool.post(f"http://{neighbour[0]}:{neighbour[1]}/drop_range", json={
+                "start": keyspace.to_hex(keys[neighbour_index]),
+                "end": keyspace.to_hex(window_start(ring, neighbour_index, k))
+            })
+            response.raise_for_status()
+            dropped += response.json().get("dropped", 0)
+    return dropped
+
+
+def resize(node, ring, old_k, new_k):
+    """
+    Runs on every node when the replication factor changes from old_k to new_k. A larger k grows the replica window
+    by the primary ranges of the next predecessors, each is pulled from its primary; a smaller k shrinks it and the
+    range that slid out, (node, new k-th predecessor], is dropped. The new k is live during the pull, so the chain
+    writes that reach the node meanwhile are tracked and win over the streamed copies, as on a join.
+    """
+    keys = ring_keys(ring)
+    if node.get_key() not in keys:
+        return 0, 0
+    index = keys.index(node.get_key())
+    received = 0
+    node.start_tracking_writes()
+    try:
+        for step in range(min(old_k, len(ring)), min(new_k, len(ring))):
+            primary = (index - step) % len(ring)
+            received += pull_range(node, ring[primary], keys[primary - 1], keys[primary])
+    finally:
+        node.stop_tracking_writes()
+    start = window_start(ring, index, new_k)
+    dropped = drop_range(node, node.get_key(), start) if new_k < old_k and start is not None else 0
+    return received, dropped
+
+
+def departure_plan(ring, leaving_index, k):
+    """
+    The ranges each remaining node gains when ring[leaving_index] leaves: its new replica window minus the old one,
+    i.e. (new k-th predecessor, old k-th predecessor]. Every gained range lies inside the window of the leaving node.
+    """
+    remaining = ring[:leaving_index] + ring[leaving_index + 1:]
+    if len(ring) <= k or not remaining:
+        return []  # every node already holds the whole ring
+    plan = []
+    for step in range(1, k + 1):
+        index = (leaving_index + step) % len(ring)
+        if index == leaving_index:
+            break
+        target = ring[index]
+        old_start = window_start(ring, index, k)
+        new_start = window_start(remaining, remaining.index(target), k)
+        if new_start is None:
+            new_start = keyspace.address_id(target)  # whole ring now: gains the complement (target, old_start]
+        plan.append((target, new_start, old_start))
+    return plan
+
+
+def push_range(node, target, start, end):
+    """
+    Streams the songs in (start, end] to the target in chunks of DEPART_CHUNK_SIZE, in ring order. A chunk is only
+    sent after the previous one was acknowledged, a 429 from the target backs off and retries, and the key of the last
+    acknowledged song is remembered so that a failed departure resumes where it stopped.
+    """
+    progress_key = (tuple(target), start, end)
+    cursor = _depart_progress.get(progress_key)
+    if cursor == end:
+        return 0  # everything was acknowledged already
+
+    transfer_id = uuid.uuid4().hex
+    sent = 0
+    for seq in itertools.count():
+        # only one chunk is read from the store at a time, resuming after the last acknowledged song; the one song
+        # more than a chunk tells whether this is the last one
+        songs = node.get_song_list().range_items(start if cursor is None else cursor, end, limit=DEPART_CHUNK_SIZE + 1)
+        if not songs:
+            break
+        chunk = songs[:DEPART_CHUNK_SIZE]
+        last = len(songs) <= DEPART_CHUNK_SIZE or keyspace.key_id(chunk[-1][0]) == end
+        packet = {"transfer_id": transfer_id, "seq": seq, "last": last, "songs": dict(chunk)}
+        for attempt in range(MAX_CHUNK_RETRIES):
+            response = http_pool.post(f"http://{target[0]}:{target[1]}/give_songs", json=packet)
+            if response.status_code != 429:
+                break
+            time.sleep(float(response.headers.get("Retry-After", 0.05)) * (attempt + 1))
+        response.raise_for_status()
+        cursor = _depart_progress[progress_key] = keyspace.key_id(chunk[-1][0])
+        sent += len(chunk)
+        if last:
+            break  # also stops at cursor == end, (end, end] would be the whole ring again
+    return sent
+
+
+def depart(node, ring, k):
+    # pushes to each of the k following nodes the range it gains when this node leaves, returns the songs sent
+    keys = ring_keys(ring)
+    if node.get_key() not in keys:
+        return 0
+    sent = 0
+    for target, start, end in departure_plan(ring, keys.index(node.get_key()), k):
+        sent += push_range(node, target, start, end)
+    _depart_progress.clear()
+    return sent
+
+
+def receive_chunk(node, packet):
+    """
+    Applies one /give_songs chunk. Returns False when the node is already applying MAX_CONCURRENT_CHUNKS chunks,
+    the sender then backs off (429) instead of piling up requests.
+    """
+    if not _chunk_slots.acquire(blocking=False):
+        return False
+    try:
+        transfer_id = packet.get("transfer_id")
+        seq = packet.get("seq", 0)
+        if _received_chunks.get(transfer_id, -1) >= seq:
+            return True  # retry of a chunk we already applied
+        for song_name, value in packet.get("songs", {}).items():
+            node.set_song_to_song_list(song_name, value)
+        if packet.get("last"):
+            _received_chunks.pop(transfer_id, None)  # the transfer is complete, nothing is retried after its last chunk
+        else:
+            _received_chunks[transfer_id] = seq
+        return True
+    finally:
+        _chunk_slots.release()
@@ -0,0 +1,56 @@
+import os
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+"""
+One keep-alive session shared by every inter-node call of the process. Each peer (ip:port) gets its own bounded
+pool of warm connections, so a forward to the successor, a chain replication hop or a call to the bootstrap node
+reuses an open TCP connection instead of paying a new handshake every time.
+"""
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT")) if os.getenv("HTTP_READ_TIMEOUT") else None  # recursive calls (e.g. query *) may take long, no limit by default
+
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "64"))  # number of peers whose pools are cached
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))  # keep-alive connections kept per peer
+
+
+def _create_session():
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+    return new_session
+
+
+session = _create_session()
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    target = urllib.parse.urlsplit(url)
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.PEER_FAILURES.inc(target.netloc)
+        raise
+    metrics.PEER_LATENCY.observe(time.perf_counter() - started, target.netloc)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
@@ -6,6 +6,8 @@ import concurrent.futures
 import requests
 import urllib
 
+from local_cluster import configure
+
 # Mapping of node IDs to their IP and port.
 node_mapping = {
     "00": ('10.0.17.96', 5000),
@@ -66,20 +68,60 @@ def insert_keys_from_file(node_id, config):
                 print(f"Exception on node {node_id} inserting '{song_name}': {str(e)}")
     return (count, file_read_time)
 
+# Songs sent per /batch/insert request, 0 sends one /insert request per song.
+BATCH_SIZE = 0
+
+def insert_keys_in_batches(node_id, config):
+    """
+    Same workload as insert_keys_from_file, but the songs of insert_<node_id>_part.txt are sent in /batch/insert
+    requests of BATCH_SIZE songs. The node splits every batch by owner and returns a result per song.
+    Returns a tuple: (number of successful inserts, time spent reading the file in seconds)
+    """
+    ip, port = node_mapping[node_id]
+    file_name = f"insert_{node_id}_part.txt"
+    count = 0
+    if not os.path.exists(file_name):
+        print(f"File {file_name} not found!")
+        return (0, 0)
+
+    start_read = time.time()
+    with open(file_name, "r", encoding="utf-8") as f:
+        song_names = [line.strip() for line in f if line.strip()]
+    file_read_time = time.time() - start_read
+
+    fixed_value = 1
+    url = f"http://{ip}:{port}/batch/insert"
+    for start in range(0, len(song_names), BATCH_SIZE):
+        items = {song_name: fixed_value for song_name in song_names[start:start + BATCH_SIZE]}
+        try:
+            response = requests.post(url, json={"items": items}, timeout=60)
+            response.raise_for_status()
+            for song_name, result in response.json()["results"].items():
+                if result.get("status") == 200:
+                    count += 1
+                else:
+                    print(f"Node {node_id} failed to insert '{song_name}': {result}")
+        except Exception as e:
+            print(f"Exception on node {node_id} inserting a batch of {len(items)} songs: {str(e)}")
+    return (count, file_read_time)
+
 def run_experiment(config):
     """
     Starts concurrent inserts from all nodes, measures total elapsed time, subtracts file-read time,
     and then calculates throughput based on the effective insertion time.
-    Assumes that nodes are preconfigured with config's 'consistency' and replication factor 'k'.
+    The ring is first switched to config's 'consistency' and replication factor 'k' (POST /config), so all
+    experiments run one after the other against the same live ring.
     """
     print(f"Running experiment with config: {config}")
+    configure([f"http://{ip}:{port}" for ip, port in node_mapping.values()], config["k"], config["consistency"])
     total_inserts = 0
     total_file_read_time = 0.0
     start_time = time.time()
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
         futures = []
         for node_id in node_mapping.keys():
-            futures.append(executor.submit(insert_keys_from_file, node_id, config))
+            worker = insert_keys_in_batches if BATCH_SIZE > 0 else insert_keys_from_file
+            futures.append(executor.submit(worker, node_id, config))
         for future in concurrent.futures.as_completed(futures):
             count, file_read_time = future.result()
             total_inserts += count
@@ -0,0 +1,94 @@
+import traceback
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+"""
+HTTP/1.1 keep-alive for the threaded (Werkzeug) server.
+
+Werkzeug's development server answers every request with `Connection: close`, so http_pool's pooled connections to
+a node were dropped after each call and every hop paid a new TCP handshake. This handler keeps the connection open
+and serves the next request of the peer on the same thread. The request body is read through a LimitedStream and
+whatever the route left unread is drained before the next request line, a response without a Content-Length (e.g.
+the NDJSON streams of query * and of the handoff) is sent chunked. A chunked request body or an error in the app
+close the connection like before.
+
+Headers and body go out as separate writes, so Nagle's algorithm is disabled on the accepted sockets; otherwise the
+body of every response would wait for the peer's delayed ACK.
+"""
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def run_wsgi(self):
+        if self.headers.get("Expect", "").lower().strip(" \t") == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        self.environ = environ = self.make_environ()
+        if environ.get("wsgi.input_terminated"):
+            self.close_connection = True  # the end of a chunked body is not tracked, the next request line is unknown
+        else:
+            environ["wsgi.input"] = LimitedStream(self.rfile, int(environ.get("CONTENT_LENGTH") or 0))
+        self._sent = None  # (chunked,) once the status line and headers went out
+        try:
+            self._execute(self.server.app)
+        except (ConnectionError, TimeoutError):
+            raise  # the peer went away, WSGIRequestHandler.handle ends the connection quietly
+        except Exception:
+            self.close_connection = True
+            self.server.log("error", f"Error on request:\n{traceback.format_exc()}")
+            if self._sent is None:
+                self._execute(InternalServerError())
+            return
+        if isinstance(environ["wsgi.input"], LimitedStream):
+            environ["wsgi.input"].exhaust()
+
+    def _execute(self, app):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and self._sent is not None:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return write
+
+        def write(data):
+            if self._sent is None:
+                self._send_headers(response["status"], response["headers"])
+            if not data:
+                return
+            if self._sent[0]:
+                data = b"%x\r\n%s\r\n" % (len(data), data)
+            self.wfile.write(data)
+
+        result = app(self.environ, start_response)
+        try:
+            for data in result:
+                write(data)
+            if self._sent is None:
+                write(b"")
+            if self._sent[0]:
+                self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    def _send_headers(self, status, headers):
+        code, _, message = status.partition(" ")
+        code = int(code)
+        self.send_response(code, message)
+        names = set()
+        for name, value in headers:
+            if name.lower() != "connection":
+                self.send_header(name, value)
+                names.add(name.lower())
+        chunked = not ("content-length" in names or self.command == "HEAD" or 100 <= code < 200 or code in (204, 304))
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self._sent = (chunked,)
@@ -0,0 +1,59 @@
+import hashlib
+
+"""
+Ring positions and interval math.
+
+Positions on the ring are 160-bit integers (SHA-1 of the song name or of "ip:port"). Nodes compute them once,
+when they join or change pointers, and routing decisions are plain int compares. The hex form is only used on the
+wire (join requests, /overlay, /find_successor/<key>, range handoff parameters) and in logs.
+"""
+
+BITS = 160  # SHA-1 identifiers are 160 bits long
+SIZE = 2 ** BITS
+
+
+def key_id(name):
+    # position of a song name (or any string) on the ring
+    return int.from_bytes(hashlib.sha1(name.encode('utf-8')).digest(), 'big')
+
+
+_address_ids = {}  # "ip:port" -> position, a ring has few addresses and CRAQ reads look them up on every request
+
+
+def address_id(address):
+    # position of the node at [ip, port], None for a missing pointer
+    if not address:
+        return None
+    name = f"{address[0]}:{address[1]}"
+    position = _address_ids.get(name)
+    if position is None:
+        position = _address_ids[name] = key_id(name)
+    return position
+
+
+def to_hex(identifier):
+    return format(identifier, '040x')
+
+
+def from_hex(identifier):
+    return int(identifier, 16)
+
+
+def between(key, start, end):
+    # open interval (start, end) on the ring, start == end means the whole ring except start
+    if start < end:
+        return start < key < end
+    return key > start or key < end
+
+
+def between_right_inclusive(key, start, end):
+    # half open interval (start, end] on the ring, start == end means the whole ring
+    if start == end:
+        return True
+    if start < end:
+        return start < key <= end
+    return key > start or key <= end
+
+
+def finger_start(identifier, i):
+    return (identifier + 2 ** i) % SIZE
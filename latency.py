@@ -0,0 +1,43 @@
+import os
+import random
+import time
+
+"""
+Opt-in network latency injection, used to model WAN delay in benchmarks. Production runs leave it unset and pay
+nothing: the hook is a lookup in an empty dict.
+
+NETWORK_DELAY lists a delay distribution per endpoint (the Flask view name), in seconds, `*` matches every endpoint:
+
+    NETWORK_DELAY="chain_append=fixed:0.01,batch_eventual_insertion=uniform:0.005:0.015,*=normal:0.002:0.0005"
+
+fixed:<delay>, uniform:<low>:<high> and normal:<mean>:<stddev> (negative samples are clamped to 0) are supported.
+"""
+
+DISTRIBUTIONS = {
+    "fixed": lambda delay: delay,
+    "uniform": random.uniform,
+    "normal": lambda mean, stddev: max(0.0, random.gauss(mean, stddev)),
+}
+
+
+def parse(spec):
+    delays = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, _, distribution = entry.partition('=')
+        name, *params = distribution.split(':')
+        if name not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown delay distribution '{name}' for endpoint '{endpoint}'")
+        delays[endpoint.strip()] = (DISTRIBUTIONS[name], [float(param) for param in params])
+    return delays
+
+
+delays = parse(os.getenv("NETWORK_DELAY", ""))
+
+
+def inject(endpoint):
+    if not delays:
+        return
+    delay = delays.get(endpoint) or delays.get('*')
+    if delay is not None:
+        sample, params = delay
+        time.sleep(sample(*params))
@@ -0,0 +1,179 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+
+"""
+A whole DHT on one machine: a bootstrap node and N regular nodes as separate processes on 127.0.0.1, for benchmarks
+on a laptop or a CI runner without the lab machines.
+
+    python local_cluster.py --nodes 9 --k 3 --consistency "eventual consistency"
+
+starts the ring, joins the nodes one after the other, waits until every node is on the successor ring and has the
+latest membership view, prints the node URLs and runs until Ctrl-C. From Python:
+
+    with LocalCluster(nodes=4, k=2) as cluster:
+        requests.post(f"{cluster.urls[1]}/insert/song/1")
+
+Node output goes to <log_dir>/<port>.log when a log directory is given. Extra environment variables for the nodes
+(e.g. STORAGE_ENGINE, SERVER_MODE, NETWORK_DELAY) are passed with env. k and the consistency model are only the
+starting settings, cluster.configure(k=3) or configure(urls, ...) switches a running ring without a restart.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def configure(urls, k=None, consistency=None, timeout=60.0):
+    """
+    Changes the replication factor and/or the consistency model of a running ring through the first node's /config
+    and waits until every node in urls has applied the new epoch. Returns the new settings.
+    """
+    settings = {name: value for name, value in (("k", k), ("consistency", consistency)) if value is not None}
+    response = requests.post(f"{urls[0]}/config", json=settings, timeout=timeout)
+    response.raise_for_status()
+    applied = response.json()
+    deadline = time.time() + timeout
+    while any(requests.get(f"{url}/membership", timeout=5).json()["epoch"] < applied["epoch"] for url in urls):
+        if time.time() > deadline:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for the nodes to apply epoch {applied['epoch']}")
+        time.sleep(0.2)
+    return applied
+
+
+class LocalCluster:
+    def __init__(self, nodes=4, k=2, consistency="chain replication", base_port=5000, ip="127.0.0.1", env=None,
+                 log_dir=None, timeout=60.0):
+        self.nodes = nodes  # regular nodes, the bootstrap comes on top
+        self.k = k
+        self.consistency = consistency
+        self.ip = ip
+        self.ports = [base_port + i for i in range(nodes + 1)]  # bootstrap first
+        self.env = env or {}
+        self.log_dir = log_dir
+        self.timeout = timeout
+        self._processes = []
+
+    @property
+    def urls(self):
+        return [f"http://{self.ip}:{port}" for port in self.ports]
+
+    def _spawn(self, script, port):
+        env = dict(os.environ)
+        env.update({
+            "BOOTSTRAP_IP": self.ip,
+            "BOOTSTRAP_PORT": str(self.ports[0]),
+            "NODE_IP": self.ip,
+            "REPLICATION_FACTOR": str(self.k),
+            "CONSISTENCY": self.consistency,
+            "SERVER_RELOAD": "off",
+        })
+        env.update({name: str(value) for name, value in self.env.items()})
+        output = subprocess.DEVNULL
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+            output = open(os.path.join(self.log_dir, f"{port}.log"), "w")
+        # own process group, so stop() also reaches whatever the node spawned
+        self._processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, script), str(port)], cwd=HERE, env=env,
+                                                stdout=output, stderr=subprocess.STDOUT, start_new_session=True))
+
+    def _wait_until(self, ready, what):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            exited = [process.args[-1] for process in self._processes if process.poll() is not None]
+            if exited:
+                raise RuntimeError(f"Node(s) on port {', '.join(exited)} exited while waiting for {what}")
+            try:
+                if ready():
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise TimeoutError(f"Timed out after {self.timeout}s waiting for {what}")
+
+    def start(self):
+        try:
+            self._spawn("bootstrap.py", self.ports[0])
+            for port in self.ports[1:]:
+                self._spawn("regular_node.py", port)
+            for url in self.urls:
+                self._wait_until(lambda: requests.get(f"{url}/membership", timeout=1).ok, f"{url} to start")
+            for url in self.urls[1:]:
+                # one at a time, every join hands off key ranges on the ring the previous one left behind
+                response = requests.post(f"{url}/join", timeout=self.timeout)
+                response.raise_for_status()
+            self.wait_converged()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def configure(self, k=None, consistency=None):
+        applied = configure(self.urls, k, consistency, self.timeout)
+        self.k, self.consistency = applied["k"], applied["consistency"]
+        return applied
+
+    def converged(self):
+        # every node is on the successor ring and holds the newest membership view
+        overlay = requests.get(f"{self.urls[0]}/overlay", timeout=5).json().get("overlay", [])
+        if len(overlay) != len(self.ports):
+            return False
+        epochs = {requests.get(f"{url}/membership", timeout=5).json()["epoch"] for url in self.urls}
+        return len(epochs) == 1
+
+    def wait_converged(self):
+        self._wait_until(self.converged, "the ring to converge")
+
+    def stop(self):
+        for process in self._processes:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+        self._processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a bootstrap node and N regular nodes on this machine")
+    parser.add_argument("--nodes", type=int, default=4, help="regular nodes besides the bootstrap (default 4)")
+    parser.add_argument("--k", type=int, default=2, help="replication factor (default 2)")
+    parser.add_argument("--consistency", default="chain replication", choices=["chain replication", "eventual consistency"])
+    parser.add_argument("--base-port", type=int, default=5000, help="port of the bootstrap, the nodes take the next ones")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--log-dir", help="write each node's output to <log-dir>/<port>.log")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra environment variable for the nodes")
+    args = parser.parse_args()
+
+    env = dict(entry.split("=", 1) for entry in args.env)
+    cluster = LocalCluster(args.nodes, args.k, args.consistency, args.base_port, args.ip, env, args.log_dir)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with cluster:
+        print(f"Ring of {len(cluster.ports)} nodes is up (k={args.k}, {args.consistency}):")
+        for url in cluster.urls:
+            print(f"  {url}")
+        print("Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler
+
+"""
+Logging of the nodes.
+
+Every module logs through a logger of the "dht" hierarchy instead of print(). Records are put on an in-memory queue
+and written to stdout (or LOG_FILE) by one background thread that drains whatever has piled up and flushes once per
+batch, so a request handler never waits on a terminal or a file.
+
+Two kinds of loggers:
+  get_logger(name): joins, departures, handoffs, failures. INFO and above are on by default.
+  get_tracer(name): per-request routing traces at DEBUG. Off unless LOG_LEVEL=DEBUG, and then only for a
+                    LOG_TRACE_SAMPLE fraction of the requests, decided once per request so a sampled request
+                    is traced on every line. With tracing off a trace call is a level check and nothing else:
+                    messages use %-style arguments and are only formatted when a record is written.
+"""
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # DEBUG turns the per-request traces on
+LOG_TRACE_SAMPLE = float(os.getenv("LOG_TRACE_SAMPLE", "1.0"))  # fraction of requests traced at DEBUG
+LOG_FILE = os.getenv("LOG_FILE")  # unset: stdout
+LOG_BATCH = 1000  # records written per flush at most
+
+_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_configured = False
+_configure_lock = threading.Lock()
+_request = threading.local()
+
+
+class _TraceSampler(logging.Filter):
+    def filter(self, record):
+        return getattr(_request, "sampled", True)
+
+
+class _Writer(threading.Thread):
+    # drains the queue filled by the QueueHandler and writes the records in batches
+    def __init__(self, records, stream):
+        super().__init__(daemon=True)
+        self.records = records
+        self.stream = stream
+        self.formatter = logging.Formatter(_FORMAT)
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = [self.formatter.format(record) + "\n" for record in batch if record is not None]
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass  # a closed stdout must not take the node down
+            if stop:
+                return
+
+    def stop(self):
+        self.records.put(None)
+        self.join(timeout=2)
+
+
+def _configure():
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        records = queue.SimpleQueue()
+        stream = open(LOG_FILE, "a", encoding="utf-8") if LOG_FILE else sys.stdout
+        writer = _Writer(records, stream)
+        writer.start()
+        atexit.register(writer.stop)  # write out what is still queued
+
+        root = logging.getLogger("dht")
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(QueueHandler(records))
+        root.propagate = False
+        # the per-request access lines of the development server are traces too
+        logging.getLogger("werkzeug").setLevel(logging.INFO if root.isEnabledFor(logging.DEBUG) else logging.WARNING)
+        _configured = True
+
+
+def get_logger(name):
+    _configure()
+    return logging.getLogger(f"dht.{name}")
+
+
+def get_tracer(name):
+    _configure()
+    tracer = logging.getLogger(f"dht.trace.{name}")
+    if not tracer.filters:
+        tracer.addFilter(_TraceSampler())
+    return tracer
+
+
+def start_request():
+    # Flask before_request hook: decides whether the request now served by this thread (or greenlet) is traced
+    if LOG_TRACE_SAMPLE < 1.0 and logging.getLogger("dht").isEnabledFor(logging.DEBUG):
+        _request.sampled = random.random() < LOG_TRACE_SAMPLE
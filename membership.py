@@ -0,0 +1,111 @@
+import bisect
+import threading
+
+import requests
+
+import http_pool
+import keyspace
+import log
+import utils
+
+"""
+Membership view of a node: the nodes of the ring sorted by key and the cluster settings (replication factor k and
+consistency model), versioned with an epoch.
+
+The bootstrap node owns the membership and the settings. Every join, departure and /config change advances its
+epoch, the new view is handed to the joining node in the /join_network response and pushed to every other node's
+/membership in the background. A node only applies a view newer than the one it has, so pushes that arrive out of
+order are harmless. Data operations (e.g. clamping the replication chain of a delete to the ring size, or picking the
+consistency model of an insert) read the local view and never call the bootstrap.
+
+read_k is the part of a key's chain that serves CRAQ reads. When k grows, writes go down the longer chain at once but
+the new replicas only have their ranges once they pulled them, so read_k stays at the old k until every node
+reported its resize to the bootstrap, which then publishes read_k = k with the next epoch.
+"""
+
+CONSISTENCY_MODELS = ("chain replication", "eventual consistency")
+
+logger = log.get_logger("membership")
+
+
+class MembershipView:
+    def __init__(self, k=utils.k, consistency=utils.consistency):
+        self._lock = threading.Lock()
+        self.epoch = 0
+        self._ring = []  # [[ip, port], ...] sorted by key
+        self._positions = []  # ring positions of the members, ascending, computed once per view for chain()
+        self._members = []  # the members in the order of _positions
+        self.k = k  # settings from the environment until the first view arrives
+        self.read_k = k
+        self.consistency = consistency
+
+    def apply(self, view):
+        # installs a view received from the bootstrap, False if it is not newer than the current one
+        with self._lock:
+            if view["epoch"] <= self.epoch:
+                return False
+            self.epoch = view["epoch"]
+            self._ring = [list(member) for member in view["ring"]]
+            self._index()
+            self.k = view.get("k", self.k)
+            self.read_k = min(view.get("read_k", self.k), self.k)
+            self.consistency = view.get("consistency", self.consistency)
+            return True
+
+    def advance(self, ring=None, k=None, consistency=None, read_k=None):
+        # bootstrap side: a join, departure or settings change happened, the new view gets the next epoch
+        with self._lock:
+            self.epoch += 1
+            if ring is not None:
+                self._ring = [list(member) for member in ring]
+                self._index()
+            self.k = k if k is not None else self.k
+            self.read_k = min(read_k if read_k is not None else self.read_k, self.k)
+            self.consistency = consistency if consistency is not None else self.consistency
+            return self._snapshot()
+
+    def _index(self):
+        members = sorted(self._ring, key=keyspace.address_id)
+        self._positions = [keyspace.address_id(member) for member in members]
+        self._members = members
+
+    def chain(self, key, k):
+        # [ip, port] of the nodes holding the key under replication factor k, primary first
+        with self._lock:
+            if not self._members:
+                return []
+            index = bisect.bisect_left(self._positions, key) % len(self._members)
+            return [self._members[(index + step) % len(self._members)] for step in range(min(k, len(self._members)))]
+
+    def _snapshot(self):
+        return {"epoch": self.epoch, "ring": list(self._ring), "k": self.k, "read_k": self.read_k, "consistency": self.consistency}
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def settings(self):
+        # (k, consistency) of the cluster, read together so a concurrent change is never seen half applied
+        with self._lock:
+            return self.k, self.consistency
+
+    def ring(self):
+        with self._lock:
+            return list(self._ring)
+
+    def size(self):
+        return max(1, len(self._ring))  # a node that has not received a view yet only knows itself
+
+
+def push(view, exclude=()):
+    # sends the view to every member except the excluded [ip, port]s, without holding up the caller
+    def send():
+        for member in view["ring"]:
+            if [member[0], str(member[1])] in [[ip, str(port)] for ip, port in exclude]:
+                continue
+            try:
+                http_pool.post(f"http://{member[0]}:{member[1]}/membership", json=view).raise_for_status()
+            except requests.RequestException as e:
+                logger.warning("Failed to push membership epoch %s to %s:%s: %s", view["epoch"], member[0], member[1], str(e))
+
+    threading.Thread(target=send, daemon=True).start()
@@ -0,0 +1,195 @@
+import bisect
+import threading
+import time
+
+from flask import g, request
+
+import craq
+
+"""
+Request metrics of a node, exposed on /metrics in the Prometheus text format.
+
+  dht_requests_total{route,status}                  requests served, by Flask endpoint and HTTP status
+  dht_requests_in_flight{route}                     requests being served right now
+  dht_request_latency_seconds{route}                handler latency histogram
+  dht_peer_request_latency_seconds{peer}            latency of the calls this node makes to other nodes (http_pool)
+  dht_peer_request_failures_total{peer}             calls to other nodes that raised
+  dht_replication_lag_seconds{consistency}          chain replication: head to tail acknowledgement of a write,
+                                                    eventual consistency: enqueue to ship delay of a queue batch
+  dht_replication_queue_depth / _lag_seconds        the eventual consistency queue when /metrics is scraped
+  dht_craq_dirty_keys                               keys with a chain replicated write not yet acknowledged by the tail
+  dht_chain_outbox_depth                            chain replication updates waiting to be shipped to the successor
+
+Every histogram also comes with a *_quantile_seconds gauge holding its p50/p95/p99, estimated from the buckets the
+same way Prometheus' histogram_quantile does. Recording a request is a bisect and a few additions under a lock, no
+formatting happens until /metrics is scraped. Latency of streamed responses (/transfer_range, query * as NDJSON) is
+the time to the first byte.
+"""
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [count per bucket, the last one +Inf], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _snapshot(self):
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def quantile(self, q, counts):
+        # linear interpolation inside the bucket holding the q-th observation, +Inf answers the highest bound
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def render(self):
+        lines = []
+        for labels, (counts, total) in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+    def render_quantiles(self):
+        lines = []
+        for labels, (counts, _) in sorted(self._snapshot().items()):
+            for q in QUANTILES:
+                lines.append(f"{self.name.replace('_seconds', '_quantile_seconds')}{_labels(self.label_names, labels, [('quantile', q)])} {self.quantile(q, counts)}")
+        return lines
+
+
+REQUESTS = Counter("dht_requests_total", "Requests served by route and status", ("route", "status"))
+IN_FLIGHT = Gauge("dht_requests_in_flight", "Requests being served", ("route",))
+LATENCY = Histogram("dht_request_latency_seconds", "Request handler latency", ("route",))
+PEER_LATENCY = Histogram("dht_peer_request_latency_seconds", "Latency of calls to other nodes", ("peer",))
+PEER_FAILURES = Counter("dht_peer_request_failures_total", "Calls to other nodes that failed", ("peer",))
+REPLICATION_LAG = Histogram("dht_replication_lag_seconds", "Replication delay by consistency model", ("consistency",))
+QUEUE_DEPTH = Gauge("dht_replication_queue_depth", "Updates waiting in the eventual consistency replication queue")
+QUEUE_LAG = Gauge("dht_replication_queue_lag_seconds", "Age of the oldest update waiting in the replication queue")
+CHAIN_OUTBOX = Gauge("dht_chain_outbox_depth", "Chain replication updates waiting to be shipped to the successor")
+DIRTY_KEYS = Gauge("dht_craq_dirty_keys", "Keys whose latest chain replicated write the tail has not acknowledged yet")
+
+_HISTOGRAMS = (LATENCY, PEER_LATENCY, REPLICATION_LAG)
+_ALL = (REQUESTS, IN_FLIGHT, LATENCY, PEER_LATENCY, PEER_FAILURES, REPLICATION_LAG, QUEUE_DEPTH, QUEUE_LAG, DIRTY_KEYS, CHAIN_OUTBOX)
+
+
+def _start_request():
+    g.metrics_route = request.endpoint or "unknown"
+    g.metrics_started = time.perf_counter()
+    IN_FLIGHT.inc(g.metrics_route)
+
+
+def _end_request(response):
+    route = g.get("metrics_route")
+    if route is not None and not g.get("metrics_counted"):
+        LATENCY.observe(time.perf_counter() - g.metrics_started, route)
+        REQUESTS.inc(route, response.status_code)
+        g.metrics_counted = True
+    return response
+
+
+def _teardown_request(error=None):
+    # runs for every request, also when the handler raised and Flask skipped the after_request hooks
+    route = g.pop("metrics_route", None)
+    if route is None:
+        return
+    IN_FLIGHT.dec(route)
+    if not g.pop("metrics_counted", False):
+        LATENCY.observe(time.perf_counter() - g.metrics_started, route)
+        REQUESTS.inc(route, 500)
+
+
+def instrument(app):
+    # registers the hooks that count and time every request of the app
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_teardown_request)
+
+
+def render(replication=None, pipeline=None):
+    if replication is not None:
+        stats = replication.stats()
+        QUEUE_DEPTH.set(stats["depth"])
+        QUEUE_LAG.set(stats["lag_seconds"])
+    if pipeline is not None:
+        CHAIN_OUTBOX.set(pipeline.stats()["outbox"])
+    DIRTY_KEYS.set(craq.dirty_count())
+    lines = []
+    for metric in _ALL:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for histogram in _HISTOGRAMS:
+        name = histogram.name.replace('_seconds', '_quantile_seconds')
+        lines.append(f"# HELP {name} p50/p95/p99 of {histogram.name}, estimated from its buckets")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(histogram.render_quantiles())
+    return "\n".join(lines) + "\n"
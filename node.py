@@ -1,25 +1,34 @@
 from utils import hash_function,get_local_ip
+import keyspace
+import log
+import storage
 
 """ 
 Each Node is a FLASK server, so this Class Implements the Node as a unit of the DHT. The logic is implemented
 in the API. From the API we know which nodes to reach out to ...
 """
+
+trace = log.get_tracer("node")
    
 class Node:
     def __init__(self,identifier = None,ip = None,port = None,predecessor = [], successor = [], song_list = {}):
         self.ip = get_local_ip()
         self.port = port
         self.identifier = hash_function(f'{self.ip}:{self.port}')
-        self._predecessor = predecessor      
-        self._successor = successor 
-        self._song_list = song_list
+        self.key = keyspace.from_hex(self.identifier) # ring position as an int, used for routing
+        self.set_predecessor(predecessor)
+        self.set_successor(successor)
+        self._song_list = storage.open_store(f'{self.ip}_{self.port}', song_list) # song_name -> value, indexed by ring position for range handoff
+        self._finger_table = [] # (ring position, [ip, port]) for each of the 160 fingers, kept fresh by chord.fix_fingers
+        self._written = None # songs written while a join reconciles its replica window, see handoff.pull_range
         
     def insert(self, key, value:int):
+        self._track_write(key)
         if key not in self._song_list:
             self._song_list[key] = value
         else:
             self._song_list[key] += value
-        print(f"Song {value} added to {key}\n")
+        trace.debug("Song %s added to %s", value, key)
         
     
     def query(self,key):
@@ -27,7 +36,7 @@ class Node:
             return self._song_list
         else:
             if key in self._song_list:
-                print(f"Song found in this node {self.identifier}\n")
+                trace.debug("Song found in this node %s", self.identifier)
                 return key, self._song_list[key]
             else:
                 return None
@@ -35,27 +44,48 @@ class Node:
     
     def delete(self,key) -> bool:
         # We want to delete the song_name and its value from the song_list 
+        self._track_write(key)
         if key in self._song_list:
             del self._song_list[key]
-            print(f"Song {key} deleted from this node {self.identifier}\n")
+            trace.debug("Song %s deleted from this node %s", key, self.identifier)
             return True
         else:
-            print(f"Song not found in this node {self.identifier}\n")
+            trace.debug("Song not found in this node %s", self.identifier)
             return False
            
         
     def set_predecessor(self,predecessor):
         self._predecessor = predecessor
+        self._predecessor_key = keyspace.address_id(predecessor) # hashed once here, not on every request
     
     def set_successor(self,successor):
         self._successor = successor
+        self._successor_key = keyspace.address_id(successor)
+    
     
+    def set_finger_table(self,finger_table):
+        self._finger_table = finger_table
     
     def set_song_list(self,song_list):
-        self._song_list = song_list
+        self._song_list.replace(song_list)
     
     def set_song_to_song_list(self,key,value):
+        self._track_write(key)
         self._song_list[key] = value
+    
+    def _track_write(self,key):
+        if self._written is not None:
+            self._written.add(key)
+    
+    def start_tracking_writes(self):
+        self._written = set()
+    
+    def stop_tracking_writes(self):
+        self._written = None
+    
+    def written_since_tracking(self):
+        # names of the songs written since start_tracking_writes, the set keeps growing until tracking stops
+        return self._written if self._written is not None else set()
         
     def get_predecessor(self):
         return self._predecessor
@@ -64,8 +94,20 @@ class Node:
     def get_successor(self):
         return self._successor
      
+    def get_finger_table(self):
+        return self._finger_table
+     
     def get_identifier(self):
         return self.identifier
+    
+    def get_key(self):
+        return self.key
+    
+    def get_predecessor_key(self):
+        return self._predecessor_key
+    
+    def get_successor_key(self):
+        return self._successor_key
      
     def get_ip(self):
         return self.ip
@@ -81,7 +123,6 @@ class Node:
 class BootstrapNode(Node):
     def __init__(self,identifier,host,port):
         super().__init__(identifier,host,port)
-        self._predecessor = None
-        self._successor = None
-        self._song_list = {}
+        self.set_predecessor(None)
+        self.set_successor(None)
         self._replica_list = {}        
\ No newline at end of file
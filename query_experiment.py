@@ -6,6 +6,8 @@ import concurrent.futures
 import requests
 import urllib
 
+from local_cluster import configure
+
 # Mapping of node IDs to their IP and port.
 node_mapping = {
     "00": ('10.0.17.96', 5000),
@@ -68,9 +70,11 @@ def run_experiment(config):
     """
     Starts concurrent inserts from all nodes, measures total elapsed time, subtracts file-read time,
     and then calculates throughput based on the effective insertion time.
-    Assumes that nodes are preconfigured with config's 'consistency' and replication factor 'k'.
+    The ring is first switched to config's 'consistency' and replication factor 'k' (POST /config), so all
+    experiments run one after the other against the same live ring.
     """
     print(f"Running experiment with config: {config}")
+    configure([f"http://{ip}:{port}" for ip, port in node_mapping.values()], config["k"], config["consistency"])
     total_inserts = 0
     total_file_read_time = 0.0
     start_time = time.time()
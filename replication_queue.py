@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import http_pool
+import keyspace
+import log
+import metrics
+
+"""
+Background replication for eventual consistency.
+
+Instead of a new thread per insert/delete, updates are put on a per-node queue drained by a fixed pool of workers.
+Keys are partitioned over the workers by hash, so updates to one key are always shipped by the same worker, in order.
+While an update waits in the queue a newer update to the same key replaces it (write coalescing), and every worker
+ships what it has collected as one /batch/eventual_insertion and one /batch/eventual_deletion packet to the successor.
+"""
+
+WORKERS = int(os.getenv("REPLICATION_WORKERS", "4"))
+BATCH_SIZE = int(os.getenv("REPLICATION_BATCH_SIZE", "500"))  # updates per packet
+QUEUE_LIMIT = int(os.getenv("REPLICATION_QUEUE_LIMIT", "100000"))  # pending keys before enqueue blocks (back-pressure)
+MAX_RETRIES = int(os.getenv("REPLICATION_MAX_RETRIES", "5"))
+
+logger = log.get_logger("replication")
+
+
+class ReplicationQueue:
+    def __init__(self, node, workers=WORKERS, batch_size=BATCH_SIZE, queue_limit=QUEUE_LIMIT):
+        self.node = node
+        self.batch_size = batch_size
+        self.partition_limit = max(1, queue_limit // workers)
+        # one ordered map song_name -> (op, value, k, enqueued_at, attempts) per worker
+        self._partitions = [OrderedDict() for _ in range(workers)]
+        self._conditions = [threading.Condition() for _ in range(workers)]
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.coalesced = 0
+        self.shipped = 0
+        self.failed = 0
+        self._last_ship_lag = 0.0
+        for index in range(workers):
+            threading.Thread(target=self._worker, args=(index,), daemon=True).start()
+
+    def _partition(self, song_name):
+        return keyspace.key_id(song_name) % len(self._partitions)
+
+    def enqueue(self, song_name, op, value, k):
+        # op is "insert" or "delete", k the number of nodes after this one that still need the update
+        if k <= 0:
+            return
+        index = self._partition(song_name)
+        pending = self._partitions[index]
+        with self._conditions[index]:
+            if song_name in pending:
+                # coalesce: keep the queue position and age of the first update, ship only the latest value
+                enqueued_at = pending[song_name][3]
+                pending[song_name] = (op, value, k, enqueued_at, 0)
+                with self._stats_lock:
+                    self.coalesced += 1
+            else:
+                while len(pending) >= self.partition_limit:
+                    self._conditions[index].wait()
+                pending[song_name] = (op, value, k, time.time(), 0)
+            with self._stats_lock:
+                self.enqueued += 1
+            self._conditions[index].notify_all()
+
+    def _take(self, index):
+        pending = self._partitions[index]
+        with self._conditions[index]:
+            while not pending:
+                self._conditions[index].wait()
+            taken = []
+            while pending and len(taken) < self.batch_size:
+                taken.append(pending.popitem(last=False))
+            self._conditions[index].notify_all()  # wake up producers blocked on a full partition
+            return taken
+
+    def _ship(self, taken):
+        successor = self.node.get_successor()
+        if not successor or successor == []:
+            return
+        packets = {}
+        for song_name, (op, value, k, _, _) in taken:
+            path = "/batch/eventual_insertion" if op == "insert" else "/batch/eventual_deletion"
+            packet = packets.setdefault((path, k), {"items": {}} if op == "insert" else {"keys": []})
+            if op == "insert":
+                packet["items"][song_name] = value
+            else:
+                packet["keys"].append(song_name)
+        for (path, k), packet in packets.items():
+            packet["k"] = k
+            response = http_pool.post(f"http://{successor[0]}:{successor[1]}{path}", json=packet)
+            response.raise_for_status()
+
+    def _worker(self, index):
+        while True:
+            taken = self._take(index)
+            try:
+                self._ship(taken)
+                with self._stats_lock:
+                    self.shipped += len(taken)
+                    self._last_ship_lag = time.time() - min(entry[3] for _, entry in taken)
+                metrics.REPLICATION_LAG.observe(self._last_ship_lag, "eventual consistency")
+            except requests.RequestException as e:
+                logger.warning("Replication batch to successor failed: %s", str(e))
+                self._retry(index, taken)
+
+    def _retry(self, index, taken):
+        # a batch mixes fresh updates and ones that failed before, every update counts its own attempts
+        pending = self._partitions[index]
+        time.sleep(0.1 * max(entry[4] + 1 for _, entry in taken))
+        with self._conditions[index]:
+            for song_name, (op, value, k, enqueued_at, attempts) in taken:
+                attempts += 1
+                if attempts > MAX_RETRIES:
+                    with self._stats_lock:
+                        self.failed += 1
+                elif song_name not in pending:  # a newer update to the key supersedes the failed one
+                    pending[song_name] = (op, value, k, enqueued_at, attempts)
+            self._conditions[index].notify_all()
+
+    def depth(self):
+        return sum(len(pending) for pending in self._partitions)
+
+    def lag(self):
+        # age in seconds of the oldest update still waiting to be shipped
+        now = time.time()
+        oldest = [next(iter(pending.values()))[3] for pending in self._partitions if pending]
+        return now - min(oldest) if oldest else 0.0
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "workers": len(self._partitions),
+                "depth": self.depth(),
+                "lag_seconds": self.lag(),
+                "last_ship_lag_seconds": self._last_ship_lag,
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "shipped": self.shipped,
+                "failed": self.failed,
+            }
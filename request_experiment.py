@@ -3,6 +3,7 @@ import time
 import random
 import requests
 import urllib.parse
+from dht_client import DHTClient
 
 # Node mapping for our 10 nodes.
 node_mapping = {
@@ -20,6 +21,10 @@ node_mapping = {
 
 REQUESTS_DIR = "./"
 
+# Route every request straight to the owner of the key with a cached ring instead of a random node
+SMART_CLIENT = False
+smart_client = DHTClient("http://%s:%d" % node_mapping["00"]) if SMART_CLIENT else None
+
 def get_random_node():
     """
     Returns a random node_id from the node_mapping
@@ -57,7 +62,7 @@ def process_request(request_line, expected_values):
         url = requests.utils.requote_uri(url)
         
         try:
-            response = requests.post(url)
+            response = smart_client.insert(key, value) if smart_client else requests.post(url)
             if response.status_code == 200:
                 success = 1
                 print(f"Node {node_id} successful insert '{key}': {value}")
@@ -73,7 +78,7 @@ def process_request(request_line, expected_values):
         url = requests.utils.requote_uri(url)
         
         try:
-            response = requests.get(url)
+            response = smart_client.query(key) if smart_client else requests.get(url)
             if response.status_code == 200:
                 success = 1
                 try:
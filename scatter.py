@@ -0,0 +1,143 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_pool
+import keyspace
+import log
+
+"""
+query * over the whole ring.
+
+The entry node splits the ring by its membership view into the primary ranges of the nodes, (predecessor, node], and
+reads every range from its primary with /transfer_range. Each song therefore comes back exactly once, from its
+primary. When a primary does not answer within SCATTER_TIMEOUT its range is read from the next replicas in ring
+order instead. Three ways to read the ring:
+
+  query_all:  every range at once, SCATTER_CONCURRENCY in parallel, merged into one dict (GET /query/*)
+  query_page: the songs after a cursor in ring position order, at most limit of them (GET /query/*?cursor=&limit=)
+  stream_all: every song as NDJSON in ring position order, range after range, each range relayed line by line as
+              it arrives from its primary, so neither the entry node nor the client holds the whole dump
+              (GET /query/*?format=ndjson)
+"""
+
+SCATTER_CONCURRENCY = int(os.getenv("SCATTER_CONCURRENCY", "16"))  # ranges fetched at the same time
+SCATTER_TIMEOUT = float(os.getenv("SCATTER_TIMEOUT", "10"))  # seconds to wait for one node
+PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", "1000"))  # songs per page when the client gives a cursor but no limit
+
+logger = log.get_logger("scatter")
+
+
+def _members(node, ring):
+    # the membership view sorted by key, just this node before it joined
+    return sorted(ring, key=keyspace.address_id) or [[node.get_ip(), node.get_port()]]
+
+
+def _intervals(members):
+    # [(low, high, primary)] covering the ring in position order from 0, low -1 means position 0 is included; the
+    # primary range of the first node wraps around 0 and is cut in two, its start and the end of the ring
+    keys = [keyspace.address_id(member) for member in members]
+    intervals = [(-1, keys[0], 0)]
+    intervals += [(keys[index - 1], keys[index], index) for index in range(1, len(keys))]
+    if keys[-1] < keyspace.SIZE - 1:
+        intervals.append((keys[-1], keyspace.SIZE - 1, 0))
+    return intervals
+
+
+def _range_params(low, high, limit=None):
+    # (SIZE - 1, high] wraps around to [0, high], that is how a range starting at position 0 goes on the wire
+    params = {"start": keyspace.to_hex(keyspace.SIZE - 1 if low < 0 else low), "end": keyspace.to_hex(high)}
+    if limit is not None:
+        params["limit"] = limit
+    return params
+
+
+def _is_local(node, member):
+    return keyspace.address_id(member) == node.get_key()
+
+
+def _fetch_range(node, member, low, high, limit=None):
+    if _is_local(node, member):
+        return node.get_song_list().range_items(keyspace.SIZE - 1 if low < 0 else low, high, limit)
+    response = http_pool.get(f"http://{member[0]}:{member[1]}/transfer_range", params=_range_params(low, high, limit),
+                             timeout=(http_pool.CONNECT_TIMEOUT, SCATTER_TIMEOUT))
+    response.raise_for_status()
+    songs = []
+    for line in response.iter_lines():
+        if line:
+            song = json.loads(line)
+            songs.append((song["song_name"], song["value"]))
+    return songs
+
+
+def _read_range(node, members, primary, low, high, k, limit=None):
+    # the range from its primary, or from the nodes that hold copies of it when the primary does not answer
+    error = None
+    for replica in range(min(k, len(members))):
+        try:
+            return _fetch_range(node, members[(primary + replica) % len(members)], low, high, limit)
+        except requests.RequestException as e:
+            error = e
+    raise error
+
+
+def query_all(node, ring, k):
+    # every song of the ring once, ring is the membership view [[ip, port], ...]
+    members = _members(node, ring)
+    intervals = _intervals(members)
+    songs = {}
+    with ThreadPoolExecutor(max_workers=min(SCATTER_CONCURRENCY, len(intervals))) as executor:
+        for part in executor.map(lambda interval: _read_range(node, members, interval[2], interval[0], interval[1], k), intervals):
+            songs.update(part)
+    return songs
+
+
+def query_page(node, ring, k, cursor, limit):
+    """
+    The first limit songs after the ring position cursor (None: from the start of the ring), in position order.
+    Returns them with the cursor of the next page, None once the end of the ring was reached.
+    """
+    position = -1 if cursor is None else cursor
+    songs = []
+    members = _members(node, ring)
+    for low, high, primary in _intervals(members):
+        if high <= position:
+            continue
+        songs.extend(_read_range(node, members, primary, max(low, position), high, k, limit - len(songs)))
+        if len(songs) >= limit:
+            return songs, keyspace.key_id(songs[-1][0])
+    return songs, None
+
+
+def _stream_range(node, member, low, high):
+    if _is_local(node, member):
+        yield from node.get_song_list().ndjson_range(keyspace.SIZE - 1 if low < 0 else low, high)
+        return
+    with http_pool.get(f"http://{member[0]}:{member[1]}/transfer_range", params=_range_params(low, high), stream=True,
+                       timeout=(http_pool.CONNECT_TIMEOUT, SCATTER_TIMEOUT)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield line + b"\n"
+
+
+def stream_all(node, ring, k):
+    # NDJSON lines of every song in position order; a replica that takes over a range resumes after the last song sent
+    members = _members(node, ring)
+    for low, high, primary in _intervals(members):
+        position, last, error = low, None, None
+        for replica in range(min(k, len(members))):
+            try:
+                for line in _stream_range(node, members[(primary + replica) % len(members)], position, high):
+                    last = line
+                    yield line
+                break
+            except requests.RequestException as e:
+                error = e
+                if last is not None:
+                    position = keyspace.key_id(json.loads(last)["song_name"])
+        else:
+            logger.warning("query * stream cut short, no replica of (%040x, %040x] answered: %s", max(low, 0), high, str(error))
+            raise error  # aborts the response, the client sees a truncated stream instead of a silently short one
@@ -1,19 +1,24 @@
-import matplotlib.pyplot as plt
+import glob
+import json
+import sys
 
-# Incorporate the baseline throughput into both lines at k=1
-k_chain = [1, 3, 5]
-throughput_chain = [182.12, 140.50, 106.04]
+import matplotlib.pyplot as plt
 
-k_eventual = [1, 3, 5]
-throughput_eventual = [186.41, 262.48, 415.90]
+# benchmark.py results of the query workload, one file per (k, consistency model): the files given on the command
+# line or every results/*.json
+files = sys.argv[1:] or glob.glob("results/*.json")
+throughput = {}  # consistency model -> {k: queries/sec}
+for file_name in files:
+    with open(file_name) as f:
+        result = json.load(f)
+    if result["config"]["workload"] == "query":
+        throughput.setdefault(result["config"]["consistency"], {})[result["config"]["k"]] = result["throughput"]
 
 plt.figure()
 
-# Plot Chain Replication
-plt.plot(k_chain, throughput_chain, marker='o', label='Chain Replication')
-
-# Plot Eventual Consistency
-plt.plot(k_eventual, throughput_eventual, marker='o', label='Eventual Consistency')
+for consistency, label in (("chain replication", 'Chain Replication'), ("eventual consistency", 'Eventual Consistency')):
+    k_values = sorted(throughput.get(consistency, {}))
+    plt.plot(k_values, [throughput[consistency][k] for k in k_values], marker='o', label=label)
 
 # Diagram settings
 plt.xlabel('k (Replication Factor)')
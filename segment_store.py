@@ -0,0 +1,370 @@
+import bisect
+import glob
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from sortedcontainers import SortedList
+
+import keyspace
+import log
+from storage import WAL_FSYNC, SongStore, WriteAheadLog, generation_of
+
+"""
+Song storage for nodes whose songs do not fit in memory (STORAGE_ENGINE=segments).
+
+Writes go to a memtable (the recent, hot songs, logged to a WriteAheadLog). Once it holds MEMTABLE_LIMIT songs it is
+frozen, a fresh memtable takes the writes and a background thread writes the frozen one out as an immutable segment
+file; writes only wait for it when MAX_FROZEN_MEMTABLES are still waiting. A segment stores its records sorted by ring position and is
+memory-mapped, only a sparse index with every SPARSE_INDEX_INTERVAL-th position is kept in memory, so cold songs stay
+on disk until a lookup or a range scan pages them in. Deletes are tombstones. When there are more than MAX_SEGMENTS
+segments the background thread merges them into one and drops the tombstones; the new segment is written without
+holding the store lock and swapped in under it, so reads and writes go on meanwhile. MANIFEST lists the live segments and the first
+log generation not contained in them. It is replaced atomically, so a crash in the middle of a flush or a merge
+leaves the previous segments and logs in charge.
+
+Segment file: records (20 byte ring position, tombstone flag, name length, value length, name, JSON value) sorted by
+(position, name), then the sparse index (position, record offset), then a footer.
+"""
+
+MEMTABLE_LIMIT = int(os.getenv("MEMTABLE_LIMIT", "100000"))  # songs buffered in memory before a segment is written
+SPARSE_INDEX_INTERVAL = int(os.getenv("SPARSE_INDEX_INTERVAL", "16"))  # records per sparse index entry
+MAX_SEGMENTS = int(os.getenv("MAX_SEGMENTS", "8"))  # segments before they are merged
+MAX_FROZEN_MEMTABLES = 2  # full memtables waiting for the background flush before writes wait for it
+
+_RECORD = struct.Struct(">20sBHI")  # ring position, tombstone flag, name length, value length
+_INDEX_ENTRY = struct.Struct(">20sQ")  # ring position, record offset
+_FOOTER = struct.Struct(">QQQ8s")  # index offset, index entries, records, magic
+_MAGIC = b"DHTSEG01"
+
+TOMBSTONE = object()
+
+logger = log.get_logger("segment_store")
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, entries, self.records, magic = _FOOTER.unpack_from(self._map, len(self._map) - _FOOTER.size)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a segment file")
+        self._data_end = index_offset
+        self._positions = []
+        self._offsets = []
+        for i in range(entries):
+            position, offset = _INDEX_ENTRY.unpack_from(self._map, index_offset + i * _INDEX_ENTRY.size)
+            self._positions.append(int.from_bytes(position, 'big'))
+            self._offsets.append(offset)
+
+    @staticmethod
+    def write(path, records):
+        # records: (position, song_name, value or TOMBSTONE) sorted by (position, song_name), returns the count
+        temporary = path + ".tmp"
+        index = []
+        offset = 0
+        count = 0
+        with open(temporary, "wb") as segment:
+            for position, song_name, value in records:
+                if count % SPARSE_INDEX_INTERVAL == 0:
+                    index.append((position, offset))
+                name = song_name.encode('utf-8')
+                data = b"" if value is TOMBSTONE else json.dumps(value).encode('utf-8')
+                segment.write(_RECORD.pack(position.to_bytes(20, 'big'), value is TOMBSTONE, len(name), len(data)))
+                segment.write(name)
+                segment.write(data)
+                offset += _RECORD.size + len(name) + len(data)
+                count += 1
+            for position, record_offset in index:
+                segment.write(_INDEX_ENTRY.pack(position.to_bytes(20, 'big'), record_offset))
+            segment.write(_FOOTER.pack(offset, len(index), count, _MAGIC))
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(temporary, path)
+        return count
+
+    def _read(self, offset):
+        position, tombstone, name_length, value_length = _RECORD.unpack_from(self._map, offset)
+        offset += _RECORD.size
+        song_name = self._map[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        value = TOMBSTONE if tombstone else json.loads(self._map[offset:offset + value_length])
+        return int.from_bytes(position, 'big'), song_name, value, offset + value_length
+
+    def scan(self, low, high):
+        # records with low < position <= high, in order; only the pages holding them are read
+        block = bisect.bisect_right(self._positions, low) - 1
+        offset = self._offsets[block] if block >= 0 else 0
+        while offset < self._data_end:
+            position, song_name, value, offset = self._read(offset)
+            if position > high:
+                return
+            if position > low:
+                yield position, song_name, value
+
+    def get(self, position, song_name):
+        # (found, value), value may be TOMBSTONE; compares the raw headers and only decodes the matching record
+        key = position.to_bytes(20, 'big')
+        name = song_name.encode('utf-8')
+        block = bisect.bisect_left(self._positions, position) - 1
+        offset = self._offsets[block] if block >= 0 else 0
+        while offset < self._data_end:
+            raw_position, tombstone, name_length, value_length = _RECORD.unpack_from(self._map, offset)
+            if raw_position > key:
+                break
+            offset += _RECORD.size
+            if raw_position == key and self._map[offset:offset + name_length] == name:
+                offset += name_length
+                return True, TOMBSTONE if tombstone else json.loads(self._map[offset:offset + value_length])
+            offset += name_length + value_length
+        return False, None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _memtable_scan(memtable, index, low, high):
+    # (position, song_name, value or TOMBSTONE) of a memtable with low < position <= high, in order
+    for position, song_name in index.irange((low + 1,), (high + 1,), inclusive=(True, False)):
+        yield position, song_name, memtable[song_name]
+
+
+def _aged(age, records):
+    # (position, song_name, age, value) for merging sources, the lowest age (newest source) wins a tie
+    for position, song_name, value in records:
+        yield position, song_name, age, value
+
+
+class SegmentStore(SongStore):
+    def __init__(self, path, fsync=WAL_FSYNC):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._maintenance = threading.Lock()  # held by a flush or merge in progress, and by replace
+        self._changed = threading.Condition(self._lock)  # a memtable was frozen or flushed, or a merge is due
+        self._memtable = {}  # song_name -> value or TOMBSTONE
+        self._memtable_index = SortedList()  # (ring position, song_name)
+        self._frozen = []  # (memtable, index, first log generation after it), oldest first, waiting to be flushed
+        self._count = None  # live songs, counted once the logs are replayed and kept up to date by every write
+        manifest = self._read_manifest()
+        self._segments = [Segment(os.path.join(path, name)) for name in manifest["segments"]]  # oldest first
+        self._wal_from = manifest["wal_from"]
+        for orphan in glob.glob(os.path.join(path, "seg-*.dat*")):
+            if os.path.basename(orphan) not in manifest["segments"]:
+                os.remove(orphan)  # left behind by a flush or merge that did not finish
+        replayed = 0
+        for record in WriteAheadLog.replay(path, self._wal_from):
+            self._apply(record)
+            replayed += 1
+        self._count = sum(1 for _ in self._scan(None, None))
+        logger.info("Opened %s segments in %s (%s log records replayed)", len(self._segments), path, replayed)
+        self._wal = WriteAheadLog(path, WriteAheadLog.last_generation(path, self._wal_from), fsync)
+        threading.Thread(target=self._maintain, daemon=True).start()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, "MANIFEST"), encoding="utf-8") as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            return {"segments": [], "wal_from": 0}
+
+    def _write_manifest(self, segments, wal_from):
+        temporary = os.path.join(self.path, "MANIFEST.tmp")
+        with open(temporary, "w", encoding="utf-8") as manifest:
+            json.dump({"segments": [os.path.basename(segment.path) for segment in segments], "wal_from": wal_from}, manifest)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.replace(temporary, os.path.join(self.path, "MANIFEST"))
+        self._segments = segments
+        self._wal_from = wal_from
+
+    def _new_segment_path(self):
+        existing = [generation_of(path) for path in glob.glob(os.path.join(self.path, "seg-*.dat"))]
+        return os.path.join(self.path, f"seg-{max(existing, default=0) + 1:08d}.dat")
+
+    def _apply(self, record):
+        if record["op"] == "set":
+            self._put(record["song_name"], record["value"])
+        elif record["op"] == "del":
+            self._put(record["song_name"], TOMBSTONE)
+        elif record["op"] == "drop":
+            start = record["start"]
+            self._drop(None if start is None else keyspace.from_hex(start), keyspace.from_hex(record["end"]))
+
+    def _put(self, song_name, value):
+        if self._count is not None:
+            self._count += (value is not TOMBSTONE) - (self._lookup(song_name) is not TOMBSTONE)
+        if song_name not in self._memtable:
+            self._memtable_index.add((keyspace.key_id(song_name), song_name))
+        self._memtable[song_name] = value
+
+    def _drop(self, start, end):
+        song_names = [song_name for song_name, _ in self._scan(start, end)]
+        for song_name in song_names:
+            self._put(song_name, TOMBSTONE)
+        return len(song_names)
+
+    def _lookup(self, song_name):
+        for memtable in [self._memtable] + [frozen[0] for frozen in reversed(self._frozen)]:
+            if song_name in memtable:
+                return memtable[song_name]
+        position = keyspace.key_id(song_name)
+        for segment in reversed(self._segments):
+            found, value = segment.get(position, song_name)
+            if found:
+                return value
+        return TOMBSTONE
+
+    def __getitem__(self, song_name):
+        with self._lock:
+            value = self._lookup(song_name)
+        if value is TOMBSTONE:
+            raise KeyError(song_name)
+        return value
+
+    def __contains__(self, song_name):
+        with self._lock:
+            return self._lookup(song_name) is not TOMBSTONE
+
+    def __setitem__(self, song_name, value):
+        with self._lock:
+            self._put(song_name, value)
+            seq = self._wal.append({"op": "set", "song_name": song_name, "value": value})
+            self._maybe_flush()
+        self._wal.wait(seq)
+
+    def __delitem__(self, song_name):
+        with self._lock:
+            if self._lookup(song_name) is TOMBSTONE:
+                raise KeyError(song_name)
+            self._put(song_name, TOMBSTONE)
+            seq = self._wal.append({"op": "del", "song_name": song_name})
+            self._maybe_flush()
+        self._wal.wait(seq)
+
+    def __iter__(self):
+        return iter([song_name for song_name, _ in self.range_items(None, None)])
+
+    def __len__(self):
+        return self._count
+
+    def _scan(self, start, end):
+        # merges the memtable and the segments over (start, end], the newest version of a song wins
+        if start is None or start == end:
+            intervals = [(-1, keyspace.SIZE - 1)]
+        elif start < end:
+            intervals = [(start, end)]
+        else:
+            intervals = [(start, keyspace.SIZE - 1), (-1, end)]  # wraps around 0
+        memtables = [(self._memtable, self._memtable_index)] + [frozen[:2] for frozen in reversed(self._frozen)]
+        for low, high in intervals:
+            sources = [_aged(age, _memtable_scan(memtable, index, low, high)) for age, (memtable, index) in enumerate(memtables)]
+            sources += [_aged(age, segment.scan(low, high)) for age, segment in enumerate(reversed(self._segments), start=len(memtables))]
+            previous = None
+            for position, song_name, _, value in heapq.merge(*sources, key=lambda record: record[:3]):
+                if (position, song_name) == previous:
+                    continue  # an older version of the song
+                previous = (position, song_name)
+                if value is not TOMBSTONE:
+                    yield song_name, value
+
+    def range_items(self, start, end, limit=None):
+        with self._lock:
+            return list(itertools.islice(self._scan(start, end), limit))
+
+    def delete_range(self, start, end):
+        with self._lock:
+            removed = self._drop(start, end)
+            seq = self._wal.append({"op": "drop", "start": None if start is None else keyspace.to_hex(start), "end": keyspace.to_hex(end)})
+            self._maybe_flush()
+        self._wal.wait(seq)
+        return removed
+
+    def defer_sync(self):
+        self._wal.defer()
+
+    def sync(self):
+        self._wal.sync()
+
+    def replace(self, songs):
+        # the new content becomes the only segment
+        with self._maintenance, self._lock:
+            wal_from = self._wal.rotate()
+            path = self._new_segment_path()
+            self._count = Segment.write(path, sorted((keyspace.key_id(song_name), song_name, value) for song_name, value in songs.items()))
+            self._swap_segments([Segment(path)], self._segments, wal_from)
+            self._memtable = {}
+            self._memtable_index = SortedList()
+            self._frozen = []
+            self._changed.notify_all()
+
+    def _maybe_flush(self):
+        # called with the lock held: a full memtable is frozen and handed to the background thread
+        if len(self._memtable) < MEMTABLE_LIMIT:
+            return
+        while len(self._frozen) >= MAX_FROZEN_MEMTABLES:
+            self._changed.wait()  # back-pressure, the flushes fell behind the writes
+        self._frozen.append((self._memtable, self._memtable_index, self._wal.rotate()))
+        self._memtable = {}
+        self._memtable_index = SortedList()
+        self._changed.notify_all()
+
+    def _maintain(self):
+        # background thread: flushes frozen memtables, oldest first, and merges the segments once there are too many
+        while True:
+            with self._lock:
+                while not self._frozen and len(self._segments) <= MAX_SEGMENTS:
+                    self._changed.wait()
+            try:
+                with self._maintenance:
+                    if self._frozen:
+                        self._flush()
+                    elif len(self._segments) > MAX_SEGMENTS:
+                        self._merge()
+            except Exception:
+                logger.exception("Flush or merge in %s failed, retrying", self.path)
+                time.sleep(1)
+
+    def _flush(self):
+        # writes the oldest frozen memtable out as the newest segment, its logs are not needed afterwards
+        with self._lock:
+            memtable, index, wal_from = self._frozen[0]
+            path = self._new_segment_path()
+        Segment.write(path, ((position, song_name, memtable[song_name]) for position, song_name in index))
+        with self._lock:
+            self._swap_segments(self._segments + [Segment(path)], [], wal_from)
+            self._frozen.pop(0)
+            self._changed.notify_all()
+
+    def _merge(self):
+        # every segment is merged, so nothing older is left that a dropped tombstone would have to hide; only the
+        # background thread adds segments, so the list does not change until the merged one is swapped in
+        with self._lock:
+            segments = list(self._segments)
+            path = self._new_segment_path()
+        sources = [_aged(age, segment.scan(-1, keyspace.SIZE - 1)) for age, segment in enumerate(reversed(segments))]
+
+        def newest_live():
+            previous = None
+            for position, song_name, _, value in heapq.merge(*sources, key=lambda record: record[:3]):
+                if (position, song_name) != previous and value is not TOMBSTONE:
+                    yield position, song_name, value
+                previous = (position, song_name)
+
+        Segment.write(path, newest_live())
+        with self._lock:
+            self._swap_segments([Segment(path)], segments, self._wal_from)
+
+    def _swap_segments(self, segments, retired, wal_from):
+        self._write_manifest(segments, wal_from)
+        for segment in retired:
+            segment.close()
+            os.remove(segment.path)
+        self._wal.delete_before(wal_from)
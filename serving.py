@@ -0,0 +1,54 @@
+import os
+import socket
+import sys
+
+"""
+Chooses the server a node (bootstrap or regular) runs on.
+
+threaded: the Werkzeug development server with HTTP/1.1 keep-alive (keep_alive.py), one OS thread per open
+          connection (the default).
+async:    a gevent event loop. Sockets are patched to be cooperative, so a handler that waits on the next hop's
+          HTTP call yields to the loop instead of holding a thread, and a node can keep thousands of forwards
+          in flight. The handlers, the outbound http_pool calls and the background threads are the same code in
+          both modes.
+
+Select the async mode with `SERVER_MODE=async` or by passing `--async` after the port.
+"""
+
+MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", "10000"))  # in-flight requests served at once in async mode
+RELOAD = os.getenv("SERVER_RELOAD", "on") == "on"  # threaded mode: restart on code changes, off for benchmarks
+
+
+def async_mode():
+    return os.getenv("SERVER_MODE", "threaded") == "async" or "--async" in sys.argv
+
+
+def patch_if_async():
+    # has to run before the node module imports requests/threading, otherwise blocking sockets slip through
+    if async_mode():
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def run(app, port):
+    if async_mode():
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIHandler, WSGIServer
+        import log  # not at the top: its thread-locals have to be created after gevent patched threading
+
+        class NoDelayHandler(WSGIHandler):
+            def handle(self):
+                # headers and body are separate writes, on a keep-alive connection Nagle would hold the body back
+                # until the peer's delayed ACK (~40 ms per hop)
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                super().handle()
+
+        log.get_logger("serving").info("Serving on port %s with the async (gevent) server", port)
+        WSGIServer(("0.0.0.0", port), app, spawn=Pool(MAX_CONCURRENCY), handler_class=NoDelayHandler,
+                   log=None).serve_forever()
+    else:
+        from keep_alive import KeepAliveRequestHandler
+        # the debug reloader runs the script a second time in a child process, with DATA_DIR both would open the
+        # same write-ahead log
+        app.run(host="0.0.0.0", port=port, debug=True, use_reloader=RELOAD and not os.getenv("DATA_DIR"),
+                request_handler=KeepAliveRequestHandler)
@@ -0,0 +1,396 @@
+import abc
+import atexit
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+
+from sortedcontainers import SortedList
+
+import keyspace
+import log
+
+"""
+Song storage of a node.
+
+MemoryStore is the song_name -> value map of the node plus an index of (ring position, song_name) kept sorted by
+sortedcontainers. The ring ranges (start, end] that move when nodes join or leave are found by bisecting the index,
+so extracting or dropping a range costs O(log n + m) for m moved songs instead of hashing every stored song.
+
+DurableStore adds a write-ahead log and periodic snapshots under DATA_DIR, so a restarted node recovers its songs
+from disk instead of having them re-replicated by the ring. Without DATA_DIR nodes keep the plain MemoryStore.
+Nodes with more songs than memory use the SegmentStore of segment_store.py (STORAGE_ENGINE=segments), nodes with
+many songs that should stay in memory the array-backed CompactStore of compact_store.py (STORAGE_ENGINE=compact).
+"""
+
+STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "memory")  # memory, compact or segments, see open_store
+DATA_DIR = os.getenv("DATA_DIR")  # unset: songs are kept in memory only
+WAL_FSYNC = os.getenv("WAL_FSYNC", "always")  # always: ack after fsync (group commit), interval: fsync every WAL_FSYNC_INTERVAL, never: leave it to the OS
+WAL_FSYNC_INTERVAL = float(os.getenv("WAL_FSYNC_INTERVAL", "0.1"))  # seconds
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))  # seconds between snapshot checks
+SNAPSHOT_MIN_RECORDS = int(os.getenv("SNAPSHOT_MIN_RECORDS", "10000"))  # log records needed before a snapshot is taken
+
+logger = log.get_logger("storage")
+
+
+class SongStore(MutableMapping, abc.ABC):
+    """
+    What Node expects from a storage engine: a song_name -> value mapping that can also work on ring ranges
+    (start, end], start None or start == end meaning the whole ring.
+    """
+
+    @abc.abstractmethod
+    def range_items(self, start, end, limit=None):
+        # [(song_name, value)] in (start, end], in ring order, only the first limit songs when limit is set
+        pass
+
+    @abc.abstractmethod
+    def delete_range(self, start, end):
+        # removes every song in (start, end], returns how many were removed
+        pass
+
+    @abc.abstractmethod
+    def replace(self, songs):
+        pass
+
+    def defer_sync(self):
+        # writes of the calling thread stop waiting for the disk until sync(), so a caller can apply them under a
+        # lock of its own and wait for them once it released it
+        pass
+
+    def sync(self):
+        pass
+
+    def ndjson_range(self, start, end, limit=None):
+        # body of /transfer_range, one {"song_name", "value"} object per line
+        for song_name, value in self.range_items(start, end, limit):
+            yield json.dumps({"song_name": song_name, "value": value}) + "\n"
+
+    def dump_json(self):
+        # every song as one JSON object
+        return json.dumps(dict(self.range_items(None, None)))
+
+
+class MemoryStore(SongStore):
+    def __init__(self, songs=None):
+        self._songs = {}
+        self._index = SortedList()  # (ring position, song_name)
+        self._lock = threading.RLock()
+        MemoryStore.replace(self, songs or {})
+
+    def __getitem__(self, song_name):
+        return self._songs[song_name]
+
+    def __setitem__(self, song_name, value):
+        with self._lock:
+            if song_name not in self._songs:
+                self._index.add((keyspace.key_id(song_name), song_name))
+            self._songs[song_name] = value
+
+    def __delitem__(self, song_name):
+        with self._lock:
+            del self._songs[song_name]
+            self._index.remove((keyspace.key_id(song_name), song_name))
+
+    def __iter__(self):
+        return iter(list(self._songs))
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __contains__(self, song_name):
+        return song_name in self._songs
+
+    def _slices(self, start, end):
+        # index slices [i, j) covering (start, end] in ring order, start None or start == end is the whole ring
+        if start is None or start == end:
+            return [(0, len(self._index))]
+        low = self._index.bisect_left((start + 1,))
+        high = self._index.bisect_left((end + 1,))
+        if start < end:
+            return [(low, high)]
+        return [(low, len(self._index)), (0, high)]  # wraps around 0
+
+    def dump_json(self):
+        with self._lock:
+            return json.dumps(self._songs)
+
+    def range_items(self, start, end, limit=None):
+        # [(song_name, value)] in (start, end], ordered by ring position starting after start
+        with self._lock:
+            positions = itertools.chain.from_iterable(self._index.islice(i, j) for i, j in self._slices(start, end))
+            return [(song_name, self._songs[song_name]) for _, song_name in itertools.islice(positions, limit)]
+
+    def delete_range(self, start, end):
+        with self._lock:
+            removed = 0
+            for i, j in sorted(self._slices(start, end), reverse=True):  # higher slice first, indices stay valid
+                for _, song_name in self._index[i:j]:
+                    del self._songs[song_name]
+                del self._index[i:j]
+                removed += j - i
+            return removed
+
+    def replace(self, songs):
+        # swaps the whole content, used when a node takes over (or clears) a full song list
+        with self._lock:
+            self._songs = {}
+            self._index = SortedList()
+            for song_name, value in songs.items():
+                MemoryStore.__setitem__(self, song_name, value)
+
+
+def generation_of(filename):
+    # wal-00000003.log -> 3
+    return int(os.path.basename(filename).split("-")[1].split(".")[0])
+
+
+class WriteAheadLog:
+    """
+    Append-only log of JSON records in <path>/wal-<generation>.log.
+
+    Records are buffered by append() and written by a flusher thread, which fsyncs according to the policy. With
+    fsync=always a writer waits (wait()) until its record is on disk, all writers that arrive during one fsync share
+    the next one (group commit). Callers keep records in order by appending under their own lock; a thread that
+    called defer() does not wait in wait(), sync() waits for all its records at once. rotate() closes
+    the current file and continues in the next generation, so everything before it can be compacted and deleted.
+    """
+
+    def __init__(self, path, generation, fsync=WAL_FSYNC):
+        self.path = path
+        self.fsync = fsync
+        self.generation = generation
+        self._file = open(self.file_path(generation), "a", encoding="utf-8")
+        self._pending = []  # encoded records not written yet
+        self._appended = 0  # sequence number of the last appended record
+        self._flushed = 0  # sequence number of the last record on disk
+        self.records = 0  # records written in the current generation
+        self._buffer_lock = threading.Condition()
+        self._durable = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._deferred = threading.local()  # .seq: last record of a thread between defer() and sync()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def file_path(self, generation):
+        return os.path.join(self.path, f"wal-{generation:08d}.log")
+
+    @staticmethod
+    def replay(path, from_generation=0):
+        # yields the records of every log of from_generation and later, oldest first
+        for wal in sorted(glob.glob(os.path.join(path, "wal-*.log"))):
+            if generation_of(wal) < from_generation:
+                continue
+            with open(wal, encoding="utf-8") as log:
+                for line in log:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn write at the tail of the log, nothing after it was acknowledged
+                    yield record
+
+    @staticmethod
+    def last_generation(path, default=0):
+        logs = sorted(glob.glob(os.path.join(path, "wal-*.log")))
+        return max(default, generation_of(logs[-1])) if logs else default
+
+    def append(self, record):
+        # returns the sequence number to pass to wait()
+        with self._buffer_lock:
+            self._pending.append(json.dumps(record) + "\n")
+            self._appended += 1
+            self._buffer_lock.notify()
+            return self._appended
+
+    def wait(self, seq):
+        if self.fsync != "always":
+            return
+        if getattr(self._deferred, "seq", None) is not None:
+            self._deferred.seq = max(self._deferred.seq, seq)
+            return
+        with self._durable:
+            while self._flushed < seq:
+                self._durable.wait()
+
+    def defer(self):
+        self._deferred.seq = 0
+
+    def sync(self):
+        seq, self._deferred.seq = getattr(self._deferred, "seq", None), None
+        if seq:
+            self.wait(seq)
+
+    def _flush(self):
+        # called with self._flush_lock held
+        with self._buffer_lock:
+            pending, self._pending = self._pending, []
+            seq = self._appended
+        if pending:
+            self._file.write("".join(pending))
+            self._file.flush()
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self.records += len(pending)
+        with self._durable:
+            self._flushed = seq
+            self._durable.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._buffer_lock:
+                while not self._pending:
+                    self._buffer_lock.wait()
+            if self.fsync == "interval":
+                time.sleep(WAL_FSYNC_INTERVAL)  # let records pile up, one fsync per interval
+            with self._flush_lock:
+                self._flush()
+
+    def rotate(self):
+        # flushes what is pending and continues in the next generation, returns the new generation
+        with self._flush_lock:
+            self._flush()
+            self._file.close()
+            self.generation += 1
+            self._file = open(self.file_path(self.generation), "a", encoding="utf-8")
+            self.records = 0
+            return self.generation
+
+    def delete_before(self, generation):
+        for wal in glob.glob(os.path.join(self.path, "wal-*.log")):
+            if generation_of(wal) < generation:
+                os.remove(wal)
+
+    def close(self):
+        with self._flush_lock:
+            self._flush()
+            os.fsync(self._file.fileno())
+
+
+class DurableStore(MemoryStore):
+    """
+    MemoryStore backed by a WriteAheadLog in a directory of its own.
+
+    Every mutation is applied in memory and appended to the log under the store lock. A snapshot thread periodically
+    rotates the log and writes snapshot-<gen>.json with the state at the rotation, after which the older logs and
+    snapshots are deleted. Recovery loads the newest snapshot and replays the logs of its generation and later.
+    """
+
+    def __init__(self, path, fsync=WAL_FSYNC):
+        MemoryStore.__init__(self)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        generation = 0
+        snapshots = sorted(glob.glob(os.path.join(path, "snapshot-*.json")))
+        if snapshots:
+            with open(snapshots[-1], encoding="utf-8") as snapshot:
+                MemoryStore.replace(self, json.load(snapshot))
+            generation = generation_of(snapshots[-1])
+        replayed = 0
+        for record in WriteAheadLog.replay(path, generation):
+            self._apply(record)
+            replayed += 1
+        logger.info("Recovered %s songs from %s (%s log records replayed)", len(self), path, replayed)
+        self._wal = WriteAheadLog(path, WriteAheadLog.last_generation(path, generation), fsync)
+        self._wal.records = replayed
+        threading.Thread(target=self._snapshot_loop, daemon=True).start()
+
+    def _snapshot_path(self, generation):
+        return os.path.join(self.path, f"snapshot-{generation:08d}.json")
+
+    def _apply(self, record):
+        if record["op"] == "set":
+            MemoryStore.__setitem__(self, record["song_name"], record["value"])
+        elif record["op"] == "del":
+            if record["song_name"] in self:
+                MemoryStore.__delitem__(self, record["song_name"])
+        elif record["op"] == "drop":
+            start = record["start"]
+            MemoryStore.delete_range(self, None if start is None else keyspace.from_hex(start), keyspace.from_hex(record["end"]))
+
+    def __setitem__(self, song_name, value):
+        with self._lock:
+            MemoryStore.__setitem__(self, song_name, value)
+            seq = self._wal.append({"op": "set", "song_name": song_name, "value": value})
+        self._wal.wait(seq)
+
+    def __delitem__(self, song_name):
+        with self._lock:
+            MemoryStore.__delitem__(self, song_name)
+            seq = self._wal.append({"op": "del", "song_name": song_name})
+        self._wal.wait(seq)
+
+    def delete_range(self, start, end):
+        with self._lock:
+            removed = MemoryStore.delete_range(self, start, end)
+            seq = self._wal.append({"op": "drop", "start": None if start is None else keyspace.to_hex(start), "end": keyspace.to_hex(end)})
+        self._wal.wait(seq)
+        return removed
+
+    def defer_sync(self):
+        self._wal.defer()
+
+    def sync(self):
+        self._wal.sync()
+
+    def replace(self, songs):
+        # the new content is written as a snapshot right away instead of one log record per song
+        with self._lock:
+            MemoryStore.replace(self, songs)
+            state, generation = dict(self._songs), self._wal.rotate()
+        self._write_snapshot(state, generation)
+
+    def snapshot(self):
+        with self._lock:
+            state, generation = dict(self._songs), self._wal.rotate()
+        self._write_snapshot(state, generation)
+
+    def _write_snapshot(self, state, generation):
+        temporary = self._snapshot_path(generation) + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as snapshot:
+            json.dump(state, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self._snapshot_path(generation))
+        # everything before this generation is covered by the snapshot now
+        self._wal.delete_before(generation)
+        for old in glob.glob(os.path.join(self.path, "snapshot-*.json")):
+            if generation_of(old) < generation:
+                os.remove(old)
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            if self._wal.records >= SNAPSHOT_MIN_RECORDS:
+                self.snapshot()
+
+
+def open_store(name, songs=None):
+    """
+    Storage of a node, chosen by STORAGE_ENGINE:
+      memory:   a DurableStore in DATA_DIR/<name> when DATA_DIR is set, otherwise a MemoryStore (the default)
+      compact:  a CompactStore, songs in packed arrays instead of Python objects (memory only, no DATA_DIR)
+      segments: a SegmentStore in DATA_DIR/<name>, for nodes whose songs do not fit in memory
+    Songs recovered from disk take precedence over the initial songs.
+    """
+    if STORAGE_ENGINE == "segments":
+        if not DATA_DIR:
+            raise ValueError("STORAGE_ENGINE=segments keeps the songs on disk and needs DATA_DIR")
+        from segment_store import SegmentStore  # segment_store builds on this module
+        store = SegmentStore(os.path.join(DATA_DIR, name))
+    elif STORAGE_ENGINE == "compact":
+        if DATA_DIR:
+            raise ValueError("STORAGE_ENGINE=compact keeps the songs in memory only, unset DATA_DIR")
+        from compact_store import CompactStore  # compact_store builds on this module
+        return CompactStore(songs)
+    elif STORAGE_ENGINE == "memory":
+        if not DATA_DIR:
+            return MemoryStore(songs)
+        store = DurableStore(os.path.join(DATA_DIR, name))
+    else:
+        raise ValueError(f"Unknown STORAGE_ENGINE '{STORAGE_ENGINE}'")
+    for song_name, value in (songs or {}).items():
+        store.setdefault(song_name, value)
+    return store
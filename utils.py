@@ -1,11 +1,14 @@
 import hashlib
+import os
 import socket
 
 nodes = {}
 
-k = 2 # replication factor, default value is 1
+k = int(os.getenv("REPLICATION_FACTOR", "2")) # replication factor, default value is 2
 
-consistency = "chain replication" # default value is 'chain replication' -> linearizability, 2 choices "eventual consistency" and "chain replication"
+consistency = os.getenv("CONSISTENCY", "chain replication") # default value is 'chain replication' -> linearizability, 2 choices "eventual consistency" and "chain replication"
+
+lookup_mode = os.getenv("LOOKUP_MODE", "recursive") # "recursive": nodes forward the request themselves, "iterative": nodes redirect the client to the next hop (overridable per request with ?mode=)
 
 
 def hash_function(key: str):
@@ -13,7 +16,9 @@ def hash_function(key: str):
 
 
 def get_local_ip():
-   # return the local IP address of the current machine
+   # return the local IP address of the current machine, NODE_IP overrides it (e.g. 127.0.0.1 for a cluster on one box)
+    if os.getenv("NODE_IP"):
+        return os.getenv("NODE_IP")
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.connect(("8.8.8.8", 80))